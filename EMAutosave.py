@@ -0,0 +1,452 @@
+"""
+Encounter Mapper is a tile-based encounter map creator for tabletop RPGs.
+Copyright 2019, 2020 Eric Symmank
+
+This file is part of Encounter Mapper.
+
+Encounter Mapper is free software: you can redistribute it
+and/or modify it under the terms of the GNU General Public License as
+published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+
+Encounter Mapper is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Encounter Mapper.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import json
+import os
+
+from PyQt5.QtCore import QObject, QTimer, pyqtSignal
+
+from EMHelper import ModelManager
+from EMMapFile import MapFileFormat
+from EMModel import MapModel
+
+
+class AutosaveService(QObject):
+    """
+    Incremental autosave for the map being edited.
+
+    Rather than saving the whole map on a timer, the service listens to the
+    edits made to the model (tilesChanged, gridResized, notesChanged) and
+    only records which cells and notes have changed. Every checkpoint writes
+    those as a small delta file on top of a base: either the file the map
+    was last saved to or opened from, or a snapshot written by the service
+    itself. After DeltasPerSnapshot deltas the base and its deltas are
+    folded into a new snapshot on the save worker, without touching the
+    model on the UI thread.
+
+    All the files live in the autosave directory:
+
+    session.json        which base and generation of deltas are current
+    snapshot_<g>.emap   snapshot written for generation g
+    delta_<g>_<n>.json  the n-th delta on top of generation g
+
+    Files are only written through the SaveQueue, so they are atomic and
+    land in the order they were made. They are queued as quiet saves, which
+    the status bar does not report. Explicit saves should call markSaved()
+    and a clean exit discard(). Anything left behind after a crash can be
+    restored with recoverModel().
+
+    When several maps are open, each needs a service with a directory of
+    its own. recoveryDirectories() finds the ones a crash left behind. Their
+    files are kept until a service for the map restored from them is told
+    markRecovered(), which writes it out again right away, or until
+    discardDirectory() is called.
+
+    A fold only replaces the session and removes the files it was built
+    from once its snapshot has been written. If it fails, they are left in
+    place and the next checkpoint writes the model out in full instead.
+
+    Signals
+    -------
+
+    foldFailed -> int
+        emitted from the save worker with the generation of a snapshot that
+        could not be written
+    """
+
+    foldFailed = pyqtSignal(int)
+
+    Interval = 30000
+    DeltasPerSnapshot = 10
+
+    SessionName = "session.json"
+    SnapshotName = "snapshot_{}.emap"
+    DeltaName = "delta_{}_{}.json"
+
+    EmptyTile = (-1, 0, False, False)
+
+    def __init__(self, model=None, directory=None):
+        super(AutosaveService, self).__init__()
+        self.directory = (ModelManager.resourcePath("autosave")
+                          if directory is None else directory)
+        self.model = None
+        self.base = None
+        self.source = None
+        self.generation = 0
+        self.deltaCount = 0
+        self.resetChanges()
+
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.checkpoint)
+        self.timer.start(self.Interval)
+        self.foldFailed.connect(self.restartFromModel)
+
+        if model is not None:
+            self.setModel(model)
+
+    def resetChanges(self):
+        self.dirtyCells = set()
+        self.dirtyNotes = set()
+        self.minRows = None
+        self.minCols = None
+        self.dirty = False
+
+    def filePath(self, name):
+        return os.path.join(self.directory, name)
+
+    def setModel(self, model, source=None):
+        """
+        Start tracking model. source is the file it was opened from, if any.
+        """
+        if self.model is not None:
+            self.model.tilesChanged.disconnect(self.recordTiles)
+            self.model.gridResized.disconnect(self.recordResize)
+            self.model.notesChanged.disconnect(self.recordNotes)
+        self.model = model
+        self.model.tilesChanged.connect(self.recordTiles)
+        self.model.gridResized.connect(self.recordResize)
+        self.model.notesChanged.connect(self.recordNotes)
+        session = self.loadSession(self.directory)
+        if session is not None:
+            # number on from the generation left behind, so none of its
+            # files can be mistaken for ours
+            self.generation = max(self.generation, session["generation"])
+        if self.hasRecovery(self.directory):
+            # a crash's unsaved changes stay until the map recovered from
+            # them replaces them, or the user discards them
+            self.forget()
+        else:
+            self.discard()
+        if source is not None:
+            self.markSaved(source)
+
+    def markSaved(self, path):
+        """
+        The model now matches path, which becomes the base for new deltas
+        """
+        self.source = path
+        self.generation += 1
+        self.startGeneration(path)
+
+    def markRecovered(self, source=None):
+        """
+        The model was recovered from a crash and has changes that source,
+        the file it was last saved to, does not. Write it out right away
+        rather than waiting for the next edit.
+        """
+        self.source = source
+        self.base = None
+        self.dirty = True
+        self.checkpoint()
+
+    def startGeneration(self, base):
+        self.base = base
+        self.deltaCount = 0
+        self.resetChanges()
+        self.writeSession()
+        self.removeStaleFiles()
+
+    def recordTiles(self, x, y, w, h):
+        for yi in range(y, y + h):
+            for xi in range(x, x + w):
+                self.dirtyCells.add((xi, yi))
+        self.dirty = True
+
+    def recordResize(self):
+        rows = self.model.getNumRows()
+        cols = self.model.getNumCols()
+        self.minRows = rows if self.minRows is None else min(
+            self.minRows, rows)
+        self.minCols = cols if self.minCols is None else min(
+            self.minCols, cols)
+        self.dirty = True
+
+    def recordNotes(self, first, last):
+        self.dirtyNotes.update(range(first, last + 1))
+        self.dirty = True
+
+    def checkpoint(self):
+        if self.model is None or not self.dirty:
+            return
+        if self.base is None:
+            # nothing to apply deltas to yet, so the first checkpoint of an
+            # unsaved map writes it out in full
+            self.generation += 1
+            snapshot = self.filePath(self.SnapshotName.format(
+                self.generation))
+            self.ensureDirectory()
+            ModelManager.saveMapToFile(self.model, snapshot, quiet=True)
+            self.startGeneration(snapshot)
+            return
+
+        self.deltaCount += 1
+        self.ensureDirectory()
+        ModelManager.saveJSONToFile(
+            self.deltaJS(), self.filePath(self.DeltaName.format(
+                self.generation, self.deltaCount)), quiet=True)
+        self.resetChanges()
+        if self.deltaCount >= self.DeltasPerSnapshot:
+            self.fold()
+
+    def deltaJS(self):
+        rows = self.model.getNumRows()
+        cols = self.model.getNumCols()
+        grid = self.model.getTileGrid()
+        cells = []
+        for (x, y) in sorted(self.dirtyCells, key=lambda c: (c[1], c[0])):
+            if x < cols and y < rows:
+                tile = grid[y][x]
+                cells.append([x, y, tile[0], tile[1], tile[2], tile[3]])
+        notes = self.model.getMapNotes()
+        changedNotes = {}
+        for i in self.dirtyNotes:
+            if i < len(notes):
+                changedNotes[str(i)] = notes[i].jsonObj()
+        delta = {
+            "name": self.model.getName(),
+            "rows": rows,
+            "cols": cols,
+            "cells": cells,
+            "noteCount": len(notes),
+            "notes": changedNotes
+        }
+        if self.minRows is not None:
+            delta["truncate"] = [self.minRows, self.minCols]
+        return delta
+
+    def fold(self):
+        """Merge the base and its deltas into a new snapshot on the worker"""
+        base = self.base
+        deltas = [self.filePath(self.DeltaName.format(self.generation, n))
+                  for n in range(1, self.deltaCount + 1)]
+        self.generation += 1
+        snapshot = self.filePath(self.SnapshotName.format(self.generation))
+        ModelManager.fetchSaveQueue().enqueueTask(
+            self.writeFold, base, deltas, snapshot, self.sessionJS(snapshot))
+        # the worker writes the session once the snapshot is in place
+        self.base = snapshot
+        self.deltaCount = 0
+        self.resetChanges()
+
+    def writeFold(self, base, deltas, snapshot, session):
+        # runs on the save worker, and must not touch the service's state
+        try:
+            jsObj = self.loadBase(base, deltas)
+            if jsObj is None:
+                raise IOError("could not read {}".format(base))
+            ModelManager.writeFileAtomic(snapshot, MapFileFormat.dumps(jsObj))
+            ModelManager.writeFileAtomic(
+                os.path.join(self.directory, self.SessionName),
+                ModelManager.encodeJSON(session))
+        except Exception as e:
+            # the previous session, base and deltas are still intact
+            print("WARNING: autosave could not fold {}: {}".format(base, e))
+            self.foldFailed.emit(session["generation"])
+            return
+        self.removeStale(self.directory, session["generation"], snapshot)
+
+    def restartFromModel(self, generation):
+        """Write the model out in full after the fold of generation failed"""
+        if generation == self.generation and self.model is not None:
+            self.base = None
+            self.dirty = True
+            self.checkpoint()
+
+    @classmethod
+    def loadBase(cls, base, deltas):
+        jsObj = ModelManager.loadJSFromFile(base)
+        if jsObj is None:
+            return None
+        grid = [list(row) for row in jsObj["grid"]]
+        notes = list(jsObj["notes"])
+        for path in deltas:
+            f = open(path, "r")
+            delta = json.loads(f.read())
+            f.close()
+            cls.applyDelta(grid, notes, delta)
+            jsObj["name"] = delta["name"]
+        jsObj["grid"] = grid
+        jsObj["notes"] = notes
+        counts = {}
+        for row in grid:
+            for tile in row:
+                counts[tile[0]] = counts.get(tile[0], 0) + 1
+        jsObj["ttf"] = list(counts)
+        jsObj["counts"] = [[uid, count] for (uid, count) in counts.items()]
+        return jsObj
+
+    @classmethod
+    def applyDelta(cls, grid, notes, delta):
+        if "truncate" in delta:
+            rows, cols = delta["truncate"]
+            del grid[rows:]
+            for row in grid:
+                del row[cols:]
+        while len(grid) < delta["rows"]:
+            grid.append([])
+        for row in grid:
+            row.extend([cls.EmptyTile] * (delta["cols"] - len(row)))
+        for cell in delta["cells"]:
+            grid[cell[1]][cell[0]] = (cell[2], cell[3], cell[4], cell[5])
+
+        del notes[delta["noteCount"]:]
+        for index, note in delta["notes"].items():
+            index = int(index)
+            while len(notes) <= index:
+                notes.append(None)
+            notes[index] = note
+
+    def sessionJS(self, base):
+        return {
+            "base": base,
+            "source": self.source,
+            "generation": self.generation
+        }
+
+    def writeSession(self):
+        self.ensureDirectory()
+        ModelManager.saveJSONToFile(self.sessionJS(self.base),
+                                    self.filePath(self.SessionName),
+                                    quiet=True)
+
+    def removeStaleFiles(self):
+        """Queue removal of files that the current session no longer uses"""
+        ModelManager.fetchSaveQueue().enqueueTask(
+            self.removeStale, self.directory, self.generation, self.base)
+
+    @classmethod
+    def removeStale(cls, directory, generation, base):
+        # runs on the save worker, after every file queued before it landed
+        if not os.path.isdir(directory):
+            return
+        if base is not None and not os.path.exists(base):
+            # the new base failed to save, so keep what it would replace
+            return
+        for name in os.listdir(directory):
+            parts = os.path.splitext(name)[0].split("_")
+            if parts[0] in ("snapshot", "delta") and len(parts) > 1:
+                fileGen = int(parts[1]) if parts[1].isdigit() else -1
+                path = os.path.join(directory, name)
+                if fileGen < generation and path != base:
+                    os.remove(path)
+
+    @classmethod
+    def removeDirectoryFiles(cls, directory):
+        if not os.path.isdir(directory):
+            return
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+
+    def forget(self):
+        """Start over without a base, leaving the files where they are"""
+        self.base = None
+        self.source = None
+        self.deltaCount = 0
+        self.resetChanges()
+
+    def discard(self):
+        """Forget all autosave data, e.g. after a clean exit"""
+        self.forget()
+        ModelManager.fetchSaveQueue().enqueueTask(
+            self.removeDirectoryFiles, self.directory)
+
+    @classmethod
+    def discardDirectory(cls, directory):
+        """Delete the unsaved changes a crash left in directory"""
+        ModelManager.fetchSaveQueue().enqueueTask(
+            cls.removeDirectoryFiles, directory)
+
+    def close(self):
+        """Stop tracking the model and forget its autosave data"""
+        self.timer.stop()
+        if self.model is not None:
+            self.model.tilesChanged.disconnect(self.recordTiles)
+            self.model.gridResized.disconnect(self.recordResize)
+            self.model.notesChanged.disconnect(self.recordNotes)
+            self.model = None
+        self.discard()
+
+    def ensureDirectory(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    @classmethod
+    def hasRecovery(cls, directory=None):
+        """Check whether a crashed session left unsaved changes behind"""
+        session = cls.loadSession(directory)
+        if session is None:
+            return False
+        directory = os.path.dirname(session["path"])
+        prefix = "delta_{}_".format(session["generation"])
+        return (session["base"] != session["source"] or any(
+            name.startswith(prefix) for name in os.listdir(directory)))
+
+    @classmethod
+    def recoveryDirectories(cls, root=None):
+        """List the directories below root that hold a map to recover"""
+        root = ModelManager.resourcePath("autosave") if root is None else root
+        if not os.path.isdir(root):
+            return []
+        directories = [os.path.join(root, name)
+                       for name in sorted(os.listdir(root))]
+        return [directory for directory in directories
+                if os.path.isdir(directory) and cls.hasRecovery(directory)]
+
+    @classmethod
+    def loadSession(cls, directory=None):
+        directory = (ModelManager.resourcePath("autosave")
+                     if directory is None else directory)
+        path = os.path.join(directory, cls.SessionName)
+        if not os.path.exists(path):
+            return None
+        f = open(path, "r")
+        session = json.loads(f.read())
+        f.close()
+        if session["base"] is None:
+            return None
+        session["path"] = path
+        return session
+
+    @classmethod
+    def recoverModel(cls, directory=None):
+        """
+        Rebuild the map of a crashed session.
+
+        Returns a (model, source) tuple, where source is the file the map
+        was last saved to, or (None, None) if there is nothing to recover.
+        """
+        session = cls.loadSession(directory)
+        if session is None:
+            return (None, None)
+        directory = os.path.dirname(session["path"])
+        deltas = []
+        n = 1
+        while True:
+            path = os.path.join(directory, cls.DeltaName.format(
+                session["generation"], n))
+            if not os.path.exists(path):
+                break
+            deltas.append(path)
+            n += 1
+        jsObj = cls.loadBase(session["base"], deltas)
+        if jsObj is None:
+            return (None, None)
+        return (MapModel.createModelJS(jsObj), session["source"])
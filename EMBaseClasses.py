@@ -19,11 +19,12 @@ along with Encounter Mapper.
 If not, see <https://www.gnu.org/licenses/>.
 """
 
-from PyQt5.QtCore import Qt, pyqtSignal
+from PyQt5.QtCore import Qt, pyqtSignal, QTimer
 from PyQt5.QtGui import QPolygon
 from PyQt5.QtWidgets import (QVBoxLayout, QHBoxLayout, QLabel,
                              QPushButton, QWidget, QListWidget,
-                             QListWidgetItem, QDialog, QLineEdit)
+                             QListWidgetItem, QDialog, QLineEdit,
+                             QMessageBox)
 
 # from EMModelEditor import ModelEditor, ModelPreviewWidget
 # from EMModel import ModelModel
@@ -39,9 +40,10 @@ class EMModelPicker(QWidget):
     a base class that can fetch said models from memory, populate a list
     with depictions of the models, and allow for the creation/selection
     of new models. Use of the EMModelPicker requires a modelClass, which
-    is the data being organized, a modelPreviewClass, which generates a
-    graphical representation of the model, and an editorClass, which is opened
-    whenever editing/creating a new instance of the model
+    is the data being organized and creates new ones through newModel(), a
+    modelPreviewClass, which generates a graphical representation of the
+    model, and an editorClass, which is opened whenever editing/creating a
+    new instance of the model
 
     Signals
     -------
@@ -96,7 +98,16 @@ class EMModelPicker(QWidget):
         layout.addWidget(self.duplicateModelButton)
         layout.addWidget(self.deleteModelButton)
         self.setLayout(layout)
-        self.loadModels()
+        self.modelsLoaded = False
+        ModelManager.fetchModelEvents().modelsInvalidated.connect(
+            self.refreshPreviews)
+
+    def showEvent(self, event):
+        # Loading and drawing every preview is expensive, so wait until the
+        # picker is actually shown
+        if not self.modelsLoaded:
+            self.loadModels()
+        super(EMModelPicker, self).showEvent(event)
 
     def updateSelectedModel(self):
         sr = self.modelList.currentRow()
@@ -106,7 +117,7 @@ class EMModelPicker(QWidget):
     def newModelDialog(self):
         self.modelDialog = QDialog()
         layout = QVBoxLayout()
-        self.modelEditor = self.editorClass(self.modelClass())
+        self.modelEditor = self.editorClass(self.modelClass.newModel())
         self.modelEditor.applyEdit.connect(self.addNewModel)
         self.modelEditor.cancelEdit.connect(self.cancelEdit)
         layout.addWidget(self.modelEditor)
@@ -118,7 +129,8 @@ class EMModelPicker(QWidget):
         if sr >= 0:
             self.modelDialog = QDialog()
             layout = QVBoxLayout()
-            tempCopy = self.modelClass.createModelCopy(self.models[sr])
+            tempCopy = ModelManager.fetchEditableCopy(
+                self.modelName, self.models[sr].getUid())
 
             self.modelEditor = self.editorClass(tempCopy)
             self.modelEditor.applyEdit.connect(self.updateExistingModel)
@@ -155,7 +167,8 @@ class EMModelPicker(QWidget):
     def duplicateModel(self):
         sr = self.modelList.currentRow()
         if sr >= 0:
-            dupe = self.modelClass.createModelCopy(self.models[sr])
+            dupe = ModelManager.fetchEditableCopy(
+                self.modelName, self.models[sr].getUid())
 
             name = "{}_copy".format(dupe.getName())
             dupe.setName(name)
@@ -167,11 +180,38 @@ class EMModelPicker(QWidget):
         sr = self.modelList.currentRow()
         if sr >= 0:
             uid = self.models[sr].getUid()
+            if not self.confirmDelete(self.models[sr]):
+                return
             ModelManager.deleteModel(self.modelName, self.models[sr])
             del self.models[sr]
             self.updateUI()
             self.deletedModel.emit(uid)
 
+    def confirmDelete(self, model):
+        """Ask before deleting a model that other models still use"""
+        references = ModelManager.fetchReferences(self.modelName,
+                                                  model.getUid())
+        if not references:
+            return True
+        names = ["{} \"{}\"".format(name, ref.getName())
+                 for (name, ref) in references]
+        shown = names[:10]
+        if len(names) > len(shown):
+            shown.append("and {} more".format(len(names) - len(shown)))
+        answer = QMessageBox.warning(
+            self, "Delete " + self.modelName,
+            "{} \"{}\" is still used by:\n\n{}\n\nThese will show empty "
+            "spaces where it was used. Delete it anyway?".format(
+                self.modelName, model.getName(), "\n".join(shown)),
+            QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
+        return answer == QMessageBox.Yes
+
+    def refreshPreviews(self, invalidated):
+        for (name, uid) in invalidated:
+            if name == self.modelName:
+                self.modelList.viewport().update()
+                break
+
     def updateUI(self):
         self.modelList.clear()
         for model in self.models:
@@ -183,6 +223,7 @@ class EMModelPicker(QWidget):
             self.modelList.setItemWidget(listItem, listItemWidget)
 
     def loadModels(self):
+        self.modelsLoaded = True
         ModelManager.loadModelListFromFile(self.modelName, self.modelClass)
         self.models = ModelManager.fetchModels(self.modelName)
         self.updateUI()
@@ -285,8 +326,15 @@ class EMModelGraphics(QWidget):
 
     The preview property determines when the graphics can be interacted with,
     and should only be True when used in conjunction with an editor.
+
+    While the user is dragging or zooming, subclasses call beginDraft() and
+    should paint at draft quality while self.draft is set: flat colours and
+    fast scaling. Once nothing has happened for DraftIdleDelay milliseconds,
+    endDraft() clears it and repaints at full quality.
     """
 
+    DraftIdleDelay = 150
+
     updatePreview = pyqtSignal()
     selectedItem = pyqtSignal(int, int)
     selectedGroup = pyqtSignal(int, int, int, int, int)
@@ -310,6 +358,10 @@ class EMModelGraphics(QWidget):
         self.mouseIndex = (-1, -1)
         self.mousePressed = False
         self.modelImage = None
+        self.draft = False
+        self.draftTimer = QTimer(self)
+        self.draftTimer.setSingleShot(True)
+        self.draftTimer.timeout.connect(self.endDraft)
 
         self.setMinimumHeight(height)
         self.setMinimumWidth(width)
@@ -323,6 +375,15 @@ class EMModelGraphics(QWidget):
         return (self.sOptions[0], self.sOptions[1],
                 self.sOptions[2])
 
+    def beginDraft(self):
+        """Paint at draft quality until the interaction has been idle"""
+        self.draft = True
+        self.draftTimer.start(self.DraftIdleDelay)
+
+    def endDraft(self):
+        self.draft = False
+        self.update()
+
     def getZoomPercentage(self):
         return self.zPercent
 
@@ -338,8 +399,9 @@ class EMModelGraphics(QWidget):
 
     def calculateSize(self):
         # TODO: Calculate scale as well in Future
-        self.width = (self.model.getNumCols() * self.tileSize)
-        self.height = (self.model.getNumRows() * self.tileSize)
+        # tileSize is fractional at most zoom levels, widget sizes are not
+        self.width = int(self.model.getNumCols() * self.tileSize)
+        self.height = int(self.model.getNumRows() * self.tileSize)
         self.xOffset = 0
         self.yOffset = 0
         self.setMinimumWidth(self.width)
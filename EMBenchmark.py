@@ -0,0 +1,554 @@
+"""
+Encounter Mapper is a tile-based encounter map creator for tabletop RPGs.
+Copyright 2019, 2020 Eric Symmank
+
+This file is part of Encounter Mapper.
+
+Encounter Mapper is free software: you can redistribute it
+and/or modify it under the terms of the GNU General Public License as
+published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+
+Encounter Mapper is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Encounter Mapper.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+# Benchmarks never need a display
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+import argparse  # noqa: E402
+import http.client  # noqa: E402
+import json  # noqa: E402
+import platform  # noqa: E402
+import random  # noqa: E402
+import shutil  # noqa: E402
+import statistics  # noqa: E402
+import sys  # noqa: E402
+import tempfile  # noqa: E402
+import threading  # noqa: E402
+import time  # noqa: E402
+
+from PyQt5.QtCore import QPoint, QT_VERSION_STR  # noqa: E402
+from PyQt5.QtGui import (QBrush, QColor, QImage, QPainter,  # noqa: E402
+                         QRegion)
+from PyQt5.QtWidgets import QApplication  # noqa: E402
+
+from EMHelper import ModelManager, EMImageGenerator  # noqa: E402
+from EMCache import CacheManager  # noqa: E402
+from EMModel import (TileModel, GroupModel, MapModel,  # noqa: E402
+                     TextureModelLoader, NoteData)
+from EMMapEditor import MapEditorGraphics  # noqa: E402
+from EMRenderServer import RenderService  # noqa: E402
+
+
+class Benchmark():
+    """
+    Reproducible timings of the expensive operations of Encounter Mapper.
+
+    Everything runs against synthetic Tile, Group and Texture libraries that
+    are generated from a fixed seed into a temporary directory, which also
+    becomes the working directory so ModelManager reads and writes there
+    instead of the real libraries. Every case is run `repeat` times and
+    reported as the min, median and mean in milliseconds.
+
+    The renderServer cases run a RenderService on a free localhost port.
+
+    Results are written as JSON. Passing a baseline compares the medians
+    against an earlier run, and any case that is more than `threshold`
+    slower is reported as a regression.
+
+    Run with:
+        python EMBenchmark.py [--quick] [--output results.json]
+                              [--baseline baseline.json] [--save-baseline]
+    """
+
+    Seed = 2020
+
+    MapSizes = (10, 50, 100, 200)
+    LibrarySizes = (10, 100, 1000, 10000)
+    QuickMapSizes = (10, 50)
+    QuickLibrarySizes = (10, 100)
+
+    # Library used by every case that is not about the library itself
+    DefaultTiles = 100
+    NumTextures = 20
+    NumGroups = 50
+    GroupSize = 4
+
+    # Full map images above this size would need gigabytes of memory, so
+    # larger maps are rendered through a window of this many cells
+    FullImageCells = 25
+    RenderWindow = 10
+
+    # cells filled per run by the fill rate cases
+    FillCells = 10
+
+    Viewport = (800, 600)
+    ZoomLevels = (25, 50, 100)
+    PaintSteps = 10
+
+    # requests per run against the render server, split among the clients
+    ServerRequests = 40
+    ServerClients = 4
+
+    def __init__(self, repeat=3, quick=False):
+        self.repeat = repeat
+        self.mapSizes = self.QuickMapSizes if quick else self.MapSizes
+        self.librarySizes = (self.QuickLibrarySizes if quick
+                             else self.LibrarySizes)
+        self.results = {}
+        self.random = random.Random(self.Seed)
+        self.directory = None
+        self.previousDirectory = None
+
+    def setUp(self):
+        self.previousDirectory = os.getcwd()
+        sourceDirectory = os.path.dirname(os.path.abspath(__file__))
+        self.directory = tempfile.mkdtemp(prefix="em_benchmark_")
+        os.symlink(os.path.join(sourceDirectory, "res"),
+                   os.path.join(self.directory, "res"))
+        os.chdir(self.directory)
+        self.writeLibraries(self.DefaultTiles)
+
+    def tearDown(self):
+        ModelManager.fetchSaveQueue().waitForIdle()
+        os.chdir(self.previousDirectory)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def resetLibraries(self):
+        ModelManager.loadedModels.clear()
+        ModelManager.pendingLoads.clear()
+        self.clearRenders()
+
+    def clearRenders(self):
+        EMImageGenerator.textureModelImages.clear()
+        EMImageGenerator.tileImages.clear()
+
+    def loadLibraries(self):
+        ModelManager.loadModelListFromFile(ModelManager.TextureName,
+                                           TextureModelLoader)
+        ModelManager.loadModelListFromFile(ModelManager.TileName, TileModel)
+        ModelManager.loadModelListFromFile(ModelManager.GroupName, GroupModel)
+
+    # ------------------------------------------------------------------
+    # Synthetic data
+
+    def textureJS(self, uid):
+        names = ModelManager.TextureNames
+        return {
+            "textureType": "Generated",
+            "name": "texture {}".format(uid),
+            "tags": "",
+            "textures": [
+                [self.random.choice(names),
+                 [self.random.randrange(256) for i in range(3)]],
+                [self.random.choice(names),
+                 [self.random.randrange(256) for i in range(3)]]
+            ],
+            "bgColor": [self.random.randrange(256) for i in range(3)],
+            "uid": uid
+        }
+
+    def tileJS(self, uid):
+        shapes = []
+        for i in range(self.random.randrange(4)):
+            points = [[self.random.randrange(101), self.random.randrange(101)]
+                      for p in range(self.random.randrange(3, 8))]
+            shapes.append([self.random.randrange(self.NumTextures), points])
+        return {
+            "name": "tile {}".format(uid),
+            "uid": uid,
+            "shapeList": shapes,
+            "bgTexture": self.random.randrange(self.NumTextures),
+            "tags": ""
+        }
+
+    def randomTile(self, numTiles):
+        return (self.random.randrange(numTiles), self.random.randrange(4),
+                self.random.random() < 0.5, self.random.random() < 0.5)
+
+    def randomGrid(self, rows, cols, numTiles):
+        return [[self.randomTile(numTiles) for x in range(cols)]
+                for y in range(rows)]
+
+    def groupJS(self, uid, numTiles):
+        grid = self.randomGrid(self.GroupSize, self.GroupSize, numTiles)
+        return GroupModel("group {}".format(uid), grid, uid=uid).jsonObj()
+
+    def writeLibraries(self, numTiles):
+        libraries = {
+            ModelManager.TextureName: [self.textureJS(uid)
+                                       for uid in range(self.NumTextures)],
+            ModelManager.TileName: [self.tileJS(uid)
+                                    for uid in range(numTiles)],
+            ModelManager.GroupName: [self.groupJS(uid, numTiles)
+                                     for uid in range(self.NumGroups)]
+        }
+        for name, jsObj in libraries.items():
+            f = open(name + ModelManager.ConfigExt, "w")
+            f.write(json.dumps(jsObj))
+            f.close()
+        self.resetLibraries()
+
+    def createMap(self, size):
+        model = MapModel("map {}".format(size),
+                         self.randomGrid(size, size, self.DefaultTiles))
+        for i in range(min(size, 20)):
+            model.addMapNote(NoteData(
+                i % 4, "note {}".format(i), "", self.random.random() * size,
+                self.random.random() * size))
+        return model
+
+    # ------------------------------------------------------------------
+    # Measuring
+
+    def measure(self, name, func, setUp=None):
+        """Time func, calling setUp untimed before every run"""
+        # one untimed run first, so caches filled on first use do not end
+        # up in the numbers
+        if setUp is not None:
+            setUp()
+        func()
+        times = []
+        for i in range(self.repeat):
+            if setUp is not None:
+                setUp()
+            start = time.perf_counter()
+            func()
+            times.append((time.perf_counter() - start) * 1000)
+        self.results[name] = {
+            "runs": len(times),
+            "min": min(times),
+            "median": statistics.median(times),
+            "mean": statistics.mean(times)
+        }
+        print("{:<45} {:>10.2f} ms".format(name, self.results[name]["median"]),
+              file=sys.stderr)
+
+    def run(self):
+        self.setUp()
+        try:
+            self.benchLibraries()
+            self.resetLibraries()
+            self.loadLibraries()
+            self.benchImages()
+            self.benchFillRate()
+            self.benchDrawTiles()
+            self.benchTransforms()
+            self.benchMapFiles()
+            self.benchPaint()
+            self.benchRenderServer()
+        finally:
+            self.tearDown()
+        return self.results
+
+    # ------------------------------------------------------------------
+    # Cases
+
+    def benchLibraries(self):
+        for numTiles in self.librarySizes:
+            self.writeLibraries(numTiles)
+            self.measure(
+                "library.load.tiles{}".format(numTiles),
+                lambda: ModelManager.loadModelListFromFile(
+                    ModelManager.TileName, TileModel),
+                self.resetLibraries)
+            self.measure(
+                "library.save.tiles{}".format(numTiles),
+                lambda: (ModelManager.saveModelToFile(ModelManager.TileName),
+                         ModelManager.fetchSaveQueue().waitForIdle()))
+        self.writeLibraries(self.DefaultTiles)
+
+    def benchImages(self):
+        tile = ModelManager.fetchByUid(ModelManager.TileName, 0)
+        group = ModelManager.fetchByUid(ModelManager.GroupName, 0)
+        texture = ModelManager.fetchByUid(ModelManager.TextureName, 0)
+
+        self.measure("genImage.texture",
+                     lambda: EMImageGenerator.genImageFromModel(texture))
+        self.measure("genImage.tile",
+                     lambda: EMImageGenerator.genImageFromModel(tile))
+        self.measure("genImage.group",
+                     lambda: EMImageGenerator.genImageFromModel(group))
+        for size in self.mapSizes:
+            model = self.createMap(size)
+            if size <= self.FullImageCells:
+                self.measure(
+                    "genImage.map{0}x{0}".format(size),
+                    lambda: EMImageGenerator.genImageFromModel(model))
+            else:
+                region = (size // 2, size // 2, size // 2 + self.RenderWindow,
+                          size // 2 + self.RenderWindow)
+                self.measure(
+                    "genImage.map{0}x{0}.region{1}".format(
+                        size, self.RenderWindow),
+                    lambda: EMImageGenerator.genImageFromModel(
+                        model, {"region": region}))
+
+        for size in self.mapSizes:
+            model = self.createMap(size)
+            self.measure(
+                "warmUp.map{0}x{0}".format(size),
+                lambda: list(EMImageGenerator.warmUp(
+                    model, (0, 0, min(size, 32), min(size, 32)))),
+                self.clearRenders)
+
+        color = EMImageGenerator.textureCache.get("Grass")
+        if color is None and EMImageGenerator.loadTexture("Grass"):
+            color = EMImageGenerator.textureCache["Grass"]
+        if color is not None:
+            self.measure("setImageColor",
+                         lambda: EMImageGenerator.setImageColor(
+                             color, QColor(120, 40, 200)))
+
+    def benchFillRate(self):
+        """
+        Fill cells with a texture brush and draw tile rasters onto them, once
+        with straight and once with premultiplied alpha on both ends.
+        """
+        texture = EMImageGenerator.getTextureImage(0)
+        tile = EMImageGenerator.genImageFromModel(
+            ModelManager.fetchByUid(ModelManager.TileName, 0))
+        size = 216 * self.FillCells
+        for (name, imageFormat) in (
+                ("argb32", QImage.Format_ARGB32),
+                ("premultiplied", QImage.Format_ARGB32_Premultiplied)):
+            target = QImage(size, size, imageFormat)
+            brush = QBrush(texture.convertToFormat(imageFormat))
+            raster = tile.convertToFormat(imageFormat)
+
+            def fill():
+                painter = QPainter(target)
+                for y in range(self.FillCells):
+                    for x in range(self.FillCells):
+                        painter.fillRect(216 * x, 216 * y, 216, 216, brush)
+                        painter.drawImage(216 * x, 216 * y, raster)
+                painter.end()
+
+            self.measure("fillRate.{}.cells{}".format(
+                name, self.FillCells ** 2), fill)
+
+    def benchDrawTiles(self):
+        """Draw tiles without rasters, as painting does once the budget is
+        used up, at the zoom levels of the map editor"""
+        tiles = [ModelManager.fetchByUid(ModelManager.TileName, uid)
+                 for uid in range(self.FillCells)]
+        for zoom in self.ZoomLevels:
+            size = 216 * self.FillCells * zoom // 100
+            target = QImage(size, size, QImage.Format_ARGB32_Premultiplied)
+
+            def draw():
+                painter = QPainter(target)
+                painter.scale(zoom / 100, zoom / 100)
+                for y in range(self.FillCells):
+                    for x in range(self.FillCells):
+                        EMImageGenerator.drawTile(
+                            painter, tiles[(x + y) % len(tiles)], x, y)
+                painter.end()
+
+            self.measure("drawTile.zoom{}.cells{}".format(
+                zoom, self.FillCells ** 2), draw)
+
+    def benchTransforms(self):
+        group = ModelManager.fetchByUid(ModelManager.GroupName, 0)
+        options = (1, True, False)
+        self.measure("createModelTransform.group",
+                     lambda: GroupModel.createModelTransform(group, options))
+        for size in self.mapSizes:
+            model = self.createMap(size)
+            self.measure(
+                "createModelTransform.map{0}x{0}".format(size),
+                lambda: GroupModel.createModelTransform(model, options))
+
+    def benchMapFiles(self):
+        saveQueue = ModelManager.fetchSaveQueue()
+        for size in self.mapSizes:
+            model = self.createMap(size)
+            path = os.path.join(self.directory, "map{}.emap".format(size))
+            self.measure(
+                "emap.save.map{0}x{0}".format(size),
+                lambda: (ModelManager.saveMapToFile(model, path),
+                         saveQueue.waitForIdle()))
+            self.measure(
+                "emap.load.map{0}x{0}".format(size),
+                lambda: ModelManager.loadModelFromFile(path, MapModel))
+            self.measure(
+                "emap.loadAll.map{0}x{0}".format(size),
+                lambda: list(ModelManager.loadModelFromFile(
+                    path, MapModel).getTileGrid()))
+
+    def benchPaint(self):
+        width, height = self.Viewport
+        image = QImage(width, height, QImage.Format_ARGB32_Premultiplied)
+        for size in self.mapSizes:
+            model = self.createMap(size)
+            graphics = MapEditorGraphics(model)
+
+            def paintLoop():
+                # scroll diagonally across the map at every zoom level,
+                # rendering the viewport like the scroll area would
+                for zoom in self.ZoomLevels:
+                    graphics.setZoomPercentage(zoom)
+                    maxX = max(0, int(graphics.width) - width)
+                    maxY = max(0, int(graphics.height) - height)
+                    for step in range(self.PaintSteps):
+                        x = maxX * step // max(1, self.PaintSteps - 1)
+                        y = maxY * step // max(1, self.PaintSteps - 1)
+                        graphics.render(image, QPoint(),
+                                        QRegion(x, y, width, height))
+
+            self.measure("paint.mapEditor.map{0}x{0}".format(size),
+                         paintLoop)
+            graphics.deleteLater()
+
+    def benchRenderServer(self):
+        """
+        Serve ServerRequests tile renders to ServerClients concurrent
+        clients: rendered by the workers, from the cache of the service,
+        and revalidated with their ETag. The workers keep their rasters
+        between runs, so renders measure drawing, PNG encoding and the
+        round trip to the worker.
+        """
+        size = self.mapSizes[-1]
+        ModelManager.saveMapToFile(self.createMap(size), os.path.join(
+            self.directory, "map{}.emap".format(size)))
+        ModelManager.fetchSaveQueue().waitForIdle()
+        service = RenderService(self.directory)
+        server = service.createServer(("127.0.0.1", 0))
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        port = server.server_address[1]
+        paths = ["/tile/{}.png".format(uid % self.DefaultTiles)
+                 for uid in range(self.ServerRequests)]
+        etags = {}
+
+        def fetch(paths, revalidate=False):
+            connection = http.client.HTTPConnection("127.0.0.1", port)
+            for path in paths:
+                headers = {"If-None-Match": etags[path]} if revalidate else {}
+                connection.request("GET", path, headers=headers)
+                response = connection.getresponse()
+                response.read()
+                etags[path] = response.getheader("ETag")
+            connection.close()
+
+        def serve(paths, revalidate=False):
+            clients = [threading.Thread(target=fetch, args=(
+                paths[i::self.ServerClients], revalidate))
+                for i in range(self.ServerClients)]
+            for client in clients:
+                client.start()
+            for client in clients:
+                client.join()
+
+        try:
+            name = "renderServer.tiles{}.clients{}".format(
+                self.ServerRequests, self.ServerClients)
+            self.measure(name + ".render", lambda: serve(paths),
+                         RenderService.renders.clear)
+            self.measure(name + ".cached", lambda: serve(paths))
+            self.measure(name + ".revalidate", lambda: serve(paths, True))
+            thumbnail = ["/thumbnail/map/map{}.png?size=512".format(size)]
+            self.measure("renderServer.thumbnail.map{0}x{0}".format(size),
+                         lambda: serve(thumbnail),
+                         RenderService.renders.clear)
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+            service.close()
+
+    # ------------------------------------------------------------------
+    # Reporting
+
+    @classmethod
+    def environment(cls):
+        return {
+            "python": platform.python_version(),
+            "qt": QT_VERSION_STR,
+            "platform": platform.platform(),
+            "cpus": os.cpu_count()
+        }
+
+    @classmethod
+    def compare(cls, results, baseline, threshold):
+        """Return the cases whose median is more than threshold slower"""
+        regressions = {}
+        for name, result in results.items():
+            if name not in baseline:
+                continue
+            before = baseline[name]["median"]
+            ratio = result["median"] / before if before > 0 else 1
+            if ratio > 1 + threshold:
+                regressions[name] = {
+                    "baseline": before,
+                    "current": result["median"],
+                    "ratio": ratio
+                }
+        return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark Encounter Mapper offscreen")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="runs per case (default 3)")
+    parser.add_argument("--quick", action="store_true",
+                        help="only run the smaller scales")
+    parser.add_argument("--output", help="write the results to this file")
+    parser.add_argument("--baseline",
+                        help="compare against the results in this file")
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="write the results to the baseline file")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="slowdown reported as a regression (0.25)")
+    args = parser.parse_args(argv)
+
+    app = QApplication.instance() or QApplication([])  # noqa: F841
+    benchmark = Benchmark(args.repeat, args.quick)
+    results = benchmark.run()
+    report = {"environment": Benchmark.environment(), "results": results,
+              "caches": CacheManager.stats()}
+
+    regressions = {}
+    if args.baseline and not args.save_baseline:
+        if os.path.exists(args.baseline):
+            f = open(args.baseline, "r")
+            baseline = json.loads(f.read())["results"]
+            f.close()
+            regressions = Benchmark.compare(results, baseline,
+                                            args.threshold)
+            report["regressions"] = regressions
+            for name, r in sorted(regressions.items()):
+                print("REGRESSION: {} {:.2f} ms -> {:.2f} ms ({:.2f}x)".format(
+                    name, r["baseline"], r["current"], r["ratio"]),
+                    file=sys.stderr)
+        else:
+            print("WARNING: baseline {} does not exist".format(
+                args.baseline), file=sys.stderr)
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.save_baseline:
+        if not args.baseline:
+            parser.error("--save-baseline needs --baseline")
+        f = open(args.baseline, "w")
+        f.write(output)
+        f.close()
+    if args.output:
+        f = open(args.output, "w")
+        f.write(output)
+        f.close()
+    elif not args.save_baseline:
+        print(output)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
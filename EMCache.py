@@ -0,0 +1,228 @@
+"""
+Encounter Mapper is a tile-based encounter map creator for tabletop RPGs.
+Copyright 2019, 2020 Eric Symmank
+
+This file is part of Encounter Mapper.
+
+Encounter Mapper is free software: you can redistribute it
+and/or modify it under the terms of the GNU General Public License as
+published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+
+Encounter Mapper is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Encounter Mapper.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import os
+import threading
+from collections import OrderedDict
+
+
+class ImageCache():
+    """
+    One named cache of images, registered with the CacheManager.
+
+    It is used like a dict, but every image stored counts towards the
+    budget of the CacheManager, which may evict it again at any time.
+    get() and fetching with [] count as hits or misses, while checking with
+    'in' does not.
+    """
+
+    def __init__(self, name, sizeOf):
+        self.name = name
+        self.sizeOf = sizeOf
+        self.entries = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with CacheManager.lock:
+            if key in self.entries:
+                self.hits += 1
+                CacheManager.touch(self, key)
+                return self.entries[key]
+            self.misses += 1
+            return default
+
+    def __getitem__(self, key):
+        value = self.get(key, self)
+        if value is self:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        CacheManager.store(self, key, value)
+
+    def setdefault(self, key, value):
+        with CacheManager.lock:
+            if key in self.entries:
+                return self.entries[key]
+            CacheManager.store(self, key, value)
+            return value
+
+    def pop(self, key, default=None):
+        with CacheManager.lock:
+            if key not in self.entries:
+                return default
+            value = self.entries[key]
+            CacheManager.remove(self, key)
+            return value
+
+    def __delitem__(self, key):
+        if self.pop(key, self) is self:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        # a copy, so entries can be removed while iterating
+        with CacheManager.lock:
+            return iter(list(self.entries))
+
+    def keys(self):
+        return list(self)
+
+    def clear(self):
+        with CacheManager.lock:
+            for key in list(self.entries):
+                CacheManager.remove(self, key)
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
+
+
+class CacheManager():
+    """
+    Keeps every image cache of the program within one memory budget.
+
+    Caches are registered by name (textures, tile rasters, thumbnails, ...)
+    and share a single least recently used order, so whichever images have
+    gone unused the longest are evicted first, no matter which cache they
+    belong to. The budget is in bytes and defaults to DefaultBudget, or can
+    be set with the EM_CACHE_BUDGET environment variable, e.g. "268435456",
+    "256M" or "1G".
+
+    shrink() evicts down to part of the budget, e.g. when the window is
+    minimized or a map is closed. stats() returns the size, hits, misses
+    and evictions of every cache.
+    """
+
+    EnvVar = "EM_CACHE_BUDGET"
+    DefaultBudget = 256 * 1024 * 1024
+    Units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+    caches = {}
+    # (cache, key) -> size in bytes, least recently used first
+    order = OrderedDict()
+    bytes = 0
+    lock = threading.RLock()
+
+    @classmethod
+    def parseBudget(cls, value):
+        if not value:
+            return cls.DefaultBudget
+        value = value.strip().upper().rstrip("B")
+        try:
+            if value[-1:] in cls.Units:
+                return int(float(value[:-1]) * cls.Units[value[-1]])
+            return int(value)
+        except ValueError:
+            print("WARNING: {} is not a valid cache budget".format(value))
+            return cls.DefaultBudget
+
+    @classmethod
+    def imageBytes(cls, image):
+        return 0 if image is None else image.sizeInBytes()
+
+    @classmethod
+    def register(cls, name, sizeOf=None):
+        """
+        Create the cache called name. sizeOf returns the bytes used by a
+        value, and defaults to treating values as QImages.
+        """
+        cache = ImageCache(name, cls.imageBytes if sizeOf is None else sizeOf)
+        cls.caches[name] = cache
+        return cache
+
+    @classmethod
+    def fetchCache(cls, name):
+        return cls.caches.get(name)
+
+    @classmethod
+    def touch(cls, cache, key):
+        cls.order.move_to_end((cache.name, key))
+
+    @classmethod
+    def store(cls, cache, key, value):
+        size = cache.sizeOf(value)
+        with cls.lock:
+            if key in cache.entries:
+                cls.remove(cache, key)
+            cache.entries[key] = value
+            cache.bytes += size
+            cls.order[(cache.name, key)] = size
+            cls.bytes += size
+            # never evict the value that was just stored
+            cls.evict(cls.budget, 1)
+
+    @classmethod
+    def remove(cls, cache, key):
+        with cls.lock:
+            size = cls.order.pop((cache.name, key), 0)
+            del cache.entries[key]
+            cache.bytes -= size
+            cls.bytes -= size
+
+    @classmethod
+    def evict(cls, target, keep=0):
+        """Evict least recently used images until at most target bytes"""
+        with cls.lock:
+            while cls.bytes > target and len(cls.order) > keep:
+                (name, key) = next(iter(cls.order))
+                cache = cls.caches[name]
+                cls.remove(cache, key)
+                cache.evictions += 1
+
+    @classmethod
+    def hasRoom(cls, size):
+        """Check whether size more bytes fit without evicting anything"""
+        return cls.bytes + size <= cls.budget
+
+    @classmethod
+    def setBudget(cls, budget):
+        cls.budget = budget
+        cls.evict(budget)
+
+    @classmethod
+    def shrink(cls, fraction=0.5):
+        """Evict until the caches use at most fraction of the budget"""
+        cls.evict(int(cls.budget * fraction))
+
+    @classmethod
+    def stats(cls):
+        stats = {name: cache.stats() for (name, cache) in cls.caches.items()}
+        stats["total"] = {"bytes": cls.bytes, "budget": cls.budget}
+        return stats
+
+
+CacheManager.budget = CacheManager.parseBudget(
+    os.environ.get(CacheManager.EnvVar))
@@ -0,0 +1,581 @@
+"""
+Encounter Mapper is a tile-based encounter map creator for tabletop RPGs.
+Copyright 2019, 2020 Eric Symmank
+
+This file is part of Encounter Mapper.
+
+Encounter Mapper is free software: you can redistribute it
+and/or modify it under the terms of the GNU General Public License as
+published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+
+Encounter Mapper is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Encounter Mapper.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import base64
+import html
+import json
+import math
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from PyQt5.QtCore import (Qt, QBuffer, QByteArray, QIODevice, QMarginsF,
+                          QSizeF)
+from PyQt5.QtGui import QImage, QPageSize, QPainter, QPdfWriter
+
+from EMHelper import ModelManager, EMImageGenerator
+from EMModel import TileModel, MapModel, TextureModelLoader
+from EMMetrics import Metrics
+from EMCache import CacheManager
+
+
+class VectorExporter():
+    """
+    Exports maps as SVG or PDF, which stay sharp at any print resolution.
+
+    In the SVG every texture is embedded once as a pattern and every
+    distinct placement of a tile once as a definition built from the shape
+    polygons of its TileModel; the cells themselves are only references to
+    those. Textures span TextureSpan x TextureSpan cells, so like the tile
+    rasters of EMImageGenerator a placement is the tile uid, orientation,
+    flips and texture phase of the cell. The size of the file depends on
+    the tiles and textures used rather than on the size of the map.
+
+    The PDF is drawn with the same painting code as the editor on a
+    QPdfWriter, at 72 points per inch, so a tile is 3 in. like in the PNG
+    export. Shapes stay vector, and Qt embeds every texture image once.
+
+    Both draw the map notes on top as the numbered badges of the editor.
+    In the SVG the number is text, and the name and description of a note
+    are the title of its badge.
+    """
+
+    TileSize = 216
+    TextureSize = 648
+    TextureSpan = 3
+    JPEGQuality = 90
+    GridColor = "#000000"
+    NoteSize = 48
+
+    @classmethod
+    def exportMap(cls, model, path, drawGrid=True):
+        """Write model to path, as PDF if it ends in .pdf, else as SVG"""
+        ModelManager.loadModelListFromFile(ModelManager.TextureName,
+                                           TextureModelLoader)
+        ModelManager.loadModelListFromFile(ModelManager.TileName, TileModel)
+        if os.path.splitext(path)[1].lower() == ".pdf":
+            cls.writePDF(model, path, drawGrid)
+        else:
+            cls.writeSVG(model, path, drawGrid)
+
+    @classmethod
+    @Metrics.timed("VectorExporter.writeSVG")
+    def writeSVG(cls, model, path, drawGrid=True):
+        ModelManager.writeFileAtomic(
+            path, cls.svgDocument(model, drawGrid).encode("utf-8"))
+
+    @classmethod
+    def svgDocument(cls, model, drawGrid=True):
+        res = cls.TileSize
+        width = res * model.getNumCols()
+        height = res * model.getNumRows()
+        tiles = {}
+        placements = {}
+        cells = []
+        grid = model.getTileGrid()
+        for y in range(model.getNumRows()):
+            for x in range(model.getNumCols()):
+                tile = grid[y][x]
+                if tile[0] == -1:
+                    cells.append(("empty", x, y))
+                    continue
+                if tile[0] not in tiles:
+                    tiles[tile[0]] = ModelManager.fetchByUid(
+                        ModelManager.TileName, tile[0])
+                if tiles[tile[0]] is None:
+                    continue
+                key = (tile[0], tile[1], bool(tile[2]), bool(tile[3]),
+                       x % cls.TextureSpan, y % cls.TextureSpan)
+                if key not in placements:
+                    placements[key] = "tile{}_{}{:d}{:d}_{}{}".format(*key)
+                cells.append((placements[key], x, y))
+
+        textures = set()
+        for key in placements:
+            tileModel = tiles[key[0]]
+            textures.add(tileModel.getBgTexture())
+            textures.update(shape[0] for shape in tileModel.getShapes())
+
+        lines = [
+            '<?xml version="1.0" encoding="UTF-8"?>',
+            '<svg xmlns="http://www.w3.org/2000/svg" '
+            'xmlns:xlink="http://www.w3.org/1999/xlink" version="1.1" '
+            'width="{0}" height="{1}" viewBox="0 0 {0} {1}">'.format(
+                width, height),
+            '<defs>',
+            '<g id="empty"><rect width="{0}" height="{0}" fill="#ffffff" '
+            'stroke="#000000"/></g>'.format(res)]
+        for uid in sorted(textures):
+            lines.append(cls.svgPattern(uid))
+        for key, name in placements.items():
+            lines.append(cls.svgPlacement(tiles[key[0]], key, name))
+        notes = model.getMapNotes()
+        lines.extend(cls.svgNoteBadges(notes))
+        lines.append('</defs>')
+        for (name, x, y) in cells:
+            lines.append('<use xlink:href="#{}" x="{}" y="{}"/>'.format(
+                name, res * x, res * y))
+        if drawGrid:
+            lines.extend(cls.svgGrid(model.getNumCols(), model.getNumRows()))
+        lines.extend(cls.svgNotes(notes))
+        lines.append('</svg>')
+        return "\n".join(lines)
+
+    @classmethod
+    def svgPattern(cls, txtUid):
+        if ModelManager.fetchByUid(ModelManager.TextureName, txtUid) is None:
+            return ('<pattern id="texture{0}" width="1" height="1">'
+                    '<rect width="1" height="1" fill="#808080"/>'
+                    '</pattern>').format(txtUid)
+        img = EMImageGenerator.getTextureImage(txtUid)
+        return ('<pattern id="texture{0}" patternUnits="userSpaceOnUse" '
+                'width="{1}" height="{1}"><image width="{1}" height="{1}" '
+                'xlink:href="{2}"/></pattern>').format(
+                    txtUid, cls.TextureSize, cls.dataUri(img))
+
+    @classmethod
+    def dataUri(cls, img):
+        """Encode img as a data URI, as JPEG if it is opaque"""
+        data = QByteArray()
+        buffer = QBuffer(data)
+        buffer.open(QIODevice.WriteOnly)
+        if img.hasAlphaChannel():
+            img.convertToFormat(QImage.Format_ARGB32).save(buffer, "PNG")
+            mimeType = "image/png"
+        else:
+            img.save(buffer, "JPEG", cls.JPEGQuality)
+            mimeType = "image/jpeg"
+        buffer.close()
+        return "data:{};base64,{}".format(
+            mimeType, base64.b64encode(bytes(data)).decode("ascii"))
+
+    @classmethod
+    def svgPlacement(cls, tileModel, key, name):
+        # drawn where the phase puts it and moved back to the origin, so
+        # the patterns line up with the neighbouring cells
+        res = cls.TileSize
+        scale = res / 100
+        offsetX = res * key[4]
+        offsetY = res * key[5]
+        parts = ['<g id="{}"><g transform="translate({} {})">'.format(
+            name, -offsetX, -offsetY),
+            '<rect x="{0}" y="{1}" width="{2}" height="{2}" '
+            'fill="url(#texture{3})"/>'.format(
+                offsetX, offsetY, res, tileModel.getBgTexture())]
+        polygons = tileModel.fetchShapePolygons(key[1], key[2], key[3])
+        for (shape, polygon) in zip(tileModel.getShapes(), polygons):
+            points = " ".join(
+                "{:g},{:g}".format(round(offsetX + p.x() * scale, 2),
+                                   round(offsetY + p.y() * scale, 2))
+                for p in polygon)
+            parts.append('<polygon points="{}" fill="url(#texture{})"/>'
+                         .format(points, shape[0]))
+        parts.append('</g></g>')
+        return "".join(parts)
+
+    @classmethod
+    def svgGrid(cls, nc, nr):
+        """Grid lines matching EMImageGenerator.GridPatternExport"""
+        res = cls.TileSize
+        pattern = EMImageGenerator.GridPatternExport
+        linesPerTile = 3
+        paths = {}
+        for x in range(linesPerTile * nc + 1):
+            xd = int(x * res / linesPerTile)
+            paths.setdefault(pattern[x % len(pattern)], []).append(
+                "M{} 0V{}".format(xd, res * nr))
+        for y in range(linesPerTile * nr + 1):
+            yd = int(y * res / linesPerTile)
+            paths.setdefault(pattern[y % len(pattern)], []).append(
+                "M0 {}H{}".format(yd, res * nc))
+        return ['<path d="{}" stroke="{}" stroke-width="{}" fill="none"/>'
+                .format("".join(d), cls.GridColor, width)
+                for (width, d) in sorted(paths.items())]
+
+    @classmethod
+    def svgNoteBadges(cls, notes):
+        """The badge of every type of note used, embedded once"""
+        if EMImageGenerator.badgeIcons is None:
+            EMImageGenerator.loadNoteImages()
+        return ['<image id="note{0}" width="{1}" height="{1}" '
+                'xlink:href="{2}"/>'.format(
+                    noteType, cls.NoteSize, cls.dataUri(
+                        EMImageGenerator.badgeIcons[noteType].toImage()))
+                for noteType in sorted(set(note.getType() for note in notes))]
+
+    @classmethod
+    def svgNotes(cls, notes):
+        half = cls.NoteSize // 2
+        lines = []
+        for index, note in enumerate(notes):
+            x, y = note.getPos(cls.TileSize)
+            title = note.getName()
+            if note.getDesc():
+                title += "\n" + note.getDesc()
+            lines.append(
+                '<g><title>{}</title><use xlink:href="#note{}" x="{:g}" '
+                'y="{:g}"/><text x="{:g}" y="{:g}" text-anchor="middle" '
+                'font-family="sans-serif" font-weight="bold" '
+                'font-size="20" fill="#ffffff">{}</text></g>'.format(
+                    html.escape(title), note.getType(), x - half, y - half,
+                    x, y + 7, index + 1))
+        return lines
+
+    @classmethod
+    @Metrics.timed("VectorExporter.writePDF")
+    def writePDF(cls, model, path, drawGrid=True):
+        res = cls.TileSize
+        writer = QPdfWriter(path)
+        writer.setResolution(72)
+        writer.setPageSize(QPageSize(
+            QSizeF(res * model.getNumCols(), res * model.getNumRows()),
+            QPageSize.Point))
+        writer.setPageMargins(QMarginsF(0, 0, 0, 0))
+        painter = QPainter(writer)
+        grid = model.getTileGrid()
+        tiles = {}
+        for y in range(model.getNumRows()):
+            for x in range(model.getNumCols()):
+                tile = grid[y][x]
+                if tile[0] == -1:
+                    EMImageGenerator.drawEmptyTile(painter, x, y)
+                    continue
+                if tile[0] not in tiles:
+                    tiles[tile[0]] = ModelManager.fetchByUid(
+                        ModelManager.TileName, tile[0])
+                if tiles[tile[0]] is not None:
+                    EMImageGenerator.drawTile(painter, tiles[tile[0]], x, y,
+                                              (tile[1], tile[2], tile[3]))
+        if drawGrid:
+            EMImageGenerator.drawGrid(
+                painter, model.getNumCols(), model.getNumRows(), 0, 0, res,
+                None, EMImageGenerator.GridPatternExport)
+        half = cls.NoteSize // 2
+        for index, note in enumerate(model.getMapNotes()):
+            x, y = note.getPos(res)
+            EMImageGenerator.drawNoteIcon(
+                painter, note, int(x) - half, int(y) - half, cls.NoteSize,
+                index + 1)
+        painter.end()
+
+
+class AtlasExporter():
+    """
+    Exports a map for virtual tabletops as a tile atlas plus a manifest.
+
+    Every distinct placement of a tile is rendered once into the atlas, a
+    PNG with AtlasColumns x AtlasColumns cells of TileSize pixels. Like the
+    tile rasters of EMImageGenerator, a placement is the tile uid, its
+    orientation and flips, and the texture phase (x % 3, y % 3) of the cell,
+    so textures still line up once the map is put back together. Larger maps
+    are spread over several atlas pages. The time and size of the export
+    depend on the tiles used rather than on the size of the map.
+
+    The manifest, written as JSON next to the atlas pages, holds:
+
+    tileSize        pixels per cell
+    columns, rows   size of the grid
+    atlases         file names of the atlas pages
+    atlasColumns    cells per row and column of a page
+    tiles           [uid, orientation, hflip, vflip, phaseX, phaseY] of the
+                    n-th atlas cell. Cell n is on page n // atlasColumns**2,
+                    at position n % atlasColumns**2 in row-major order.
+    grid            for every row, the atlas cell of every column, -1 for
+                    empty cells
+    notes           the map notes, as saved in map files
+    """
+
+    Version = 1
+    TileSize = 216
+    TextureSpan = 3
+    AtlasColumns = 16
+    AtlasName = "{}_atlas{}"
+
+    @classmethod
+    @Metrics.timed("AtlasExporter.exportMap")
+    def exportMap(cls, model, path):
+        """Write the manifest to path and the atlas pages next to it"""
+        ModelManager.loadModelListFromFile(ModelManager.TextureName,
+                                           TextureModelLoader)
+        ModelManager.loadModelListFromFile(ModelManager.TileName, TileModel)
+        tiles = {}
+        for uid in model.getTilesToFetch():
+            tileModel = ModelManager.fetchByUid(ModelManager.TileName, uid)
+            if tileModel is not None:
+                tiles[uid] = tileModel
+
+        placements = {}
+        grid = []
+        for (y, row) in enumerate(model.getTileGrid()):
+            indices = []
+            for (x, tile) in enumerate(row):
+                if tile[0] not in tiles:
+                    indices.append(-1)
+                    continue
+                key = (tile[0], tile[1], bool(tile[2]), bool(tile[3]),
+                       x % cls.TextureSpan, y % cls.TextureSpan)
+                if key not in placements:
+                    placements[key] = len(placements)
+                indices.append(placements[key])
+            grid.append(indices)
+
+        base = os.path.splitext(path)[0]
+        atlases = cls.writeAtlases(tiles, list(placements), base)
+        manifest = {
+            "version": cls.Version,
+            "name": model.getName(),
+            "tileSize": cls.TileSize,
+            "columns": model.getNumCols(),
+            "rows": model.getNumRows(),
+            "atlases": [os.path.basename(atlas) for atlas in atlases],
+            "atlasColumns": cls.AtlasColumns,
+            "tiles": [list(key) for key in placements],
+            "grid": grid,
+            "notes": [note.jsonObj() for note in model.getMapNotes()]
+        }
+        ModelManager.writeFileAtomic(
+            path, json.dumps(manifest, separators=(",", ":")).encode("utf-8"))
+        return manifest
+
+    @classmethod
+    def writeAtlases(cls, tiles, keys, base):
+        """Render the placements in keys into atlas pages, one at a time"""
+        res = cls.TileSize
+        perPage = cls.AtlasColumns ** 2
+        paths = []
+        for page in range(math.ceil(len(keys) / perPage)):
+            pageKeys = keys[page * perPage:(page + 1) * perPage]
+            columns = min(len(pageKeys), cls.AtlasColumns)
+            rows = math.ceil(len(pageKeys) / cls.AtlasColumns)
+            atlas = QImage(res * columns, res * rows,
+                           EMImageGenerator.RenderFormat)
+            atlas.fill(0)
+            painter = QPainter(atlas)
+            for (i, key) in enumerate(pageKeys):
+                tile = (key[0], key[1], key[2], key[3])
+                tileModel = tiles[key[0]]
+                img = EMImageGenerator.fetchTileImage(tileModel, tile,
+                                                      key[4], key[5])
+                if img is None:
+                    img = EMImageGenerator.renderTileImage(
+                        tileModel, EMImageGenerator.tileImageKey(
+                            tileModel, tile, key[4], key[5]))
+                painter.drawImage(res * (i % cls.AtlasColumns),
+                                  res * (i // cls.AtlasColumns), img)
+            painter.end()
+            atlasPath = cls.AtlasName.format(base, page)
+            ModelManager.saveImageToFile(atlas, atlasPath)
+            paths.append(atlasPath + ".png")
+        return paths
+
+
+class DeepZoomExporter():
+    """
+    Exports a map as a Deep Zoom (DZI) image pyramid for browser viewers.
+
+    Level n of the pyramid is the map scaled to fit 2**n pixels, down to a
+    single pixel at level 0, cut into TileSize pixel JPEG tiles without
+    overlap. Next to the .dzi descriptor they are laid out as viewers
+    expect them:
+
+    <name>.dzi
+    <name>_files/<level>/<column>_<row>.jpg
+
+    The full resolution level is rendered in chunks of ChunkTiles x
+    ChunkTiles tiles by a pool of worker processes, each holding its own
+    copy of the map and libraries, so only a few chunks are in memory at a
+    time. Every other level is then built by the workers from the four
+    tiles below each of its tiles.
+    """
+
+    TileSize = 256
+    CellSize = 216
+    ChunkTiles = 8
+    # maps are opaque, and JPEG tiles encode many times faster than PNG
+    Format = "jpg"
+    Quality = 90
+    TileName = "{}_{}"
+
+    Descriptor = """<?xml version="1.0" encoding="UTF-8"?>
+<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" Format="{}" \
+Overlap="0" TileSize="{}">
+  <Size Width="{}" Height="{}"/>
+</Image>
+"""
+
+    # the map rendered by this process, when it is a worker
+    workerModel = None
+
+    @classmethod
+    def maxLevel(cls, width, height):
+        return max(0, math.ceil(math.log2(max(width, height))))
+
+    @classmethod
+    def levelSize(cls, width, height, level, maxLevel):
+        scale = 2 ** (maxLevel - level)
+        return (math.ceil(width / scale), math.ceil(height / scale))
+
+    @classmethod
+    def tilePath(cls, filesDirectory, level, column, row):
+        """Path of a tile without the extension"""
+        return os.path.join(filesDirectory, str(level),
+                            cls.TileName.format(column, row))
+
+    @classmethod
+    def saveTile(cls, img, path):
+        img.convertToFormat(QImage.Format_RGB32).save(
+            path + "." + cls.Format, None, cls.Quality)
+
+    @classmethod
+    def exportMap(cls, model, path, drawGrid=True, workers=None):
+        """
+        Write the pyramid of model, with the descriptor at path.
+
+        This is a generator, yielding (done, total) every time a chunk or a
+        row of tiles has been written so the caller can show progress.
+        """
+        res = cls.CellSize
+        width = res * model.getNumCols()
+        height = res * model.getNumRows()
+        maxLevel = cls.maxLevel(width, height)
+        filesDirectory = os.path.splitext(path)[0] + "_files"
+        for level in range(maxLevel + 1):
+            os.makedirs(os.path.join(filesDirectory, str(level)),
+                        exist_ok=True)
+
+        chunk = cls.TileSize * cls.ChunkTiles
+        chunks = [(x, y) for y in range(math.ceil(height / chunk))
+                  for x in range(math.ceil(width / chunk))]
+        rows = [math.ceil(cls.levelSize(width, height, level, maxLevel)[1]
+                          / cls.TileSize) for level in range(maxLevel)]
+        total = len(chunks) + sum(rows)
+        done = 0
+        yield (done, total)
+
+        workers = workers or max(1, min(os.cpu_count() or 1, len(chunks)))
+        # spawned rather than forked, a copy of a running Qt application is
+        # not safe to use
+        executor = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=cls.initWorker,
+            initargs=(cls.libraryDirectory(), model.jsonObj(),
+                      CacheManager.budget // workers))
+        with executor:
+            futures = [executor.submit(cls.renderChunk, filesDirectory,
+                                       maxLevel, x, y, drawGrid)
+                       for (x, y) in chunks]
+            for future in as_completed(futures):
+                future.result()
+                done += 1
+                yield (done, total)
+            for level in range(maxLevel - 1, -1, -1):
+                # every level needs the one below it to be complete
+                futures = [executor.submit(cls.mergeRow, filesDirectory,
+                                           width, height, level, maxLevel,
+                                           row)
+                           for row in range(rows[level])]
+                for future in as_completed(futures):
+                    future.result()
+                    done += 1
+                    yield (done, total)
+
+        ModelManager.writeFileAtomic(path, cls.Descriptor.format(
+            cls.Format, cls.TileSize, width, height).encode("utf-8"))
+
+    @classmethod
+    def libraryDirectory(cls):
+        """Directory the libraries of this process are read from"""
+        return os.path.dirname(ModelManager.resourcePath(
+            ModelManager.TextureName + ModelManager.ConfigExt))
+
+    @classmethod
+    def initWorker(cls, directory, mapJS, budget):
+        os.chdir(directory)
+        CacheManager.setBudget(budget)
+        ModelManager.loadModelListFromFile(ModelManager.TextureName,
+                                           TextureModelLoader)
+        ModelManager.loadModelListFromFile(ModelManager.TileName, TileModel)
+        cls.workerModel = MapModel.createModelJS(mapJS)
+
+    @classmethod
+    @Metrics.timed("DeepZoomExporter.renderChunk")
+    def renderChunk(cls, filesDirectory, maxLevel, chunkX, chunkY,
+                    drawGrid=True):
+        """Render a chunk of the full resolution level and cut it up"""
+        model = cls.workerModel
+        res = cls.CellSize
+        size = cls.TileSize
+        chunk = size * cls.ChunkTiles
+        width = res * model.getNumCols()
+        height = res * model.getNumRows()
+        x0 = chunk * chunkX
+        y0 = chunk * chunkY
+        w = min(chunk, width - x0)
+        h = min(chunk, height - y0)
+        region = (x0 // res, y0 // res, math.ceil((x0 + w) / res),
+                  math.ceil((y0 + h) / res))
+
+        img = QImage(w, h, EMImageGenerator.RenderFormat)
+        img.fill(Qt.white)
+        painter = QPainter(img)
+        painter.translate(-x0, -y0)
+        EMImageGenerator.drawTileGroup(painter, model, region)
+        if drawGrid:
+            EMImageGenerator.drawGrid(
+                painter, model.getNumCols(), model.getNumRows(), 0, 0, res,
+                None, EMImageGenerator.GridPatternExport)
+        painter.end()
+
+        for y in range(0, h, size):
+            for x in range(0, w, size):
+                cls.saveTile(
+                    img.copy(x, y, min(size, w - x), min(size, h - y)),
+                    cls.tilePath(filesDirectory, maxLevel,
+                                 (x0 + x) // size, (y0 + y) // size))
+
+    @classmethod
+    def mergeRow(cls, filesDirectory, width, height, level, maxLevel, row):
+        """Build a row of level from the tiles of the level below"""
+        size = cls.TileSize
+        levelWidth, levelHeight = cls.levelSize(width, height, level,
+                                                maxLevel)
+        belowWidth, belowHeight = cls.levelSize(width, height, level + 1,
+                                                maxLevel)
+        for column in range(math.ceil(levelWidth / size)):
+            w = min(size, levelWidth - column * size)
+            h = min(size, levelHeight - row * size)
+            merged = QImage(min(2 * size, belowWidth - 2 * size * column),
+                            min(2 * size, belowHeight - 2 * size * row),
+                            EMImageGenerator.RenderFormat)
+            merged.fill(Qt.white)
+            painter = QPainter(merged)
+            for (dx, dy) in ((0, 0), (1, 0), (0, 1), (1, 1)):
+                path = cls.tilePath(filesDirectory, level + 1,
+                                    2 * column + dx, 2 * row + dy)
+                child = QImage(path + "." + cls.Format)
+                if not child.isNull():
+                    painter.drawImage(size * dx, size * dy, child)
+            painter.end()
+            cls.saveTile(
+                merged.scaled(w, h, Qt.IgnoreAspectRatio,
+                              Qt.SmoothTransformation),
+                cls.tilePath(filesDirectory, level, column, row))
@@ -28,6 +28,7 @@ from PyQt5.QtWidgets import (QApplication, QGridLayout, QHBoxLayout,  QLabel,
 from EMModel import GroupModel, TileModel
 from EMTileEditor import TileEditor, TilePreviewWidget
 from EMHelper import ModelManager, EMImageGenerator
+from EMMetrics import Metrics
 from EMBaseClasses import EMModelEditor, EMModelGraphics, EMModelPicker
 
 
@@ -208,13 +209,18 @@ class GroupPreview(EMModelGraphics):
             self.modelList[id] = None
             self.repaint()
 
+    @Metrics.timed("GroupPreview.paintEvent")
     def paintEvent(self, paintEvent):
         painter = QPainter(self)
         if(self.model is not None):
             nr = self.model.getNumRows()
             nc = self.model.getNumCols()
 
-            img = EMImageGenerator.genImageFromModel(self.model)
+            if self.preview:
+                img = EMImageGenerator.fetchModelImage(
+                    ModelManager.GroupName, self.model)
+            else:
+                img = EMImageGenerator.genImageFromModel(self.model)
             painter.drawImage(0, 0, img.scaled(self.width, self.height))
             if self.preview:
                 EMImageGenerator.drawGrid(
@@ -281,7 +287,6 @@ class GroupPreview(EMModelGraphics):
                     self.model.setTileForIndex(
                         self.mouseIndex[0], self.mouseIndex[1],
                         tileOptions)
-                    print(tileOptions)
                 self.repaint()
 
     def mouseReleaseEvent(self, QMouseEvent):
@@ -19,15 +19,22 @@ along with Encounter Mapper.
 If not, see <https://www.gnu.org/licenses/>.
 """
 
-from PyQt5.QtGui import (QPolygon, QImage, QPainter, QTransform, QPen, QPixmap,
+from PyQt5.QtGui import (QImage, QPainter, QTransform, QPen, QPixmap,
                          QBrush, QColor)
 import sys
 import os
 import json
+import tempfile
+import hashlib
+import math
 import numpy
-from PyQt5.QtCore import Qt
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from PyQt5.QtCore import Qt, QObject, pyqtSignal
 from EMModel import (TileModel, GroupModel, MapModel, TextureModelLoader,
-                     GeneratedTextureModel, ImageTextureModel)
+                     TextureModel, GeneratedTextureModel, ImageTextureModel)
+from EMMapFile import MapFileFormat
+from EMMetrics import Metrics
+from EMCache import CacheManager
 
 
 class ModelManager():
@@ -40,10 +47,33 @@ class ModelManager():
     done so through fetchByUid(). Future implementations will allow for basic
     search functionality via model name and tags.
 
+    Fetched models are shared, versioned snapshots and must be treated as
+    read-only. Anything that intends to modify a model should request its
+    own copy through fetchEditableCopy(), then hand the finished copy back
+    through updateModel(), which swaps it in as the next snapshot rather
+    than changing the one that readers may still be holding.
+
     Calling saveModelToFile() will save the mentioned list of models. This
     should be done whenever a model is updated. For models that are not meant
     to be internal resources (ex. maps) they should be saved instead via
-    saveJSONToFile() and loaded through loadModelFromFile()
+    saveJSONToFile() or saveMapToFile() and loaded through loadModelFromFile(),
+    which reads both the JSON and the binary map formats.
+
+    Saving never writes on the calling thread. The data is captured there,
+    then serialized and written by the SaveQueue from fetchSaveQueue(), one
+    save at a time and in the order they were requested.
+
+    Libraries can also be read ahead of time with fetchLibraryLoader(). The
+    files are read and decoded on a background thread, and the models are
+    created on the UI thread once the data is ready, or as soon as
+    loadModelListFromFile() asks for them, whichever comes first.
+
+    ModelManager also keeps an index of which models reference which: groups
+    reference their tiles, and tiles their background and shape textures.
+    The index is kept up to date as models are loaded, added, updated and
+    deleted, and maps open in an editor should be registered through
+    registerMap(). fetchReferences() lists what would break if a model was
+    deleted, and fetchDependents() everything whose look depends on it.
     """
 
     TileName = "Tile"
@@ -51,6 +81,7 @@ class ModelManager():
     TextureName = "Texture"
     GSTextureName = "TxtImage"
     PaletteName = "Palette"
+    MapName = "Map"
 
     TextureNames = ("None", "Tile", "Checkerboard", "Grass", "Wood",
                     "Cobblestone", "Water", "Lava_1", "Lava_2", "Gradient")
@@ -63,10 +94,22 @@ class ModelManager():
     ClassRef = "ClassRef"
 
     ConfigExt = ".json"
-    MapExt = ".emmap"
+    MapExt = ".emap"
 
     loadedModels = {}
 
+    # (name, uid) -> set of the (name, uid) of the models referencing it
+    references = {}
+    # (name, uid) -> frozenset of the (name, uid) that the model references
+    dependencies = {}
+    openMaps = []
+
+    saveQueue = None
+    libraryLoader = None
+    textureImporter = None
+    modelEvents = None
+    pendingLoads = {}
+
     paletteModels = None
 
     tileModels = None
@@ -82,72 +125,157 @@ class ModelManager():
     groupModelNextUID = 0
 
     @classmethod
+    @Metrics.timed("ModelManager.loadModelListFromFile")
     def loadModelListFromFile(cls, name, classType, ext=".json"):
         if name not in cls.loadedModels:
-            # fetch data according to filename
-            filePath = cls.resourcePath(name+ext)
+            if name in cls.pendingLoads:
+                # already being read in the background, so only wait for
+                # whatever is left of it
+                jsContents = cls.pendingLoads.pop(name).result()
+            else:
+                jsContents = cls.readModelList(name, ext)
+            if jsContents is None:
+                return
+
             modelList = []
-            f = open(filePath, "r")
-            if f.mode == "r":
-                contents = f.read()
-                print(contents)
-                jsContents = json.loads(contents)
-                f.close()
-
-                for modeljs in jsContents:
-                    modelList.append(classType.createModelJS(modeljs))
-                modelDict = {
-                    cls.List: modelList,
-                    cls.ByUid: {},
-                    cls.ByName: {},
-                    cls.ByTag: {},
-                    cls.NextUid: 0,
-                    cls.ClassRef: classType
-                }
-
-                cls.loadedModels[name] = modelDict
-                cls.createCache(name)
+            for modeljs in jsContents:
+                modelList.append(classType.createModelJS(modeljs))
+            modelDict = {
+                cls.List: modelList,
+                cls.ByUid: {},
+                cls.ByName: {},
+                cls.ByTag: {},
+                cls.NextUid: 0,
+                cls.ClassRef: classType
+            }
+
+            cls.loadedModels[name] = modelDict
+            cls.createCache(name)
+            for model in modelList:
+                cls.indexModel(name, model)
 
     @classmethod
-    def loadModelFromFile(cls, path, classType):
-        f = open(path, "r")
+    def readModelList(cls, name, ext=".json"):
+        """Read and decode a library file. Safe to call from any thread."""
+        # fetch data according to filename
+        filePath = cls.resourcePath(name+ext)
+        f = open(filePath, "r")
         if f.mode == "r":
             contents = f.read()
+            f.close()
+            return json.loads(contents)
+        return None
+
+    @classmethod
+    def fetchModelEvents(cls):
+        if cls.modelEvents is None:
+            cls.modelEvents = ModelEvents()
+        return cls.modelEvents
+
+    @classmethod
+    def fetchLibraryLoader(cls):
+        if cls.libraryLoader is None:
+            cls.libraryLoader = LibraryLoader()
+        return cls.libraryLoader
+
+    @classmethod
+    def fetchTextureImporter(cls):
+        if cls.textureImporter is None:
+            cls.textureImporter = TextureImporter()
+        return cls.textureImporter
+
+    @classmethod
+    def loadModelFromFile(cls, path, classType):
+        jsContents = cls.loadJSFromFile(path)
+        if jsContents is None:
+            return None
+        return classType.createModelJS(jsContents)
+
+    @classmethod
+    def loadJSFromFile(cls, path):
+        """Read a JSON or binary map file into its json dictionary"""
+        f = open(path, "rb")
+        if f.mode == "rb":
             jsContents = None
             try:
-                jsContents = json.loads(contents)
+                if MapFileFormat.isMapFile(f):
+                    jsContents = MapFileFormat.load(f)
+                else:
+                    jsContents = json.loads(f.read().decode("utf-8"))
             except Exception:
                 # using the base exception class for now
-                # Send an alert that the JSON contents cannot be read
+                # Send an alert that the contents cannot be read
                 pass
             f.close()
-            if jsContents is None:
-                return None
-
-            return classType.createModelJS(jsContents)
+            return jsContents
         return None
 
     @classmethod
+    @Metrics.timed("ModelManager.saveModelToFile")
     def saveModelToFile(cls, name, ext=".json"):
         modelJS = []
         for model in cls.loadedModels[name][cls.List]:
             modelJS.append(model.jsonObj())
+        cls.fetchSaveQueue().enqueue(cls.resourcePath(name+ext),
+                                     cls.encodeJSON, modelJS)
+
+    @classmethod
+    def saveJSONToFile(cls, jsObj,  path, ext="", quiet=False):
+        cls.fetchSaveQueue().enqueue(cls.resourcePath(path+ext),
+                                     cls.encodeJSON, jsObj, quiet)
+
+    @classmethod
+    def saveMapToFile(cls, model, path, ext="", quiet=False):
+        # jsonObj() detaches the grid, so the map can keep being edited
+        # while the snapshot is written out
+        cls.fetchSaveQueue().enqueue(cls.resourcePath(path+ext),
+                                     MapFileFormat.dumps, model.jsonObj(),
+                                     quiet)
 
-        text = json.dumps(modelJS)
-        f = open(cls.resourcePath(name+ext), "w+")
-        f.write(text)
-        f.close()
+    @classmethod
+    def encodeJSON(cls, jsObj):
+        return json.dumps(jsObj).encode("utf-8")
 
     @classmethod
-    def saveJSONToFile(cls, jsObj,  path, ext=""):
-        text = json.dumps(jsObj)
-        f = open(cls.resourcePath(path+ext), "w+")
-        f.write(text)
-        f.close()
+    def fetchSaveQueue(cls):
+        if cls.saveQueue is None:
+            cls.saveQueue = SaveQueue()
+        return cls.saveQueue
+
+    @classmethod
+    def writeFileAtomic(cls, path, data):
+        """
+        Write data to path so it is either completely replaced or untouched.
+
+        The data goes to a temporary file in the same directory, which is
+        flushed to disk and then renamed over path.
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tempPath = tempfile.mkstemp(
+            prefix=".{}.".format(os.path.basename(path)), suffix=".tmp",
+            dir=directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tempPath, path)
+        except BaseException:
+            if os.path.exists(tempPath):
+                os.remove(tempPath)
+            raise
+        if hasattr(os, "O_DIRECTORY"):
+            # make the rename itself durable
+            dirFd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(dirFd)
+            finally:
+                os.close(dirFd)
 
     @classmethod
     def saveImageToFile(cls, img, path):
-        # f = open(path+".png", "w+")
+        # renders are premultiplied, PNG stores straight alpha
+        img = img.convertToFormat(QImage.Format_ARGB32)
         img.save(path+".png", "PNG")
         # f.close()
 
@@ -161,11 +289,20 @@ class ModelManager():
 
     @classmethod
     def fetchByUid(cls, modelName, uid):
+        """Return the shared, read-only snapshot of the model with uid"""
         if modelName in cls.loadedModels:
             uidDict = cls.loadedModels[modelName][cls.ByUid]
-            cr = cls.loadedModels[modelName][cls.ClassRef]
             if uid in uidDict:
-                return cr.createModelCopy(uidDict[uid])
+                return uidDict[uid]
+        return None
+
+    @classmethod
+    def fetchEditableCopy(cls, modelName, uid):
+        """Return a private, mutable copy of the model with uid"""
+        model = cls.fetchByUid(modelName, uid)
+        if model is not None:
+            cr = cls.loadedModels[modelName][cls.ClassRef]
+            return cr.createModelCopy(model)
         return None
 
     @classmethod
@@ -173,10 +310,8 @@ class ModelManager():
         if modelName in cls.loadedModels:
             modelType = cls.loadedModels[modelName]
             if keyword is None or searchType is None:
-                return cls.copyModelList(
-                    modelType[cls.List], modelType[cls.ClassRef])
-            return cls.copyModelList(
-                modelType[cls.List], modelType[cls.ClassRef])
+                return list(modelType[cls.List])
+            return list(modelType[cls.List])
         return None
 
     @classmethod
@@ -198,11 +333,23 @@ class ModelManager():
 
     @classmethod
     def updateModel(cls, name, model):
+        """
+        Replace the stored snapshot with model, bumping its version.
+
+        The previous snapshot is left untouched for anyone still holding it.
+        model becomes the shared snapshot, so the caller must not modify it
+        afterwards.
+        """
         if name in cls.loadedModels:
             modelType = cls.loadedModels[name]
             if model.getUid() in modelType[cls.ByUid]:
                 mainModel = modelType[cls.ByUid][model.getUid()]
-                mainModel.updateModel(model)
+                model.setVersion(mainModel.getVersion() + 1)
+                index = modelType[cls.List].index(mainModel)
+                modelType[cls.List][index] = model
+                modelType[cls.ByUid][model.getUid()] = model
+                cls.indexModel(name, model)
+                EMImageGenerator.invalidateModel(name, model.getUid())
                 cls.saveModelToFile(name)
 
     @classmethod
@@ -215,6 +362,7 @@ class ModelManager():
             else:
                 modelType[cls.List].insert(index, model)
             modelType[cls.ByUid][model.getUid()] = model
+            cls.indexModel(name, model)
             cls.saveModelToFile(name)
 
     @classmethod
@@ -229,8 +377,94 @@ class ModelManager():
                     break
             # remove from UID cache
             del modelType[cls.ByUid][uid]
+            # anything still referencing it is left as is, so it stays in
+            # the index to show up as broken
+            cls.unindexModel(name, uid)
+            EMImageGenerator.invalidateModel(name, uid)
             cls.saveModelToFile(name)
 
+    @classmethod
+    def modelDependencies(cls, name, model):
+        """Return the (name, uid) of every model that model references"""
+        if name == cls.TileName:
+            textures = {model.getBgTexture()}
+            for shape in model.getShapes():
+                textures.add(shape[0])
+            return frozenset((cls.TextureName, uid) for uid in textures
+                             if uid is not None and uid >= 0)
+        if name == cls.GroupName:
+            return frozenset((cls.TileName, uid)
+                             for uid in model.getTilesToFetch() if uid >= 0)
+        return frozenset()
+
+    @classmethod
+    def indexModel(cls, name, model):
+        key = (name, model.getUid())
+        cls.unindexModel(name, model.getUid())
+        dependencies = cls.modelDependencies(name, model)
+        cls.dependencies[key] = dependencies
+        for dependency in dependencies:
+            if dependency not in cls.references:
+                cls.references[dependency] = set()
+            cls.references[dependency].add(key)
+
+    @classmethod
+    def unindexModel(cls, name, uid):
+        key = (name, uid)
+        for dependency in cls.dependencies.pop(key, ()):
+            referencing = cls.references.get(dependency)
+            if referencing is not None:
+                referencing.discard(key)
+                if not referencing:
+                    del cls.references[dependency]
+
+    @classmethod
+    def registerMap(cls, model):
+        """Include an open map when looking for references to tiles"""
+        if model not in cls.openMaps:
+            cls.openMaps.append(model)
+
+    @classmethod
+    def unregisterMap(cls, model):
+        if model in cls.openMaps:
+            cls.openMaps.remove(model)
+
+    @classmethod
+    def fetchReferences(cls, name, uid):
+        """
+        Return (name, model) pairs of the models that reference the model
+        directly, including registered maps. Only libraries that are loaded
+        are taken into account.
+        """
+        found = []
+        for (refName, refUid) in sorted(cls.references.get((name, uid), ())):
+            model = cls.fetchByUid(refName, refUid)
+            if model is not None:
+                found.append((refName, model))
+        if name == cls.TileName:
+            for model in cls.openMaps:
+                if model.getTileCount(uid) > 0:
+                    found.append((cls.MapName, model))
+        return found
+
+    @classmethod
+    def fetchDependents(cls, name, uid):
+        """
+        Return the (name, uid) of every library model that references the
+        model, directly or through other models, e.g. the tiles using a
+        texture and the groups using those tiles.
+        """
+        found = []
+        seen = {(name, uid)}
+        pending = [(name, uid)]
+        while pending:
+            for key in cls.references.get(pending.pop(), ()):
+                if key not in seen:
+                    seen.add(key)
+                    found.append(key)
+                    pending.append(key)
+        return found
+
     @classmethod
     def loadPalette(cls):
         """"Todo"""
@@ -327,6 +561,257 @@ class ModelManager():
         return os.path.join(os.path.abspath('.'), relative_path)
 
 
+class SaveQueue(QObject):
+    """
+    Serializes and writes files on a single background thread.
+
+    enqueue() takes a snapshot of the data, which must not be modified
+    afterwards, and the function that turns it into bytes. Both run on the
+    worker, so large maps no longer block the UI while saving. Because there
+    is only one worker, saves are written one at a time in the order they
+    were queued, and a later save of a file always wins. Saves queued as
+    quiet, such as autosaves, are written the same way but emit no signals,
+    so only files the user saved are reported.
+
+    Signals
+    -------
+
+    saveStarted -> str
+        emitted with the path when a save begins writing
+    saveFinished -> str
+        emitted with the path once the file has been replaced
+    saveFailed -> str, str
+        emitted with the path and the error message if a save failed. The
+        previous contents of the file are left untouched.
+    """
+
+    saveStarted = pyqtSignal(str)
+    saveFinished = pyqtSignal(str)
+    saveFailed = pyqtSignal(str, str)
+
+    def __init__(self):
+        super(SaveQueue, self).__init__()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def enqueue(self, path, serialize, snapshot, quiet=False):
+        return self.executor.submit(self.write, path, serialize, snapshot,
+                                    quiet)
+
+    def enqueueTask(self, task, *args):
+        """Run task on the worker, after everything queued before it"""
+        return self.executor.submit(task, *args)
+
+    @Metrics.timed("SaveQueue.write")
+    def write(self, path, serialize, snapshot, quiet=False):
+        if not quiet:
+            self.saveStarted.emit(path)
+        try:
+            ModelManager.writeFileAtomic(path, serialize(snapshot))
+        except Exception as e:
+            print("WARNING: {} could not be saved: {}".format(path, e))
+            if not quiet:
+                self.saveFailed.emit(path, str(e))
+            return False
+        if not quiet:
+            self.saveFinished.emit(path)
+        return True
+
+    def waitForIdle(self):
+        """Block until every queued save has been written"""
+        self.executor.submit(int).result()
+
+
+class ModelEvents(QObject):
+    """
+    Notifications about library models shared across the program.
+
+    Signals
+    -------
+
+    modelsInvalidated -> list
+        emitted with the (name, uid) of the models whose cached renders were
+        dropped, because they or something they depend on changed
+    """
+
+    modelsInvalidated = pyqtSignal(list)
+
+
+class LibraryLoader(QObject):
+    """
+    Reads libraries on a background thread ahead of their first use.
+
+    load() takes (name, classType) pairs. Each file is read and decoded on
+    the worker, while the models themselves, being QObjects, are created back
+    on the UI thread through ModelManager.loadModelListFromFile().
+
+    Signals
+    -------
+
+    libraryLoaded -> str
+        emitted with the name of a library once its models are available
+    finished -> None
+        emitted once every requested library has been loaded
+    """
+
+    libraryLoaded = pyqtSignal(str)
+    finished = pyqtSignal()
+    libraryRead = pyqtSignal(str)
+
+    def __init__(self):
+        super(LibraryLoader, self).__init__()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.classTypes = {}
+        # emitted from the worker, so the slot runs on the UI thread
+        self.libraryRead.connect(self.createModels, Qt.QueuedConnection)
+
+    def load(self, libraries):
+        for (name, classType) in libraries:
+            if (name in ModelManager.loadedModels
+                    or name in ModelManager.pendingLoads):
+                continue
+            self.classTypes[name] = classType
+            ModelManager.pendingLoads[name] = self.executor.submit(
+                self.read, name)
+        if not self.classTypes:
+            self.finished.emit()
+
+    def read(self, name):
+        try:
+            return ModelManager.readModelList(name)
+        except Exception as e:
+            print("WARNING: {} could not be loaded: {}".format(name, e))
+            return None
+        finally:
+            self.libraryRead.emit(name)
+
+    def createModels(self, name):
+        classType = self.classTypes.pop(name, None)
+        if classType is not None:
+            ModelManager.loadModelListFromFile(name, classType)
+            self.libraryLoaded.emit(name)
+            if not self.classTypes:
+                self.finished.emit()
+
+    def isLoading(self):
+        return bool(self.classTypes)
+
+
+class TextureImporter(QObject):
+    """
+    Turns user images into textures.
+
+    importImage() decodes the image on a worker, crops it to a square,
+    resamples it to the texture size and stores the pixels as raw
+    premultiplied ARGB (native byte order, no header) in the texture store.
+    loadImage() reads the stored file straight into the pixels of a QImage
+    without decoding anything, and keeps no file open, so a stored copy can
+    be replaced or deleted at any time. Images are stored under a hash of their source path and
+    imported again whenever the source is newer than its stored copy.
+
+    Signals
+    -------
+
+    imported -> str
+        emitted with the source path once the image has been stored
+    importFailed -> str, str
+        emitted with the source path and the error message if the image
+        could not be imported
+    """
+
+    imported = pyqtSignal(str)
+    importFailed = pyqtSignal(str, str)
+
+    StoreDirectory = "textures"
+    StoreExt = ".raw"
+    Size = TextureModel.TextureSize
+    Format = QImage.Format_ARGB32_Premultiplied
+
+    def __init__(self):
+        super(TextureImporter, self).__init__()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def importImage(self, source):
+        return self.executor.submit(self.read, source)
+
+    def read(self, source):
+        try:
+            self.storeImage(source)
+        except Exception as e:
+            print("WARNING: {} could not be imported: {}".format(source, e))
+            self.importFailed.emit(source, str(e))
+            return False
+        self.imported.emit(source)
+        return True
+
+    @classmethod
+    def storePath(cls, source):
+        name = hashlib.sha1(
+            os.path.abspath(source).encode("utf-8")).hexdigest()
+        return ModelManager.resourcePath(
+            os.path.join(cls.StoreDirectory, name + cls.StoreExt))
+
+    @classmethod
+    def isStored(cls, source):
+        path = cls.storePath(source)
+        if not os.path.exists(path):
+            return False
+        # the source may be gone, the stored copy is all that is needed then
+        return (not os.path.exists(source)
+                or os.path.getmtime(source) <= os.path.getmtime(path))
+
+    @classmethod
+    @Metrics.timed("TextureImporter.storeImage")
+    def storeImage(cls, source):
+        """Decode, resample and store source. Safe to call on any thread."""
+        img = QImage()
+        if not img.load(source):
+            raise IOError("not a readable image")
+        side = min(img.width(), img.height())
+        img = img.copy((img.width() - side) // 2,
+                       (img.height() - side) // 2, side, side)
+        img = img.scaled(cls.Size, cls.Size, Qt.IgnoreAspectRatio,
+                         Qt.SmoothTransformation).convertToFormat(cls.Format)
+        bits = img.constBits()
+        bits.setsize(img.bytesPerLine() * img.height())
+        path = cls.storePath(source)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        ModelManager.writeFileAtomic(path, bytes(bits))
+
+    @classmethod
+    def loadImage(cls, source):
+        """
+        Return the stored image of source, importing it first if needed.
+        Returns None if source can not be read.
+        """
+        if not cls.isStored(source):
+            try:
+                cls.storeImage(source)
+            except Exception as e:
+                print("WARNING: {} could not be imported: {}".format(
+                    source, e))
+                return None
+        path = cls.storePath(source)
+        size = cls.Size * cls.Size * 4
+        if os.path.getsize(path) != size:
+            print("WARNING: {} is damaged".format(path))
+            os.remove(path)
+            return None
+        img = QImage(cls.Size, cls.Size, cls.Format)
+        bits = img.bits()
+        bits.setsize(size)
+        with open(path, "rb") as f:
+            f.readinto(bits)
+        return img
+
+    @classmethod
+    def removeImage(cls, source):
+        """Delete the stored copy of source"""
+        path = cls.storePath(source)
+        if os.path.exists(path):
+            os.remove(path)
+
+
 class EMImageGenerator():
     """
     Helper class for generating the images used to display the tileMap.
@@ -340,10 +825,62 @@ class EMImageGenerator():
     things easier for my personal use. In the future, I plan to allow this to
     be customized, although some user-created custom images may be required
     at that time.
+
+    Every render of a library model is cached under its uid and version.
+    The version of a model goes up with each change, and when a snapshot is
+    replaced through ModelManager.updateModel(), the models depending on it
+    (the tiles using a texture, the groups using those tiles) get a new
+    version too. Stale renders are never looked up again, so only the
+    changed model and its dependents are rendered anew.
+
+    Tiles placed in a group or map are drawn from rasters cached in
+    tileImages, keyed by the tile uid and version, its orientation and
+    flips, and the texture phase (x % 3, y % 3) of the cell, since textures
+    span 3x3 tiles.
+    Painting only adds rasters while there is room, and draws the tile
+    directly otherwise. warmUp() renders the textures and rasters a model
+    needs on worker threads ahead of its first paint, replacing the least
+    recently used images if needed.
+
+    All the image caches are registered with the CacheManager, which keeps
+    them within one memory budget.
+
+    Everything is rendered in RenderFormat, premultiplied ARGB, which
+    QPainter composites without converting every pixel, and generated
+    textures, being opaque, in OpaqueFormat. Images are only converted to
+    plain ARGB when they are saved as PNG. Textures are painted with brushes
+    cached by texture version and painter scale, see fetchTextureBrush().
+
+    Draft rendering (draft=True or a "draft" display option) never renders
+    anything new: tiles without a cached raster are filled with the average
+    colours of their textures instead. QImage and QPainter can be used off
+    the UI thread and the caches lock themselves, so rasters can be rendered
+    on worker threads.
     """
 
-    textureCache = {}
-    textureModelImages = {}
+    textureCache = CacheManager.register("backgrounds")
+    # (uid, version) -> QImage of a texture
+    textureModelImages = CacheManager.register("textures")
+    # (uid, version) -> average QColor of a texture, used for draft tiles
+    textureColors = {}
+    # (name, uid) -> (snapshot, version, image) of rendered library models
+    modelImages = CacheManager.register(
+        "thumbnails", lambda cached: CacheManager.imageBytes(cached[2]))
+    # (uid, version, scale) -> texture QBrush for painters at that scale.
+    # Brushes at scale 1 share their image with textureModelImages.
+    textureBrushes = CacheManager.register(
+        "brushes", lambda brush: 0 if brush.transform().isIdentity()
+        else CacheManager.imageBytes(brush.textureImage()))
+    # (uid, version, orientation, hflip, vflip, phaseX, phaseY) -> QImage
+    tileImages = CacheManager.register("tiles")
+    TileImageBytes = 216 * 216 * 4
+    RenderFormat = QImage.Format_ARGB32_Premultiplied
+    OpaqueFormat = QImage.Format_RGB32
+    TextureSpan = 3
+    # fill of textures that no longer exist, as in the vector export
+    MissingTextureColor = "#808080"
+
+    renderExecutor = None
 
     GridPatternExport = (5, 3, 3)
     GridPatternStandard = (3, 1, 1)
@@ -382,47 +919,62 @@ class EMImageGenerator():
                 ModelManager.resourcePath(
                     filePath.format(selectedString.format(str))
                 )))
-        for i in range(0, 9):
+        for i in range(0, 10):
             cls.badgeNums.append(QPixmap(
                 ModelManager.resourcePath(
                     filePath.format(i)
                 )))
 
     @classmethod
+    @Metrics.timed("EMImageGenerator.genImageFromModel")
     def genImageFromModel(cls, model, displayOptions=None):
         displayOptions = [] if displayOptions is None else displayOptions
         genImage = None
         if isinstance(model, MapModel):
-            genImage = QImage(216 * model.getNumCols(),
-                              216 * model.getNumRows(),
-                              QImage.Format_ARGB32)
+            region = (0, 0, model.getNumCols(), model.getNumRows())
+            if "region" in displayOptions:
+                region = displayOptions["region"]
+            nc = region[2] - region[0]
+            nr = region[3] - region[1]
+            genImage = QImage(216 * nc, 216 * nr, cls.RenderFormat)
+            genImage.fill(Qt.transparent)
             painter = QPainter(genImage)
-            cls.drawTileGroup(painter, model)
+            painter.translate(-216 * region[0], -216 * region[1])
+            cls.drawTileGroup(painter, model, region)
+            painter.resetTransform()
             if "drawGrid" in displayOptions:
-                cls.drawGrid(painter, model.getNumCols(), model.getNumRows(),
+                cls.drawGrid(painter, nc, nr,
                              0, 0, 216, Qt.black, cls.GridPatternExport)
+            painter.end()
         elif isinstance(model, GroupModel):
             genImage = QImage(216 * model.getNumCols(),
                               216 * model.getNumRows(),
-                              QImage.Format_ARGB32)
+                              cls.RenderFormat)
+            genImage.fill(Qt.transparent)
             painter = QPainter(genImage)
             cls.drawTileGroup(painter, model)
+            painter.end()
         elif isinstance(model, TileModel):
-            genImage = QImage(216, 216, QImage.Format_ARGB32)
+            genImage = QImage(216, 216, cls.RenderFormat)
+            genImage.fill(Qt.transparent)
             painter = QPainter(genImage)
-            cls.drawTile(painter, model)
+            if "draft" in displayOptions:
+                cls.drawTileDraft(painter, model)
+            else:
+                cls.drawTile(painter, model)
             if "transformOptions" in displayOptions:
                 cls.drawTile(painter, model, 0, 0,
                              displayOptions["transformOptions"])
             if "drawGrid" in displayOptions:
                 cls.drawGrid(painter, 1, 1)
+            painter.end()
         elif isinstance(model, ImageTextureModel):
-            genImage = QImage(648, 648, QImage.Format_ARGB32)
-            painter = QPainter(genImage)
-            pass
+            genImage = TextureImporter.loadImage(model.getFilePath())
+            if genImage is None:
+                genImage = QImage(648, 648, cls.RenderFormat)
+                genImage.fill(Qt.transparent)
         elif isinstance(model, GeneratedTextureModel):
-            genImage = QImage(648, 648, QImage.Format_ARGB32)
-            genImage.fill(QColor(0, 0, 0, 0))
+            genImage = QImage(648, 648, cls.OpaqueFormat)
             painter = QPainter(genImage)
             cls.drawGeneratedTexture(painter, model)
             painter.end()
@@ -434,11 +986,20 @@ class EMImageGenerator():
         pass
 
     @classmethod
-    def drawTileGroup(cls, painter, model):
+    @Metrics.timed("EMImageGenerator.drawTileGroup")
+    def drawTileGroup(cls, painter, model, region=None, draft=False):
+        """
+        Draw the tiles of a group or map at their grid positions.
+
+        region limits drawing to the cells in (x0, y0, x1, y1), so only the
+        part of the grid being displayed or exported has to be read.
+        """
+        if region is None:
+            region = (0, 0, model.getNumCols(), model.getNumRows())
         cachedTiles = {}
         grid = model.getTileGrid()
-        for y in range(model.getNumRows()):
-            for x in range(model.getNumCols()):
+        for y in range(region[1], region[3]):
+            for x in range(region[0], region[2]):
                 tile = grid[y][x]
                 if tile[0] == -1:
                     # draw Empty Tile
@@ -450,8 +1011,18 @@ class EMImageGenerator():
                             ModelManager.TileName, tile[0])
                     tileModel = cachedTiles[tile[0]]
                     if tileModel is not None:
-                        cls.drawTile(painter, tileModel, x, y,
-                                     (tile[1], tile[2], tile[3]))
+                        img = cls.fetchTileImage(tileModel, tile, x, y,
+                                                 not draft)
+                        if img is not None:
+                            painter.drawImage(216 * x, 216 * y, img)
+                        elif draft:
+                            cls.drawTileDraft(painter, tileModel, x, y,
+                                              (tile[1], tile[2], tile[3]))
+                        else:
+                            # the raster cache is full, so draw the tile
+                            # directly rather than evict rasters in use
+                            cls.drawTile(painter, tileModel, x, y,
+                                         (tile[1], tile[2], tile[3]))
                     else:
                         # Draw error Tile
                         pass
@@ -459,27 +1030,29 @@ class EMImageGenerator():
         pass
 
     @classmethod
+    @Metrics.timed("EMImageGenerator.drawTile")
     def drawTile(cls, painter, model, xind=0, yind=0,
                  options=(0, False, False)):
         # Res = 3 in. at 72ppi. 72*3 = 216
         res = 216
-        bgUid = model.getBgTexture()
-        bgTxt = cls.getTextureImage(bgUid)
+        scale = cls.painterScale(painter)
         painter.setPen(Qt.NoPen)
-        painter.setBrush(QBrush(bgTxt))
+        painter.setBrush(cls.fetchTextureBrush(model.getBgTexture(), scale))
         painter.drawRect(int(res * xind),
                          int(res * yind),
                          res, res)
 
-        pointsForShapes = model.generateAllShapeOffset(
-            xind, yind, res, 0, 0, options[0], options[1], options[2])
+        # The cached polygons are mapped into place rather than transforming
+        # the painter, which would move the texture brushes along with them
+        polygons = model.fetchShapePolygons(options[0], options[1],
+                                            options[2])
+        transform = QTransform(res / 100, 0, 0, res / 100,
+                               res * xind, res * yind)
         shapes = model.getShapes()
         for i in range(len(shapes)):
-            texture = cls.getTextureImage(shapes[i][0])
             # painter.setPen(Qt.NoPen)
-            painter.setBrush(QBrush(texture))
-            poly = QPolygon(pointsForShapes[i])
-            painter.drawPolygon(poly)
+            painter.setBrush(cls.fetchTextureBrush(shapes[i][0], scale))
+            painter.drawPolygon(transform.map(polygons[i]))
 
         # Add Background texture
         # bgTexture = model.getBgTexture()
@@ -499,8 +1072,6 @@ class EMImageGenerator():
         # fg = model.getFgColor()
         # painter.setBrush(fg)
         # painter.setPen(fg)
-        # poly = QPolygon(points)
-        # painter.drawPolygon(poly)
         # # FG Texture
         # fgTxtName = model.getFgTexture()
         # if fgTxtName != "None":
@@ -511,6 +1082,200 @@ class EMImageGenerator():
         #     painter.setPen(Qt.NoPen)
         #     painter.drawPolygon(poly)
 
+    @classmethod
+    def painterScale(cls, painter):
+        """Return the scale painter draws at, rounded to limit the brushes"""
+        transform = painter.combinedTransform()
+        scale = round(math.hypot(transform.m11(), transform.m12()), 2)
+        return scale if scale > 0 else 1.0
+
+    @classmethod
+    def fetchTextureBrush(cls, txtUid, scale=1.0):
+        """
+        Return a brush of the texture for a painter drawing at scale.
+
+        The texture is resampled to the size it ends up on screen, and the
+        brush transform undoes the painter scale, so filling with it copies
+        the pixels instead of transforming the texture for every polygon.
+        """
+        key = cls.textureKey(txtUid) + (scale,)
+        brush = cls.textureBrushes.get(key)
+        if brush is None:
+            texture = cls.getTextureImage(txtUid)
+            if texture is None:
+                # the texture was deleted, so fill with a flat placeholder
+                brush = QBrush(QColor(cls.MissingTextureColor))
+                cls.textureBrushes[key] = brush
+                return brush
+            size = max(1, round(texture.width() * scale))
+            if scale == 1 or size == texture.width():
+                brush = QBrush(texture)
+            else:
+                brush = QBrush(texture.scaled(
+                    size, size, Qt.IgnoreAspectRatio,
+                    Qt.SmoothTransformation))
+                ratio = texture.width() / size
+                brush.setTransform(QTransform.fromScale(ratio, ratio))
+            cls.textureBrushes[key] = brush
+        return brush
+
+    @classmethod
+    def drawTileDraft(cls, painter, model, xind=0, yind=0,
+                      options=(0, False, False)):
+        """Draw a tile with flat colours, without rendering any texture"""
+        res = 216
+        painter.setPen(Qt.NoPen)
+        painter.setBrush(cls.fetchTextureColor(model.getBgTexture()))
+        painter.drawRect(int(res * xind), int(res * yind), res, res)
+        polygons = model.fetchShapePolygons(options[0], options[1],
+                                            options[2])
+        transform = QTransform(res / 100, 0, 0, res / 100,
+                               res * xind, res * yind)
+        shapes = model.getShapes()
+        for i in range(len(shapes)):
+            painter.setBrush(cls.fetchTextureColor(shapes[i][0]))
+            painter.drawPolygon(transform.map(polygons[i]))
+
+    @classmethod
+    def fetchTextureColor(cls, txtUid):
+        key = cls.textureKey(txtUid)
+        color = cls.textureColors.get(key)
+        if color is None:
+            img = cls.textureModelImages.get(key)
+            if img is not None:
+                color = img.scaled(
+                    1, 1, Qt.IgnoreAspectRatio,
+                    Qt.SmoothTransformation).pixelColor(0, 0)
+                cls.textureColors[key] = color
+            else:
+                # not rendered yet, so make do with the background colour
+                model = ModelManager.fetchByUid(ModelManager.TextureName,
+                                                txtUid)
+                if isinstance(model, GeneratedTextureModel):
+                    color = model.getBgColor()
+                else:
+                    color = QColor(Qt.gray)
+        return color
+
+    @classmethod
+    def textureKey(cls, txtUid):
+        """Return the (uid, version) the current texture is cached under"""
+        model = ModelManager.fetchByUid(ModelManager.TextureName, txtUid)
+        return (txtUid, -1 if model is None else model.getVersion())
+
+    @classmethod
+    def tileImageKey(cls, tileModel, tile, x, y):
+        return (tile[0], tileModel.getVersion(), tile[1], bool(tile[2]),
+                bool(tile[3]), x % cls.TextureSpan, y % cls.TextureSpan)
+
+    @classmethod
+    def fetchTileImage(cls, tileModel, tile, x, y, render=True):
+        """
+        Return the raster of a tile as placed in cell (x, y). If it is not
+        cached, it is rendered if render is set and there is room in the
+        cache, otherwise None is returned.
+        """
+        key = cls.tileImageKey(tileModel, tile, x, y)
+        img = cls.tileImages.get(key)
+        if img is not None:
+            return img
+        if not render or not CacheManager.hasRoom(cls.TileImageBytes):
+            return None
+        return cls.renderTileImage(tileModel, key)
+
+    @classmethod
+    def renderTileImage(cls, tileModel, key):
+        """
+        Render and cache a tile raster. When the budget is used up, the
+        least recently used images make room for it.
+        """
+        img = QImage(216, 216, cls.RenderFormat)
+        img.fill(Qt.transparent)
+        painter = QPainter(img)
+        # draw in place so the textures line up with the neighbouring cells
+        painter.translate(-216 * key[5], -216 * key[6])
+        cls.drawTile(painter, tileModel, key[5], key[6],
+                     (key[2], key[3], key[4]))
+        painter.end()
+        cls.tileImages[key] = img
+        return img
+
+    @classmethod
+    def fetchRenderExecutor(cls):
+        if cls.renderExecutor is None:
+            cls.renderExecutor = ThreadPoolExecutor(
+                max_workers=max(2, os.cpu_count() or 1))
+        return cls.renderExecutor
+
+    @classmethod
+    def warmUp(cls, model, region=None):
+        """
+        Render the textures and tile rasters model needs in parallel.
+
+        This is a generator, yielding (done, total) every time a render
+        finishes so the caller can show progress. Textures are rendered
+        first, as every tile raster needs them. region limits the rasters to
+        the cells in (x0, y0, x1, y1), e.g. the part shown first.
+        """
+        ModelManager.loadModelListFromFile(ModelManager.TextureName,
+                                           TextureModelLoader)
+        ModelManager.loadModelListFromFile(ModelManager.TileName, TileModel)
+        tiles = {}
+        textures = set()
+        for uid in model.getTilesToFetch():
+            tileModel = ModelManager.fetchByUid(ModelManager.TileName, uid)
+            if tileModel is not None:
+                tiles[uid] = tileModel
+                textures.add(tileModel.getBgTexture())
+                for shape in tileModel.getShapes():
+                    textures.add(shape[0])
+        textures = [uid for uid in textures
+                    if cls.textureKey(uid) not in cls.textureModelImages
+                    and ModelManager.fetchByUid(
+                        ModelManager.TextureName, uid) is not None]
+
+        if region is None:
+            region = (0, 0, model.getNumCols(), model.getNumRows())
+        grid = model.getTileGrid()
+        # use at most half the budget, leaving the rest for textures and
+        # anything else on screen
+        limit = CacheManager.budget // (2 * cls.TileImageBytes)
+        keys = {}
+        for y in range(region[1], region[3]):
+            for x in range(region[0], region[2]):
+                tile = grid[y][x]
+                if tile[0] in tiles:
+                    key = cls.tileImageKey(tiles[tile[0]], tile, x, y)
+                    if key not in cls.tileImages:
+                        keys[key] = tiles[tile[0]]
+                        if len(keys) >= limit:
+                            break
+            if len(keys) >= limit:
+                break
+
+        executor = cls.fetchRenderExecutor()
+        total = len(textures) + len(keys)
+        done = 0
+        yield (done, total)
+        futures = [executor.submit(cls.renderTexture, uid)
+                   for uid in textures]
+        for future in as_completed(futures):
+            future.result()
+            done += 1
+            yield (done, total)
+        futures = [executor.submit(cls.renderTileImage, tileModel, key)
+                   for (key, tileModel) in keys.items()]
+        for future in as_completed(futures):
+            future.result()
+            done += 1
+            yield (done, total)
+
+    @classmethod
+    def renderTexture(cls, txtUid):
+        model = ModelManager.fetchByUid(ModelManager.TextureName, txtUid)
+        img = cls.genImageFromModel(model)
+        cls.textureModelImages.setdefault((txtUid, model.getVersion()), img)
+
     @classmethod
     def drawEmptyTile(cls, painter, xInd, yInd):
         painter.setPen(Qt.black)
@@ -523,8 +1288,12 @@ class EMImageGenerator():
         pattern = cls.GridPatternStandard if gp is None else gp
         pc = Qt.black if penColor is None else penColor
         painter.setPen(pc)
-        xLen = tileSize * nc
-        yLen = tileSize * nr
+        # QPainter takes int coordinates, and tileSize and the offsets are
+        # fractional when zoomed
+        xoff = int(xoff)
+        yoff = int(yoff)
+        xLen = int(tileSize * nc)
+        yLen = int(tileSize * nr)
         dist = tileSize/lpt
         # print(pattern)
         patternLen = len(pattern)
@@ -595,27 +1364,29 @@ class EMImageGenerator():
                                       0, 0, 648, 648)
 
     @classmethod
+    @Metrics.timed("EMImageGenerator.setImageColor")
     def setImageColor(cls, img, color):
         """Set an image to a single color while preserving the alpha"""
-        img = QImage(img)
-        modifiedImg = None
-        # return img
+        if img.format() != cls.RenderFormat:
+            img = img.convertToFormat(cls.RenderFormat)
+        modifiedImg = QImage(img.width(), img.height(), cls.RenderFormat)
+        alpha = cls.imageArray(img)[:, :, 3].astype(numpy.uint16)
+        arr = cls.imageArray(modifiedImg)
+        # premultiplied, so every channel is scaled by the alpha
+        for (channel, value) in ((0, color.blue()), (1, color.green()),
+                                 (2, color.red())):
+            arr[:, :, channel] = (alpha * value + 127) // 255
+        arr[:, :, 3] = alpha
+        return modifiedImg
 
-        red = color.red()
-        green = color.green()
-        blue = color.blue()
+    @classmethod
+    def imageArray(cls, img):
+        """Return a writable (height, width, 4) view of a 32-bit image"""
         bits = img.bits()
-        bits.setsize(img.byteCount())
-        #
-        arr = numpy.array(bits).reshape(img.height(), img.width(), 4)
-        for line in arr:
-            for pix in line:
-                pix[0] = blue
-                pix[1] = green
-                pix[2] = red
-        modifiedImg = QImage(arr, img.width(),
-                             img.height(), QImage.Format_ARGB32)
-        return modifiedImg
+        bits.setsize(img.bytesPerLine() * img.height())
+        arr = numpy.frombuffer(bits, numpy.uint8).reshape(
+            img.height(), img.bytesPerLine() // 4, 4)
+        return arr[:, :img.width()]
 
     @classmethod
     def transformImage(cls, img, options=(0, False, False)):
@@ -626,23 +1397,86 @@ class EMImageGenerator():
         return tImage
 
     @classmethod
+    def fetchModelImage(cls, modelName, model):
+        """
+        Return the render of a library model.
+
+        Renders of the shared snapshots are cached until the version of the
+        snapshot changes. Any other model, e.g. a copy being edited, is
+        rendered every time.
+        """
+        if ModelManager.fetchByUid(modelName, model.getUid()) is not model:
+            return cls.genImageFromModel(model)
+        key = (modelName, model.getUid())
+        cached = cls.modelImages.get(key)
+        if (cached is None or cached[0] is not model
+                or cached[1] != model.getVersion()):
+            cached = (model, model.getVersion(),
+                      cls.genImageFromModel(model))
+            cls.modelImages[key] = cached
+        return cached[2]
+
+    @classmethod
+    def invalidateModel(cls, modelName, uid):
+        """
+        Propagate a change of a model to every model depending on it, which
+        gets a new version, and drop the renders that went stale. Returns
+        the (name, uid) of all models that were invalidated.
+        """
+        dependents = ModelManager.fetchDependents(modelName, uid)
+        for (name, depUid) in dependents:
+            model = ModelManager.fetchByUid(name, depUid)
+            if model is not None:
+                model.bumpVersion()
+        invalidated = [(modelName, uid)] + dependents
+        textures = set()
+        tiles = set()
+        for (name, depUid) in invalidated:
+            cls.modelImages.pop((name, depUid), None)
+            if name == ModelManager.TextureName:
+                textures.add(depUid)
+            elif name == ModelManager.TileName:
+                tiles.add(depUid)
+        # stale renders would never be looked up again, drop them right away
+        # rather than waiting for them to be evicted
+        for (cache, uids) in ((cls.textureModelImages, textures),
+                              (cls.textureBrushes, textures),
+                              (cls.tileImages, tiles)):
+            if uids:
+                for key in cache:
+                    if key[0] in uids:
+                        cache.pop(key)
+        for key in list(cls.textureColors):
+            if key[0] in textures:
+                del cls.textureColors[key]
+        ModelManager.fetchModelEvents().modelsInvalidated.emit(invalidated)
+        return invalidated
+
+    @classmethod
+    @Metrics.timed("EMImageGenerator.getTextureImage")
     def getTextureImage(cls, txtUid):
+        """Return the render of a texture, or None if it does not exist"""
         if len(cls.textureModelImages) == 0:
             ModelManager.loadModelListFromFile(
                 ModelManager.TextureName, TextureModelLoader)
-        if txtUid not in cls.textureModelImages:
-            img = cls.genImageFromModel(
-                ModelManager.fetchByUid(ModelManager.TextureName, txtUid))
-            cls.textureModelImages[txtUid] = img
-        return cls.textureModelImages[txtUid]
+        key = cls.textureKey(txtUid)
+        img = cls.textureModelImages.get(key)
+        if img is None:
+            model = ModelManager.fetchByUid(ModelManager.TextureName, txtUid)
+            if model is None:
+                return None
+            Metrics.count("EMImageGenerator.textureImageMiss")
+            img = cls.genImageFromModel(model)
+            cls.textureModelImages[key] = img
+        return img
 
     @classmethod
     def loadTexture(cls, txtName):
         texture = QImage()
         if texture.load(ModelManager.resourcePath(
                 "res/bg_{}.png".format(txtName.lower())), "PNG"):
-            cls.textureCache[txtName] = texture
-            print("successful Load!")
+            cls.textureCache[txtName] = texture.convertToFormat(
+                cls.RenderFormat)
             return True
         else:
             # include None to prevent multiple loads
@@ -22,31 +22,57 @@ If not, see <https://www.gnu.org/licenses/>.
 from PyQt5.QtWidgets import (QApplication, QStackedWidget, QFileDialog,
                              QLabel, QPushButton, QVBoxLayout, QComboBox,
                              QWidget, QMainWindow, QAction, QSpinBox,
-                             QGridLayout, QDialog)
+                             QGridLayout, QDialog, QMessageBox,
+                             QProgressDialog)
 from PyQt5.QtGui import QPixmap
-from PyQt5.QtCore import Qt, pyqtSignal
+from PyQt5.QtCore import Qt, pyqtSignal, QTimer, QEvent
 
 # from EMMapWidget import EMMapWidget
 from EMMapEditor import MapEditor, TileModel
-from EMModel import MapModel
+from EMModel import MapModel, GroupModel, TextureModelLoader
 from EMTileEditor import TilePreviewWidget
 from EMHelper import ModelManager, EMImageGenerator
+from EMAutosave import AutosaveService
+from EMMetrics import Metrics
+from EMCache import CacheManager
+from EMExport import VectorExporter, AtlasExporter, DeepZoomExporter
 import math
+import multiprocessing
+import os
+import time
 
 
 class EMMain(QMainWindow):
     """
     The main class for Encounter Mapper.
 
-    Handles the saving and loading of maps. Future implementations may include
-    setting up tabs for maps, enabling multiple encounters to be edited at once
+    Handles the saving and loading of maps. Every encounter that is created
+    or opened gets a tab in the map editor, so several can be edited at once.
+    Saving and exporting apply to the map in the current tab.
+
+    Startup is kept short by only building the title screen up front. The map
+    editor is created the first time an encounter is opened, and the
+    libraries in StartupLibraries are read in the background meanwhile.
     """
 
-    def __init__(self, map=None):
+    StartupLibraries = (
+        (ModelManager.TextureName, TextureModelLoader),
+        (ModelManager.TileName, TileModel),
+        (ModelManager.GroupName, GroupModel)
+    )
+
+    # rows and columns of tile rasters rendered before an opened map shows
+    WarmUpCells = 32
+    # part of the cache budget kept while the window is minimized
+    MinimizedCacheFraction = 0.1
+
+    def __init__(self, map=None, startTime=None):
         super(EMMain, self).__init__()
+        self.startTime = (time.perf_counter() if startTime is None
+                          else startTime)
         if map is None:
             self.model = MapModel()
-        self.mapEditor = MapEditor(self.model)
+        self.mapEditor = None
         self.setWindowTitle("Encounter Mapper")
         # Set Menu Elements
         menuBar = self.menuBar()
@@ -59,13 +85,31 @@ class EMMain(QMainWindow):
         saveAsAction.triggered.connect(self.saveAsEncounter)
         exportImageAction = QAction("Export Map", self)
         exportImageAction.triggered.connect(self.exportEncounterMap)
+        exportVectorAction = QAction("Export Vector Map", self)
+        exportVectorAction.triggered.connect(self.exportVectorMap)
+        exportAtlasAction = QAction("Export Tabletop Atlas", self)
+        exportAtlasAction.triggered.connect(self.exportAtlasMap)
+        exportDeepZoomAction = QAction("Export Deep Zoom", self)
+        exportDeepZoomAction.triggered.connect(self.exportDeepZoomMap)
 
         quitAction = QAction("Quit", self)
 
         undoAction = QAction("Undo", self)
+        undoAction.triggered.connect(self.undoEdit)
         redoAction = QAction("Redo", self)
+        redoAction.triggered.connect(self.redoEdit)
+        cutAction = QAction("Cut", self)
+        cutAction.triggered.connect(self.cutSelection)
+        copyAction = QAction("Copy", self)
+        copyAction.triggered.connect(self.copySelection)
+        pasteAction = QAction("Paste", self)
+        pasteAction.triggered.connect(self.pasteSelection)
 
         self.statusBar()
+        saveQueue = ModelManager.fetchSaveQueue()
+        saveQueue.saveStarted.connect(self.showSaveStarted)
+        saveQueue.saveFinished.connect(self.showSaveFinished)
+        saveQueue.saveFailed.connect(self.showSaveFailed)
 
         fileMenu = menuBar.addMenu("File")
         fileMenu.addAction(newAction)
@@ -74,16 +118,21 @@ class EMMain(QMainWindow):
 
         fileMenu.addAction(saveAsAction)
         fileMenu.addAction(exportImageAction)
+        fileMenu.addAction(exportVectorAction)
+        fileMenu.addAction(exportAtlasAction)
+        fileMenu.addAction(exportDeepZoomAction)
         fileMenu.addAction(quitAction)
 
         editMenu = menuBar.addMenu("Edit")
         editMenu.addAction(undoAction)
         editMenu.addAction(redoAction)
+        editMenu.addAction(cutAction)
+        editMenu.addAction(copyAction)
+        editMenu.addAction(pasteAction)
 
         menuBar.setNativeMenuBar(False)
         self.editStack = QStackedWidget()
         self.editStack.addWidget(self.initialWidget())
-        self.editStack.addWidget(self.mapEditor)
 
         self.setCentralWidget(self.editStack)
 
@@ -93,8 +142,84 @@ class EMMain(QMainWindow):
             (self.saveAsEncounter,),
             Qt.Key_N | Qt.ControlModifier: (self.newEncounterOpenDialog,),
             Qt.Key_O | Qt.ControlModifier: (self.openEncounter,),
+            Qt.Key_Z | Qt.ControlModifier: (self.undoEdit,),
+            Qt.Key_Z | Qt.ControlModifier | Qt.ShiftModifier:
+            (self.redoEdit,),
+            Qt.Key_Y | Qt.ControlModifier: (self.redoEdit,),
         }
 
+    def loadLibraries(self):
+        """Start reading the libraries in the background"""
+        loader = ModelManager.fetchLibraryLoader()
+        loader.finished.connect(self.librariesLoaded)
+        loader.load(self.StartupLibraries)
+
+    def librariesLoaded(self):
+        elapsed = time.perf_counter() - self.startTime
+        Metrics.record("EMMain.timeToInteractive", elapsed)
+        self.statusBar().showMessage(
+            "Ready in {:.0f} ms".format(elapsed * 1000), 3000)
+
+    def firstWindowShown(self):
+        Metrics.record("EMMain.timeToFirstWindow",
+                       time.perf_counter() - self.startTime)
+
+    def fetchMapEditor(self):
+        """Return the map editor, creating it on first use"""
+        if self.mapEditor is None:
+            with Metrics.timer("EMMain.createMapEditor"):
+                self.mapEditor = MapEditor()
+                self.mapEditor.currentMapChanged.connect(self.updateMapTitle)
+                self.editStack.addWidget(self.mapEditor)
+        return self.mapEditor
+
+    def showMapEditor(self, model, path=None, autosaveDirectory=None):
+        """Open model in a new tab of the map editor"""
+        self.model = model
+        self.fetchMapEditor().openMap(self.model, path, autosaveDirectory)
+        self.editStack.setCurrentWidget(self.mapEditor)
+
+    def updateMapTitle(self):
+        model = self.mapEditor.getModel()
+        if model is None:
+            # the last map was closed, so go back to the title screen
+            self.editStack.setCurrentIndex(0)
+            self.setWindowTitle("Encounter Mapper")
+        else:
+            self.model = model
+            path = self.mapEditor.getFilePath()
+            self.setWindowTitle("untitled" if path is None else path[0])
+
+    def recoverAutosave(self):
+        """Offer to restore the maps of a session that did not exit cleanly"""
+        directories = AutosaveService.recoveryDirectories()
+        if len(directories) == 0:
+            return
+        answer = QMessageBox.question(
+            self, "Recover Encounter",
+            "Encounter Mapper did not close properly. Recover the unsaved "
+            "changes to {} encounter(s)?".format(len(directories)))
+        if answer != QMessageBox.Yes:
+            answer = QMessageBox.question(
+                self, "Discard Changes",
+                "Discard the unsaved changes for good? Otherwise recovering "
+                "them is offered again the next time Encounter Mapper "
+                "starts.", QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
+            if answer == QMessageBox.Yes:
+                for directory in directories:
+                    AutosaveService.discardDirectory(directory)
+            return
+        for directory in directories:
+            (model, source) = AutosaveService.recoverModel(directory)
+            if model is not None:
+                # the map takes over the directory it was recovered from
+                self.showMapEditor(
+                    model, None if source is None else (source, ""),
+                    directory)
+                self.mapEditor.markRecovered()
+                self.setWindowTitle("{}*".format(
+                    "untitled" if source is None else source))
+
     def initialWidget(self):
         widget = QWidget()
         layout = QVBoxLayout()
@@ -113,6 +238,50 @@ class EMMain(QMainWindow):
 
         return widget
 
+    def closeEvent(self, event):
+        # Make sure queued saves reach the disk before the window goes away
+        if self.mapEditor is not None:
+            self.mapEditor.discardAutosaves()
+        ModelManager.fetchSaveQueue().waitForIdle()
+        super(EMMain, self).closeEvent(event)
+
+    def undoEdit(self):
+        if self.mapEditor is not None:
+            self.mapEditor.undo()
+
+    def redoEdit(self):
+        if self.mapEditor is not None:
+            self.mapEditor.redo()
+
+    def cutSelection(self):
+        if self.mapEditor is not None:
+            self.mapEditor.cut()
+
+    def copySelection(self):
+        if self.mapEditor is not None:
+            self.mapEditor.copy()
+
+    def pasteSelection(self):
+        if self.mapEditor is not None:
+            self.mapEditor.paste()
+
+    def changeEvent(self, event):
+        if (event.type() == QEvent.WindowStateChange
+                and self.isMinimized()):
+            # nothing is drawn while minimized, so give most memory back
+            CacheManager.shrink(self.MinimizedCacheFraction)
+        super(EMMain, self).changeEvent(event)
+
+    def showSaveStarted(self, path):
+        self.statusBar().showMessage("Saving {}...".format(path))
+
+    def showSaveFinished(self, path):
+        self.statusBar().showMessage("Saved {}".format(path), 3000)
+
+    def showSaveFailed(self, path, error):
+        self.statusBar().showMessage(
+            "Could not save {}: {}".format(path, error))
+
     def keyPressEvent(self, event):
         key = event.key() | int(event.modifiers())
         if key in self.keyBindings:
@@ -145,26 +314,43 @@ class EMMain(QMainWindow):
         self.newEncounterWidget = None
 
         if self.model is not None:
-
-            self.mapEditor.setModel(self.model)
-            self.editStack.setCurrentIndex(1)
+            self.showMapEditor(self.model)
             self.setWindowTitle("untitled*")
 
     def openEncounter(self):
         pathToOpen = QFileDialog.getOpenFileName(self, 'Open File',
                                                  '', "Encounter Map (*.emap)")
         if pathToOpen is not None and pathToOpen[0]:
-            self.model = ModelManager.loadModelFromFile(pathToOpen[0],
-                                                        MapModel)
-            if self.model is not None:
-
-                self.mapEditor.setModel(self.model)
-                self.mapEditor.setFilePath(pathToOpen)
-                self.editStack.setCurrentIndex(1)
+            if (self.mapEditor is not None
+                    and self.mapEditor.findMap(pathToOpen[0])):
+                self.editStack.setCurrentWidget(self.mapEditor)
+                return
+            model = ModelManager.loadModelFromFile(pathToOpen[0], MapModel)
+            if model is not None:
+                self.warmUpCaches(model)
+                self.showMapEditor(model, pathToOpen)
+                self.mapEditor.markEdited(False)
 
                 self.setWindowTitle(pathToOpen[0])
 
+    def warmUpCaches(self, model):
+        """Render what the map needs up front, showing the progress"""
+        progress = QProgressDialog("Preparing tiles...", None, 0, 0, self)
+        progress.setWindowTitle("Opening Encounter")
+        progress.setWindowModality(Qt.WindowModal)
+        progress.setMinimumDuration(250)
+        with Metrics.timer("EMMain.warmUpCaches"):
+            # the editor opens scrolled to the top left corner
+            region = (0, 0, min(model.getNumCols(), self.WarmUpCells),
+                      min(model.getNumRows(), self.WarmUpCells))
+            for (done, total) in EMImageGenerator.warmUp(model, region):
+                progress.setMaximum(total)
+                progress.setValue(done)
+        progress.close()
+
     def saveAsEncounter(self):
+        if self.mapEditor is None or self.mapEditor.getModel() is None:
+            return
         filePath = QFileDialog.getSaveFileName(self, 'Save File',
                                                '', "Encounter Map (*.emap)")
         if filePath is not None:
@@ -177,24 +363,22 @@ class EMMain(QMainWindow):
             if fp.endswith(".emap"):
                 fp = fp[:-5]
             model.setName(fp)
-            modelJS = model.jsonObj()
-            ModelManager.saveJSONToFile(modelJS, filePath[0])
-            # update the string
-            self.mapEditor.markEdited(False)
+            self.mapEditor.saveMap(filePath[0])
             self.setWindowTitle(filePath[0])
 
     def saveEncounter(self):
+        if self.mapEditor is None or self.mapEditor.getModel() is None:
+            return
         fp = self.mapEditor.getFilePath()
         if fp is None:
             self.saveAsEncounter()
         else:
-            model = self.mapEditor.getModel()
-            modelJS = model.jsonObj()
-            ModelManager.saveJSONToFile(modelJS, fp[0])
+            self.mapEditor.saveMap(fp[0])
 
     def exportEncounterMap(self):  # , mods=None):
+        if self.mapEditor is None or self.mapEditor.getModel() is None:
+            return
         modifiers = []
-        print(modifiers)
         filePath = QFileDialog.getSaveFileName(self, "Open Encounter",
                                                "", "Image (*.png)")
         if filePath is not None:
@@ -224,6 +408,51 @@ class EMMain(QMainWindow):
                 else:
                     print("model is not MapModel")
 
+    def exportVectorMap(self):
+        if self.mapEditor is None or self.mapEditor.getModel() is None:
+            return
+        filePath = QFileDialog.getSaveFileName(
+            self, "Export Map", "", "SVG (*.svg);;PDF (*.pdf)")
+        if filePath is not None and filePath[0]:
+            fp = filePath[0]
+            ext = ".pdf" if filePath[1].startswith("PDF") else ".svg"
+            if os.path.splitext(fp)[1].lower() not in (".svg", ".pdf"):
+                fp += ext
+            VectorExporter.exportMap(self.mapEditor.getModel(), fp)
+            self.statusBar().showMessage("Exported {}".format(fp), 3000)
+
+    def exportAtlasMap(self):
+        if self.mapEditor is None or self.mapEditor.getModel() is None:
+            return
+        filePath = QFileDialog.getSaveFileName(
+            self, "Export Tabletop Atlas", "", "Atlas Manifest (*.json)")
+        if filePath is not None and filePath[0]:
+            fp = filePath[0]
+            if not fp.endswith(".json"):
+                fp += ".json"
+            AtlasExporter.exportMap(self.mapEditor.getModel(), fp)
+            self.statusBar().showMessage("Exported {}".format(fp), 3000)
+
+    def exportDeepZoomMap(self):
+        if self.mapEditor is None or self.mapEditor.getModel() is None:
+            return
+        filePath = QFileDialog.getSaveFileName(
+            self, "Export Deep Zoom", "", "Deep Zoom Image (*.dzi)")
+        if filePath is not None and filePath[0]:
+            fp = filePath[0]
+            if not fp.endswith(".dzi"):
+                fp += ".dzi"
+            progress = QProgressDialog("Rendering tiles...", None, 0, 0, self)
+            progress.setWindowTitle("Export Deep Zoom")
+            progress.setWindowModality(Qt.WindowModal)
+            progress.setMinimumDuration(250)
+            for (done, total) in DeepZoomExporter.exportMap(
+                    self.mapEditor.getModel(), fp):
+                progress.setMaximum(total)
+                progress.setValue(done)
+            progress.close()
+            self.statusBar().showMessage("Exported {}".format(fp), 3000)
+
 
 class NewMapDialog(QWidget):
     creatingNewMap = pyqtSignal()
@@ -280,7 +509,6 @@ class NewMapDialog(QWidget):
         tileUid = -1
         if self.tileToPopulate.currentIndex() > 0:
             tileUid = self.tiles[self.tileToPopulate.currentIndex()-1].getUid()
-        print(tileUid)
         grid = []
         for y in range(numRows):
             grid.append([])
@@ -291,7 +519,20 @@ class NewMapDialog(QWidget):
         return model
 
 
-app = QApplication([])
-mainWindow = EMMain()
-mainWindow.show()
-app.exec_()
+def main():
+    startTime = time.perf_counter()
+    app = QApplication([])
+    mainWindow = EMMain(startTime=startTime)
+    mainWindow.show()
+    # runs once the event loop has drawn the window
+    QTimer.singleShot(0, mainWindow.firstWindowShown)
+    mainWindow.loadLibraries()
+    mainWindow.recoverAutosave()
+    app.exec_()
+
+
+if __name__ == "__main__":
+    # the export workers are spawned by running this program again, which
+    # in a frozen build must start a worker rather than the editor
+    multiprocessing.freeze_support()
+    main()
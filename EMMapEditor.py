@@ -20,16 +20,79 @@ If not, see <https://www.gnu.org/licenses/>.
 """
 
 from PyQt5.QtWidgets import (QApplication, QLabel, QScrollArea,
-                             QGridLayout, QTabWidget, QWidget, QPushButton)
-from PyQt5.QtCore import Qt, pyqtSignal
-from PyQt5.QtGui import QPainter, QPalette
+                             QGridLayout, QTabWidget, QWidget, QPushButton,
+                             QMessageBox)
+from PyQt5.QtCore import Qt, pyqtSignal, QRect
+from PyQt5.QtGui import QPainter, QPalette, QPen
 
 from EMTileEditor import TileEditor, TilePreviewWidget
 from EMModel import TileModel, GroupModel, MapModel
 from EMHelper import ModelManager, EMImageGenerator
+from EMMetrics import Metrics
 from EMGroupEditor import GroupEditor, GroupPreview
 from EMBaseClasses import EMModelGraphics, EMModelPicker
 from EMNotesTab import NotesTab
+from EMAutosave import AutosaveService
+from EMCache import CacheManager
+import os
+
+
+class MapDocument(object):
+    """
+    A map open in the MapEditor, with everything that belongs to it alone:
+    the graphics and scroll area showing it, the file it was saved to and
+    its autosave. Libraries, pickers and rendered images are shared by all
+    open maps.
+    """
+
+    def __init__(self, model, autosaveDirectory):
+        self.model = model
+        self.filePath = None
+        self.edited = False
+        # counts every edit, to tell whether a finished save is still current
+        self.edits = 0
+        self.autosaveDirectory = autosaveDirectory
+        self.autosave = AutosaveService(model, autosaveDirectory)
+
+        self.graphics = MapEditorGraphics(model)
+        self.scrollArea = QScrollArea()
+        self.scrollArea.setWidget(self.graphics)
+        self.scrollArea.setBackgroundRole(QPalette.Dark)
+        self.scrollArea.setAlignment(Qt.AlignCenter)
+        self.scrollArea.setMinimumWidth(500)
+        self.scrollArea.setMinimumHeight(500)
+        self.trackEdits(model)
+
+    def setModel(self, model):
+        self.untrackEdits(self.model)
+        self.model = model
+        self.graphics.setModel(model)
+        self.autosave.setModel(model)
+        self.trackEdits(model)
+
+    def trackEdits(self, model):
+        model.tilesChanged.connect(self.markEdited)
+        model.gridResized.connect(self.markEdited)
+        model.notesChanged.connect(self.markEdited)
+
+    def untrackEdits(self, model):
+        model.tilesChanged.disconnect(self.markEdited)
+        model.gridResized.disconnect(self.markEdited)
+        model.notesChanged.disconnect(self.markEdited)
+
+    def markEdited(self, *args):
+        self.edited = True
+        self.edits += 1
+
+    def getName(self):
+        if self.filePath is not None and self.filePath[0]:
+            return os.path.basename(self.filePath[0])
+        return self.model.getName()
+
+    def close(self):
+        self.untrackEdits(self.model)
+        self.autosave.close()
+        self.graphics.releaseImages()
 
 
 class MapEditor(QWidget):
@@ -37,43 +100,60 @@ class MapEditor(QWidget):
     Editor to create maps from tiles, objects, and notes. This class primarily
     handles the context switches whenever a new tab is selected from the tab
     bar.
+
+    Every open map gets a tab of its own (see MapDocument), while the tile,
+    group and notes tabs on the side work on whichever map is current. All
+    maps draw from the same libraries and image caches, so opening another
+    map only costs memory for the tiles it uses that are not on screen
+    already. Background tabs give up their selection previews to the
+    current one.
+
+    Signals
+    -------
+    currentMapChanged: Emitted when another map becomes current, or the last
+    one is closed.
     """
 
-    def __init__(self, model=None):
+    AutosaveSlotName = "map_{}"
+
+    currentMapChanged = pyqtSignal()
+
+    def __init__(self, model=None, autosaveRoot=None):
         # Set ui in here
         super(MapEditor, self).__init__()
+        # the autosave directories of the open maps go in here
+        self.autosaveRoot = (ModelManager.resourcePath("autosave")
+                             if autosaveRoot is None else autosaveRoot)
         layout = QGridLayout()
-        # Create a tab widget
-        self.model = MapModel() if model is None else model
-        self.model.modelUpdated.connect(self.updateUI)
+        self.documents = []
+        self.document = None
+        self.model = None
+        self.mapEditGraphics = None
+        # path -> [(document, edits)] of the saves queued for it, in order
+        self.pendingSaves = {}
+        saveQueue = ModelManager.fetchSaveQueue()
+        saveQueue.saveFinished.connect(self.saveFinished)
+        saveQueue.saveFailed.connect(self.saveFailed)
 
         self.mouseOverItem = None
         self.pressedItem = None
-        self.filePathOfModel = None
 
-        self.mapEditGraphics = MapEditorGraphics(self.model)
-        self.mapEditGraphics.updatePreview.connect(self.updateUI)
-        self.mapEditGraphics.selectedItem.connect(self.updateSelection)
-
-        # Add Scrollable area for groupPreview
-        self.scrollArea = QScrollArea()
-        self.scrollArea.setWidget(self.mapEditGraphics)
-        self.scrollArea.setBackgroundRole(QPalette.Dark)
-        self.scrollArea.setAlignment(Qt.AlignCenter)
-        self.scrollArea.setMinimumWidth(500)
-        self.scrollArea.setMinimumHeight(500)
+        self.mapTabs = QTabWidget()
+        self.mapTabs.setTabsClosable(True)
+        self.mapTabs.setMovable(True)
+        self.mapTabs.setDocumentMode(True)
+        self.mapTabs.currentChanged.connect(self.selectMap)
+        self.mapTabs.tabCloseRequested.connect(self.closeMap)
 
+        # Create a tab widget
         self.tabWidget = QTabWidget()
-        self.tabWidget.currentChanged.connect(
-            self.mapEditGraphics.updateSelectedTab)
+        self.tabWidget.currentChanged.connect(self.updateSelectedTab)
         self.tilePicker = EMModelPicker(ModelManager.TileName, TileModel,
                                         TileEditor, TilePreviewWidget)
-        self.tilePicker.selectedModel.connect(
-            self.mapEditGraphics.updateSelectedObject)
+        self.tilePicker.selectedModel.connect(self.updateSelectedObject)
         self.groupPicker = EMModelPicker(ModelManager.GroupName, GroupModel,
                                          GroupEditor, GroupPreview)
-        self.groupPicker.selectedModel.connect(
-            self.mapEditGraphics.updateSelectedObject)
+        self.groupPicker.selectedModel.connect(self.updateSelectedObject)
 
         self.notesWidget = NotesTab()
         self.notesWidget.setCurrentEditor(self)
@@ -103,6 +183,15 @@ class MapEditor(QWidget):
         self.addColBtn.clicked.connect(self.addGroupCol)
         self.delColBtn = QPushButton("Del Col")
         self.delColBtn.clicked.connect(self.delGroupCol)
+        self.fillBtn = QPushButton("Fill")
+        self.fillBtn.setCheckable(True)
+        self.fillBtn.clicked.connect(self.toggleFloodFill)
+        self.rectFillBtn = QPushButton("Rect Fill")
+        self.rectFillBtn.setCheckable(True)
+        self.rectFillBtn.clicked.connect(self.toggleRectFill)
+        self.selectBtn = QPushButton("Select")
+        self.selectBtn.setCheckable(True)
+        self.selectBtn.clicked.connect(self.toggleSelect)
 
         btnLayout.addWidget(self.cwBtn, 0, 0)
         btnLayout.addWidget(self.ccwBtn, 1, 0)
@@ -112,54 +201,275 @@ class MapEditor(QWidget):
         btnLayout.addWidget(self.delRowBtn, 1, 2)
         btnLayout.addWidget(self.addColBtn, 0, 3)
         btnLayout.addWidget(self.delColBtn, 1, 3)
+        btnLayout.addWidget(self.fillBtn, 0, 4)
+        btnLayout.addWidget(self.rectFillBtn, 1, 4)
+        btnLayout.addWidget(self.selectBtn, 0, 5)
         self.btnGroup.setLayout(btnLayout)
 
-        layout.addWidget(self.scrollArea, 0, 0)
+        layout.addWidget(self.mapTabs, 0, 0)
         layout.addWidget(self.tabWidget, 0, 1, 2, 1)
         layout.addWidget(self.btnGroup, 1, 0)
         self.setLayout(layout)
 
+        if model is not None:
+            self.openMap(model)
+
+    """
+    *-----------*
+    |Map Methods|
+    *-----------*
+    """
+
+    def openMap(self, model, path=None, autosaveDirectory=None):
+        """
+        Open model in a new tab and make it the current map. A map recovered
+        from an autosave passes the directory it came from to take it over.
+        """
+        if autosaveDirectory is None:
+            autosaveDirectory = self.autosaveDirectory()
+        document = MapDocument(model, autosaveDirectory)
+        document.filePath = path
+        document.graphics.updatePreview.connect(self.updateUI)
+        document.graphics.selectedItem.connect(self.updateSelection)
+        model.modelUpdated.connect(self.updateUI)
+        ModelManager.registerMap(model)
+        self.documents.append(document)
+        index = self.mapTabs.addTab(document.scrollArea, document.getName())
+        self.mapTabs.setCurrentIndex(index)
+        return document
+
+    def autosaveDirectory(self):
+        # every open map autosaves to a directory of its own
+        used = [document.autosaveDirectory for document in self.documents]
+        slot = 0
+        while True:
+            directory = os.path.join(
+                self.autosaveRoot, self.AutosaveSlotName.format(slot))
+            # unsaved changes left by a crash belong to the map recovered
+            # from them, even if the user has not recovered it yet
+            if (directory not in used
+                    and not AutosaveService.hasRecovery(directory)):
+                return directory
+            slot += 1
+
+    def documentAt(self, index):
+        widget = self.mapTabs.widget(index)
+        for document in self.documents:
+            if document.scrollArea is widget:
+                return document
+        return None
+
+    def findMap(self, path):
+        """Make the map saved to path current, if it is open"""
+        for document in self.documents:
+            if document.filePath is not None and document.filePath[0] == path:
+                self.mapTabs.setCurrentWidget(document.scrollArea)
+                return True
+        return False
+
+    def selectMap(self, index):
+        document = self.documentAt(index)
+        previous = self.document
+        if document is previous:
+            return
+        if document is not None and previous is not None:
+            document.graphics.takeSelection(previous.graphics)
+        self.document = document
+        if document is None:
+            self.model = None
+            self.mapEditGraphics = None
+        else:
+            self.model = document.model
+            self.mapEditGraphics = document.graphics
+            self.mapEditGraphics.updateSelectedTab(
+                self.tabWidget.currentIndex())
+            self.mapEditGraphics.setFocus()
+            self.updateUI()
+        self.notesWidget.populateList(self.getNotes())
+        self.currentMapChanged.emit()
+
+    def closeMap(self, index):
+        document = self.documentAt(index)
+        if document is None:
+            return False
+        if document.edited:
+            answer = QMessageBox.question(
+                self, "Close Encounter",
+                "{} has unsaved changes. Close it anyway?".format(
+                    document.getName()))
+            if answer != QMessageBox.Yes:
+                return False
+        document.graphics.updatePreview.disconnect(self.updateUI)
+        document.graphics.selectedItem.disconnect(self.updateSelection)
+        document.model.modelUpdated.disconnect(self.updateUI)
+        ModelManager.unregisterMap(document.model)
+        self.documents.remove(document)
+        self.mapTabs.removeTab(self.mapTabs.indexOf(document.scrollArea))
+        if self.document is document:
+            # removing the tab already made another map current, unless it
+            # was the last one
+            self.selectMap(self.mapTabs.currentIndex())
+        document.close()
+        document.scrollArea.deleteLater()
+        # the images only the closed map used are likely the least recently
+        # used ones
+        CacheManager.shrink()
+        return True
+
+    def discardAutosaves(self):
+        for document in self.documents:
+            document.autosave.discard()
+
     def getModel(self):
         return self.model
 
     def setModel(self, model):
+        """Show model in place of the current map"""
+        if self.document is None:
+            self.openMap(model)
+            return
+        ModelManager.unregisterMap(self.model)
+        self.model.modelUpdated.disconnect(self.updateUI)
         self.model = model
-        self.mapEditGraphics.setModel(model)
+        ModelManager.registerMap(self.model)
+        self.document.setModel(model)
         self.model.modelUpdated.connect(self.updateUI)
+        self.notesWidget.populateList(self.getNotes())
         self.updateUI()
 
     def markEdited(self, edited=False):
-        self.edited = edited
+        if self.document is None:
+            return
+        self.document.edited = edited
+        if not edited and self.document.filePath is not None:
+            # the file on disk is current again, so autosave only has to
+            # track changes made from here on
+            self.document.autosave.markSaved(self.document.filePath[0])
+
+    def markRecovered(self):
+        """The current map was restored from an autosave and is unsaved"""
+        if self.document is None:
+            return
+        self.markEdited(True)
+        path = self.document.filePath
+        self.document.autosave.markRecovered(
+            None if path is None else path[0])
+
+    def saveMap(self, path):
+        """
+        Queue a save of the current map to path. The map counts as saved
+        once the file has been written, unless it was edited in between.
+        """
+        if self.document is None:
+            return
+        pending = self.pendingSaves.setdefault(
+            ModelManager.resourcePath(path), [])
+        pending.append((self.document, self.document.edits))
+        ModelManager.saveMapToFile(self.model, path)
+
+    def saveFinished(self, path):
+        if path not in self.pendingSaves:
+            return
+        document, edits = self.popPendingSave(path)
+        if document in self.documents and document.edits == edits:
+            document.edited = False
+            # the file on disk is current again, so autosave only has to
+            # track changes made from here on
+            document.autosave.markSaved(path)
+
+    def saveFailed(self, path, error):
+        # the map keeps counting as edited
+        if path in self.pendingSaves:
+            self.popPendingSave(path)
+
+    def popPendingSave(self, path):
+        pending = self.pendingSaves[path]
+        save = pending.pop(0)
+        if len(pending) == 0:
+            del self.pendingSaves[path]
+        return save
 
     def getFilePath(self):
-        return self.filePathOfModel
+        return None if self.document is None else self.document.filePath
 
     def setFilePath(self, path):
-        self.filePathOfModel = path
+        if self.document is not None:
+            self.document.filePath = path
+            self.mapTabs.setTabText(
+                self.mapTabs.indexOf(self.document.scrollArea),
+                self.document.getName())
+
+    def updateSelectedTab(self, index):
+        if self.mapEditGraphics is not None:
+            self.mapEditGraphics.updateSelectedTab(index)
+
+    def updateSelectedObject(self, uid):
+        if self.mapEditGraphics is not None:
+            self.mapEditGraphics.updateSelectedObject(uid)
 
     def rotateTileMapCW(self):
-        self.mapEditGraphics.transformS("cw")
+        if self.mapEditGraphics is not None:
+            self.mapEditGraphics.transformS("cw")
 
     def rotateTileMapCCW(self):
-        self.mapEditGraphics.transformS("ccw")
+        if self.mapEditGraphics is not None:
+            self.mapEditGraphics.transformS("ccw")
 
     def flipTileMapH(self):
-        self.mapEditGraphics.transformS("h")
+        if self.mapEditGraphics is not None:
+            self.mapEditGraphics.transformS("h")
 
     def flipTileMapV(self):
-        self.mapEditGraphics.transformS("v")
+        if self.mapEditGraphics is not None:
+            self.mapEditGraphics.transformS("v")
+
+    def toggleFloodFill(self):
+        if self.mapEditGraphics is not None:
+            self.mapEditGraphics.toggleTool("flood")
+
+    def toggleRectFill(self):
+        if self.mapEditGraphics is not None:
+            self.mapEditGraphics.toggleTool("rect")
+
+    def toggleSelect(self):
+        if self.mapEditGraphics is not None:
+            self.mapEditGraphics.toggleTool("select")
+
+    def undo(self):
+        if self.mapEditGraphics is not None:
+            self.mapEditGraphics.undo()
+
+    def redo(self):
+        if self.mapEditGraphics is not None:
+            self.mapEditGraphics.redo()
+
+    def cut(self):
+        if self.mapEditGraphics is not None:
+            self.mapEditGraphics.cutSelected()
+
+    def copy(self):
+        if self.mapEditGraphics is not None:
+            self.mapEditGraphics.copySelected()
+
+    def paste(self):
+        if self.mapEditGraphics is not None:
+            self.mapEditGraphics.pasteClipboard()
 
     def addGroupRow(self):
-        self.model.addRow()
+        if self.model is not None:
+            self.model.addRow()
 
     def addGroupCol(self):
-        self.model.addCol()
+        if self.model is not None:
+            self.model.addCol()
 
     def delGroupRow(self):
-        self.model.delRow()
+        if self.model is not None:
+            self.model.delRow()
 
     def delGroupCol(self):
-        self.model.delCol()
+        if self.model is not None:
+            self.model.delCol()
 
     def updateSelection(self, tab, id):
         if tab == 3:
@@ -172,7 +482,7 @@ class MapEditor(QWidget):
     """
 
     def getNotes(self):
-        return self.model.getMapNotes()
+        return [] if self.model is None else self.model.getMapNotes()
 
     def addNote(self, note, index=-1, x=-1, y=-1):
         # Since this is a new note, begin in the center
@@ -190,7 +500,7 @@ class MapEditor(QWidget):
     def updateNotePosition(self, index, x, y):
         note = self.model.getMapNotes()[index]
         note.setPos(x, y)
-        self.updateMapNote(note, index)
+        self.model.updateMapNote(note, index)
 
     """
     *----------*
@@ -199,19 +509,24 @@ class MapEditor(QWidget):
     """
 
     def updateUI(self):
+        if self.document is None:
+            return
         # update Buttons
         options = self.mapEditGraphics.getSOptions()
         self.hfBtn.setChecked(options[1])
         self.vfBtn.setChecked(options[2])
         self.btnGroup.repaint()
+        self.fillBtn.setChecked(self.mapEditGraphics.tool == "flood")
+        self.rectFillBtn.setChecked(self.mapEditGraphics.tool == "rect")
+        self.selectBtn.setChecked(self.mapEditGraphics.tool == "select")
         # self.modelNameEdit.setText(self.model.getName())
-        # update the preview
-        # self.mapEditGraphics.calculateOffsets()
-        self.mapEditGraphics.calculateSize()
-        self.mapEditGraphics.repaint()
+        # the graphics repaint the cells that change themselves, so large
+        # edits don't cause a repaint of the whole map here
 
         # Update the name of the thing
         self.setWindowTitle(self.model.getName())
+        self.mapTabs.setTabText(self.mapTabs.indexOf(self.document.scrollArea),
+                                self.document.getName())
 
 
 class MapEditorGraphics(EMModelGraphics):
@@ -219,10 +534,33 @@ class MapEditorGraphics(EMModelGraphics):
     """
     Graphical Representation of the mpap object. Similar to the Group Editor,
     but also contains means to interact with notes, etc.
+
+    Besides painting single cells, a tool can be set. With a tile selected,
+    "flood" fills the area of matching tiles around the pressed cell and
+    "rect" the rectangle dragged out from it. "select" drags out an area of
+    the map, which can then be moved by dragging it, rotated and flipped
+    like a group, or cut, copied, pasted and cleared. The clipboard is
+    shared by all maps.
+
+    Every edit is a single bulk write to the model, which only repaints the
+    cells that changed, and is one entry on the undo stack. Removing rows or
+    columns clears the undo history.
     """
 
     updatePreview = pyqtSignal()
 
+    UndoLimit = 100
+    EmptyTile = (-1, 0, False, False)
+    TransformOptions = {
+        "cw": [1, False, False],
+        "ccw": [3, False, False],
+        "h": [0, True, False],
+        "v": [0, False, True]
+    }
+
+    # GroupModel of the cells last cut or copied
+    clipboard = None
+
     def __init__(self, model=None):
         super(MapEditorGraphics, self).__init__(
             model, model.getNumRows(), model.getNumCols())
@@ -234,6 +572,21 @@ class MapEditorGraphics(EMModelGraphics):
         self.mousePosition = (-1, -1)
         self.mouseOverItem = None
         self.pressedItem = None
+        # area painted at draft quality, refined once the user is idle
+        self.draftRect = QRect()
+        self.tool = None
+        self.fillStart = None
+        # (x0, y0, x1, y1) of the selected area, inclusive
+        self.selectedArea = None
+        self.selectStart = None
+        self.moveStart = None
+        # undo entries are (cells, tiles before, tiles after)
+        self.undoStack = []
+        self.redoStack = []
+        self.stroke = None
+        self.gridSize = (model.getNumRows(), model.getNumCols())
+        self.watchModel(model)
+        self.calculateSize()
 
         self.keyBindings = {
             Qt.Key_R: (self.transformS, "cw"),
@@ -242,17 +595,231 @@ class MapEditorGraphics(EMModelGraphics):
             Qt.Key_F | Qt.ShiftModifier: (self.transformS, "v"),
             Qt.Key_0: (self.updateZoom, 5),
             Qt.Key_Minus: (self.updateZoom, -5),
+            Qt.Key_B: (self.toggleTool, "flood"),
+            Qt.Key_B | Qt.ShiftModifier: (self.toggleTool, "rect"),
+            Qt.Key_S: (self.toggleTool, "select"),
+            Qt.Key_C | Qt.ControlModifier: (self.copySelected,),
+            Qt.Key_X | Qt.ControlModifier: (self.cutSelected,),
+            Qt.Key_V | Qt.ControlModifier: (self.pasteClipboard,),
+            Qt.Key_Delete: (self.clearSelected,),
+            Qt.Key_Escape: (self.setSelectedArea, None),
         }
 
     def setModel(self, model):
+        self.unwatchModel(self.model)
         self.model = model
+        self.watchModel(model)
+        self.undoStack = []
+        self.redoStack = []
+        self.selectedArea = None
+        self.gridSize = (model.getNumRows(), model.getNumCols())
         self.rows = model.getNumRows()
         self.cols = model.getNumCols()
+        self.calculateSize()
         self.repaint()
 
+    def watchModel(self, model):
+        model.tilesChanged.connect(self.updateCells)
+        model.gridResized.connect(self.updateGrid)
+        model.notesChanged.connect(self.updateNotes)
+
+    def unwatchModel(self, model):
+        model.tilesChanged.disconnect(self.updateCells)
+        model.gridResized.disconnect(self.updateGrid)
+        model.notesChanged.disconnect(self.updateNotes)
+
+    def updateCells(self, x, y, w, h):
+        """Schedule a repaint of just the cells that changed"""
+        self.update(self.cellRect(x, y, w, h))
+
+    def updateGrid(self):
+        rows = self.model.getNumRows()
+        cols = self.model.getNumCols()
+        if rows < self.gridSize[0] or cols < self.gridSize[1]:
+            # undo entries and the selection refer to cells by position, and
+            # some of those cells are gone now
+            self.undoStack = []
+            self.redoStack = []
+            self.selectedArea = None
+        self.gridSize = (rows, cols)
+        self.calculateSize()
+        self.update()
+
+    def updateNotes(self, first, last):
+        self.update()
+
+    def cellRect(self, x, y, w, h):
+        # one pixel wider and higher, to include the grid lines at the edge
+        left = int(self.xOffset + x * self.tileSize)
+        top = int(self.yOffset + y * self.tileSize)
+        right = int(self.xOffset + (x + w) * self.tileSize) + 1
+        bottom = int(self.yOffset + (y + h) * self.tileSize) + 1
+        return QRect(left, top, right - left + 1, bottom - top + 1)
+
+    def toggleTool(self, mode):
+        self.tool = None if self.tool == mode else mode
+        self.fillStart = None
+        if self.tool != "select":
+            self.setSelectedArea(None)
+        self.updatePreview.emit()
+
+    """
+    *------------*
+    |Edit Methods|
+    *------------*
+    """
+
+    def applyEdit(self, cells, tiles):
+        """Set cells to tiles in one write that can be undone"""
+        if len(cells) == 0:
+            return
+        before = self.model.getTiles(cells)
+        self.model.setTiles(cells, tiles)
+        self.pushUndo((cells, before, tiles))
+
+    def pushUndo(self, entry):
+        self.undoStack.append(entry)
+        if len(self.undoStack) > self.UndoLimit:
+            self.undoStack.pop(0)
+        self.redoStack = []
+
+    def undo(self):
+        if len(self.undoStack) > 0:
+            cells, before, after = self.undoStack.pop()
+            self.model.setTiles(cells, before)
+            self.redoStack.append((cells, before, after))
+
+    def redo(self):
+        if len(self.redoStack) > 0:
+            cells, before, after = self.redoStack.pop()
+            self.model.setTiles(cells, after)
+            self.undoStack.append((cells, before, after))
+
+    def paintCell(self, x, y, tile):
+        # cells painted while the mouse is down are undone together
+        if self.stroke is not None and (x, y) not in self.stroke:
+            self.stroke[(x, y)] = self.model.getTileGrid()[y][x]
+        self.model.setTileForIndex(x, y, tile)
+
+    def endStroke(self):
+        if self.stroke is not None and len(self.stroke) > 0:
+            cells = list(self.stroke)
+            self.pushUndo((cells, list(self.stroke.values()),
+                           self.model.getTiles(cells)))
+        self.stroke = None
+
+    def writeBlock(self, x, y, block, clear=None):
+        """
+        Write the rows of tiles in block with their top left at (x, y), as
+        one edit. The cells in the clear area (x0, y0, x1, y1) that the block
+        does not cover are emptied. Returns the area the block landed on,
+        clipped to the map.
+        """
+        edit = {}
+        if clear is not None:
+            for cell in self.model.rectCells(*clear):
+                edit[cell] = self.EmptyTile
+        nc = self.model.getNumCols()
+        nr = self.model.getNumRows()
+        for (by, row) in enumerate(block):
+            for (bx, tile) in enumerate(row):
+                if 0 <= x + bx < nc and 0 <= y + by < nr:
+                    edit[(x + bx, y + by)] = tuple(tile)
+        self.applyEdit(list(edit), list(edit.values()))
+        if len(block) == 0 or len(block[0]) == 0:
+            return None
+        area = (max(0, x), max(0, y), min(nc - 1, x + len(block[0]) - 1),
+                min(nr - 1, y + len(block) - 1))
+        return None if area[0] > area[2] or area[1] > area[3] else area
+
+    """
+    *-----------------*
+    |Selection Methods|
+    *-----------------*
+    """
+
+    def setSelectedArea(self, area):
+        if self.selectedArea is not None:
+            self.updateArea(self.selectedArea)
+        self.selectedArea = area
+        if area is not None:
+            self.updateArea(area)
+
+    def updateArea(self, area):
+        self.updateCells(area[0], area[1], area[2] - area[0] + 1,
+                         area[3] - area[1] + 1)
+
+    def inSelectedArea(self, index):
+        area = self.selectedArea
+        return (area is not None and area[0] <= index[0] <= area[2]
+                and area[1] <= index[1] <= area[3])
+
+    def selectedBlock(self):
+        area = self.selectedArea
+        return self.model.copyRegion(area[0], area[1], area[2], area[3])
+
+    def copySelected(self):
+        if self.selectedArea is not None:
+            MapEditorGraphics.clipboard = self.selectedBlock()
+
+    def cutSelected(self):
+        if self.selectedArea is not None:
+            self.copySelected()
+            self.clearSelected()
+
+    def clearSelected(self):
+        if self.selectedArea is not None:
+            cells = self.model.rectCells(*self.selectedArea)
+            self.applyEdit(cells, [self.EmptyTile] * len(cells))
+
+    def pasteClipboard(self):
+        """Paste at the mouse, or else over the selected area"""
+        if self.clipboard is None:
+            return
+        if self.mouseIndex != (-1, -1):
+            x, y = self.mouseIndex
+        elif self.selectedArea is not None:
+            x, y = self.selectedArea[0], self.selectedArea[1]
+        else:
+            x, y = 0, 0
+        self.tool = "select"
+        self.setSelectedArea(
+            self.writeBlock(x, y, self.clipboard.getTileGrid()))
+        self.updatePreview.emit()
+
+    def moveSelected(self, dx, dy):
+        area = self.selectedArea
+        self.setSelectedArea(self.writeBlock(
+            area[0] + dx, area[1] + dy, self.selectedBlock().getTileGrid(),
+            area))
+
+    def transformSelected(self, type):
+        """Rotate or flip the selected area around its top left corner"""
+        area = self.selectedArea
+        block = GroupModel.createModelTransform(
+            self.selectedBlock(), self.TransformOptions[type])
+        self.setSelectedArea(self.writeBlock(
+            area[0], area[1], block.getTileGrid(), area))
+
     def updateSelectedTab(self, index):
         self.openTab = index
 
+    def takeSelection(self, other):
+        """
+        Take over the selected tile or group, its transform and previews
+        from the graphics of another map, which no longer needs them
+        """
+        self.selectedObject = list(other.selectedObject)
+        self.sOptions = list(other.sOptions)
+        self.selectedGroup = other.selectedGroup
+        self.selectedModelImages = other.selectedModelImages
+        self.tool = other.tool
+        other.releaseImages()
+
+    def releaseImages(self):
+        self.selectedGroup = None
+        self.selectedModelImages = [None, None]
+
     def updateSelectedObject(self, uid, objNum=-1):
         self.selectedObject[self.openTab] = uid
         tab = self.openTab if objNum == -1 else objNum
@@ -289,6 +856,9 @@ class MapEditorGraphics(EMModelGraphics):
         return (midIndex[0] + edits[0], midIndex[1] + edits[1])
 
     def transformS(self, type):
+        if self.tool == "select" and self.selectedArea is not None:
+            self.transformSelected(type)
+            return
         if type == "cw":
             self.sOptions[0] = (self.sOptions[0] + 1) % 4
         elif type == "ccw":
@@ -304,23 +874,38 @@ class MapEditorGraphics(EMModelGraphics):
                 ModelManager.fetchByUid(ModelManager.TileName,
                                         self.selectedObject[0]),
                 {"transformOptions": self.sOptions})
+        self.update()
         self.updatePreview.emit()
 
+    @Metrics.timed("MapEditorGraphics.paintEvent")
     def paintEvent(self, paintEvent):
         painter = QPainter(self)
         if(self.model is not None):
             nr = self.model.getNumRows()
             nc = self.model.getNumCols()
 
-            img = EMImageGenerator.genImageFromModel(self.model)
-
-            painter.drawImage(0, 0,
-                              img.scaled(self.width, self.height))
+            # Only draw the cells that are exposed, so large maps only read
+            # and render the part of the grid that is on screen
+            region = self.visibleRegion(paintEvent.rect())
+            if self.draft:
+                self.draftRect = self.draftRect.united(paintEvent.rect())
+            painter.setRenderHint(QPainter.SmoothPixmapTransform,
+                                  not self.draft)
+            painter.save()
+            painter.scale(self.tileSize/216, self.tileSize/216)
+            EMImageGenerator.drawTileGroup(painter, self.model, region,
+                                           self.draft)
+            painter.restore()
             EMImageGenerator.drawGrid(painter, nc, nr,
                                       self.xOffset, self.yOffset,
                                       self.tileSize)
 
-            if self.mouseIndex != (-1, -1) and not self.mousePressed:
+            if self.selectedArea is not None:
+                self.drawSelectedArea(painter)
+            if self.fillStart is not None and self.mouseIndex != (-1, -1):
+                self.drawFillRect(painter)
+            elif (self.mouseIndex != (-1, -1) and not self.mousePressed
+                    and self.tool != "select"):
                 if self.openTab == 0 and self.selectedObject[0] != -1:
                     self.drawPreviewTileSingle(painter)
                 elif self.openTab == 1 and self.selectedObject[1] != -1:
@@ -337,7 +922,6 @@ class MapEditorGraphics(EMModelGraphics):
                     np = (int(np[0] * self.tileSize),
                           int(np[1] * self.tileSize))
                     options = []
-                    print(self.mouseOverItem)
                     if (self.mouseOverItem is not None
                         and self.mouseOverItem[0] == 3
                             and self.mouseOverItem[1] == index):
@@ -358,17 +942,63 @@ class MapEditorGraphics(EMModelGraphics):
                         painter, note, np[0]-24,
                         np[1]-24, 48, notes.index(note) + 1, ["selected"])
 
+    def endDraft(self):
+        self.draft = False
+        if not self.draftRect.isNull():
+            self.update(self.draftRect)
+        self.draftRect = QRect()
+
+    def updateZoom(self, dz):
+        self.beginDraft()
+        super(MapEditorGraphics, self).updateZoom(dz)
+
+    def visibleRegion(self, rect):
+        nr = self.model.getNumRows()
+        nc = self.model.getNumCols()
+        return (max(0, int(rect.left() / self.tileSize)),
+                max(0, int(rect.top() / self.tileSize)),
+                min(nc, int(rect.right() / self.tileSize) + 1),
+                min(nr, int(rect.bottom() / self.tileSize) + 1))
+
+    def drawFillRect(self, painter):
+        x0 = min(self.fillStart[0], self.mouseIndex[0])
+        y0 = min(self.fillStart[1], self.mouseIndex[1])
+        x1 = max(self.fillStart[0], self.mouseIndex[0])
+        y1 = max(self.fillStart[1], self.mouseIndex[1])
+        EMImageGenerator.drawGrid(
+            painter, x1 - x0 + 1, y1 - y0 + 1,
+            int(self.xOffset + self.tileSize * x0),
+            int(self.yOffset + self.tileSize * y0),
+            self.tileSize, Qt.red)
+
+    def drawSelectedArea(self, painter):
+        area = self.selectedArea
+        if self.moveStart is not None and self.mouseIndex != (-1, -1):
+            # show where the area will land while it is dragged
+            dx = self.mouseIndex[0] - self.moveStart[0]
+            dy = self.mouseIndex[1] - self.moveStart[1]
+            area = (area[0] + dx, area[1] + dy, area[2] + dx, area[3] + dy)
+        rect = self.cellRect(area[0], area[1], area[2] - area[0] + 1,
+                             area[3] - area[1] + 1)
+        painter.setPen(QPen(Qt.blue, 2, Qt.DashLine))
+        painter.setBrush(Qt.NoBrush)
+        painter.drawRect(rect.adjusted(1, 1, -2, -2))
+
+    def selectedTile(self):
+        return (self.selectedObject[0], self.sOptions[0],
+                self.sOptions[1], self.sOptions[2])
+
     def drawPreviewTileSingle(self, painter):
         if self.selectedModelImages[0] is not None:
             point = (int(self.xOffset + (self.tileSize * self.mouseIndex[0])),
                      int(self.yOffset + (self.tileSize * self.mouseIndex[1])))
             painter.drawImage(point[0], point[1],
                               self.selectedModelImages[0].scaled(
-                self.tileSize, self.tileSize))
+                int(self.tileSize), int(self.tileSize)))
 
-        EMImageGenerator.drawGrid(
-            painter, 1, 1, point[0], point[1],
-            self.tileSize, Qt.red)
+            EMImageGenerator.drawGrid(
+                painter, 1, 1, point[0], point[1],
+                self.tileSize, Qt.red)
 
     def drawPreviewTileGroup(self, painter):
         if self.selectedModelImages[1] is not None:
@@ -379,8 +1009,8 @@ class MapEditorGraphics(EMModelGraphics):
 
             painter.drawImage(point[0], point[1],
                               self.selectedModelImages[1].scaled(
-                              self.tileSize * model.getNumCols(),
-                              self.tileSize * model.getNumRows()))
+                              int(self.tileSize * model.getNumCols()),
+                              int(self.tileSize * model.getNumRows())))
 
             EMImageGenerator.drawGrid(
                 painter, model.getNumCols(), model.getNumRows(),
@@ -413,7 +1043,10 @@ class MapEditorGraphics(EMModelGraphics):
             key = event.key() | int(event.modifiers())
             if key in self.keyBindings:
                 command = self.keyBindings[key]
-                command[0](command[1])
+                if len(command) == 1:
+                    command[0]()
+                else:
+                    command[0](command[1])
             else:
                 # Ignore event so it can percolate up
                 event.ignore()
@@ -424,24 +1057,37 @@ class MapEditorGraphics(EMModelGraphics):
         else:
             if QMouseEvent.button() & Qt.LeftButton:
                 self.mousePressed = True
+                if self.openTab == 0 or self.openTab == 1:
+                    self.beginDraft()
                 if self.mouseIndex != (-1, -1):
-                    if self.openTab == 0 and self.selectedObject[0] != -1:
-                        tile = (self.selectedObject[0],
-                                self.sOptions[0], self.sOptions[1],
-                                self.sOptions[2])
-                        self.model.setTileForIndex(
-                            self.mouseIndex[0], self.mouseIndex[1], tile)
+                    if ((self.openTab == 0 or self.openTab == 1)
+                            and self.tool == "select"):
+                        if self.inSelectedArea(self.mouseIndex):
+                            self.moveStart = self.mouseIndex
+                        else:
+                            self.selectStart = self.mouseIndex
+                            self.setSelectedArea(
+                                self.mouseIndex + self.mouseIndex)
+                    elif (self.openTab == 0 and self.selectedObject[0] != -1
+                            and self.tool == "flood"):
+                        tile = self.selectedTile()
+                        cells = self.model.connectedCells(
+                            self.mouseIndex[0], self.mouseIndex[1])
+                        if tuple(self.model.getTiles(cells[:1])[0]) != tile:
+                            self.applyEdit(cells, [tile] * len(cells))
+                    elif (self.openTab == 0 and self.selectedObject[0] != -1
+                            and self.tool == "rect"):
+                        self.fillStart = self.mouseIndex
                         self.repaint()
+                    elif self.openTab == 0 and self.selectedObject[0] != -1:
+                        self.stroke = {}
+                        self.paintCell(
+                            self.mouseIndex[0], self.mouseIndex[1],
+                            self.selectedTile())
                     elif self.openTab == 1 and self.selectedObject[1] != -1:
                         groupIndex = self.indexAlignedGroup()
-                        gGrid = self.selectedGroup.getTileGrid()
-                        for y in range(self.selectedGroup.getNumRows()):
-                            for x in range(self.selectedGroup.getNumCols()):
-                                tile = gGrid[y][x]
-                                self.model.setTileForIndex(
-                                    groupIndex[0] + x, groupIndex[1] + y,
-                                    tile)
-                        self.repaint()
+                        self.writeBlock(groupIndex[0], groupIndex[1],
+                                        self.selectedGroup.getTileGrid())
                     elif self.openTab == 3:
                         # print("Checking the Notes Tab")
                         if self.mouseOverItem is not None:
@@ -461,14 +1107,22 @@ class MapEditorGraphics(EMModelGraphics):
             prevIndex = self.mouseIndex
             self.mouseIndex = self.calcMouseIndex(QMouseEvent.pos())
             if self.openTab == 0 or self.openTab == 1:
+                if self.mousePressed:
+                    self.beginDraft()
                 if prevIndex != self.mouseIndex:
                     if (self.mousePressed and self.mouseIndex != (-1, -1)
-                            and self.openTab == 0):
-                        tile = [self.selectedObject[0], self.sOptions[0],
-                                self.sOptions[1], self.sOptions[2]]
-                        self.model.setTileForIndex(
+                            and self.stroke is not None):
+                        self.paintCell(
                             self.mouseIndex[0], self.mouseIndex[1],
-                            tile)
+                            self.selectedTile())
+                    elif (self.selectStart is not None
+                            and self.mouseIndex != (-1, -1)):
+                        start = self.selectStart
+                        self.setSelectedArea((
+                            min(start[0], self.mouseIndex[0]),
+                            min(start[1], self.mouseIndex[1]),
+                            max(start[0], self.mouseIndex[0]),
+                            max(start[1], self.mouseIndex[1])))
                     self.repaint()
             else:
                 if self.openTab == 3 and not self.mousePressed:
@@ -487,13 +1141,52 @@ class MapEditorGraphics(EMModelGraphics):
             QMouseEvent.ignore()
         else:
             self.mousePressed = False
+            self.endStroke()
+            self.selectStart = None
+            if self.moveStart is not None:
+                moveStart = self.moveStart
+                self.moveStart = None
+                dx = self.mouseIndex[0] - moveStart[0]
+                dy = self.mouseIndex[1] - moveStart[1]
+                if self.mouseIndex != (-1, -1) and (dx != 0 or dy != 0):
+                    self.moveSelected(dx, dy)
+                else:
+                    # clear the outline of where it would have landed
+                    self.update()
+            if self.fillStart is not None:
+                fillStart = self.fillStart
+                self.fillStart = None
+                if self.mouseIndex != (-1, -1):
+                    # repaints the filled cells, which covers the outline
+                    cells = self.model.rectCells(
+                        fillStart[0], fillStart[1],
+                        self.mouseIndex[0], self.mouseIndex[1])
+                    self.applyEdit(cells, [self.selectedTile()] * len(cells))
+                else:
+                    self.update()
+            if self.pressedItem is not None and self.pressedItem[0] == 3:
+                # let the map know the dragged note has moved
+                note = self.pressedItem[1]
+                notes = self.model.getMapNotes()
+                if note in notes:
+                    self.model.updateMapNote(note, notes.index(note))
             self.pressedItem = None
 
+    def wheelEvent(self, QWheelEvent):
+        if (self.preview
+                or not QWheelEvent.modifiers() & Qt.ControlModifier):
+            # Let the scroll area scroll
+            QWheelEvent.ignore()
+        else:
+            steps = QWheelEvent.angleDelta().y() / 120
+            if steps != 0:
+                self.updateZoom(int(5 * steps) or (5 if steps > 0 else -5))
+
 
 def main():
     app = QApplication([])
 
-    mainWidget = MapEditor()
+    mainWidget = MapEditor(MapModel())
     mainWidget.show()
     app.exec_()
 
@@ -0,0 +1,406 @@
+"""
+Encounter Mapper is a tile-based encounter map creator for tabletop RPGs.
+Copyright 2019, 2020 Eric Symmank
+
+This file is part of Encounter Mapper.
+
+Encounter Mapper is free software: you can redistribute it
+and/or modify it under the terms of the GNU General Public License as
+published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+
+Encounter Mapper is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Encounter Mapper.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import json
+import os
+import struct
+import zlib
+
+
+class MapFileFormat():
+    """
+    Reader and writer for the binary .emap format.
+
+    Maps used to be saved as plain JSON, which spends a 4 element array on
+    every grid cell. The binary format stores the same data as a small
+    header, followed by the grid packed as fixed-width little-endian records
+    and a trailing section holding the notes and objects.
+
+    Layout
+    ------
+    header: magic, format version, flags, rows, cols, uid
+    name:   uint16 length + utf-8 bytes
+    grid:   uint32 length + payload. Each cell is an int32 tile uid and a
+            byte holding the orientation (bits 0-1), hflip (bit 2) and
+            vflip (bit 3). With FlagRLE set, each record is prefixed by a
+            uint32 run length. With FlagZlib set, the payload is compressed.
+    extra:  uint32 length + (optionally compressed) JSON of notes/objects
+
+    Large maps are written with FlagChunked (format version 2) instead. The
+    grid is split into ChunkSize x ChunkSize blocks, each packed and
+    compressed on its own, and an index of their offsets is stored ahead of
+    them. The extra section, which then also carries the tile counts,
+    moves in front of the index so everything but the grid is read up
+    front:
+
+    header, name, extra, uint16 chunk size, index, chunks
+    index:  one (uint64 offset, uint32 length) per chunk, row-major, with
+            offsets relative to the first chunk
+
+    Both dumps() and load() work with the same dictionaries produced by
+    MapModel.jsonObj(), so models are created with MapModel.createModelJS()
+    regardless of the format they were read from. A chunked map is loaded
+    as a ChunkedTileGrid, which only reads the chunks a caller touches.
+    """
+
+    Magic = b"EMAP"
+    Version = 2
+    PlainVersion = 1
+
+    FlagRLE = 0x1
+    FlagZlib = 0x2
+    FlagChunked = 0x4
+
+    ChunkSize = 32
+    ChunkThreshold = 64 * 64
+
+    Header = struct.Struct("<4sHHIIi")
+    Length = struct.Struct("<I")
+    NameLength = struct.Struct("<H")
+    ChunkHeader = struct.Struct("<H")
+    ChunkEntry = struct.Struct("<QI")
+    Cell = struct.Struct("<iB")
+    RunCell = struct.Struct("<IiB")
+
+    ReadBlock = 1 << 16
+
+    @classmethod
+    def isMapFile(cls, f):
+        """Check for the magic number, leaving the stream where it was"""
+        pos = f.tell()
+        magic = f.read(len(cls.Magic))
+        f.seek(pos)
+        return magic == cls.Magic
+
+    @classmethod
+    def packTile(cls, tile):
+        return (tile[1] & 0x3) | (bool(tile[2]) << 2) | (bool(tile[3]) << 3)
+
+    @classmethod
+    def unpackTile(cls, uid, packed):
+        return (uid, packed & 0x3, bool(packed & 0x4), bool(packed & 0x8))
+
+    @classmethod
+    def packGrid(cls, grid, rle=True):
+        records = []
+        if rle:
+            run = None
+            count = 0
+            for row in grid:
+                for tile in row:
+                    cell = (tile[0], cls.packTile(tile))
+                    if cell == run:
+                        count += 1
+                    else:
+                        if run is not None:
+                            records.append(cls.RunCell.pack(count, *run))
+                        run = cell
+                        count = 1
+            if run is not None:
+                records.append(cls.RunCell.pack(count, *run))
+        else:
+            for row in grid:
+                for tile in row:
+                    records.append(cls.Cell.pack(tile[0], cls.packTile(tile)))
+        return b"".join(records)
+
+    @classmethod
+    def dumps(cls, jsObj, compress=True, rle=True, chunked=None):
+        """
+        Encode a MapModel.jsonObj() dictionary as bytes.
+
+        chunked defaults to writing the chunked layout only for maps larger
+        than ChunkThreshold cells.
+        """
+        grid = jsObj["grid"]
+        rows = len(grid)
+        cols = 0 if rows == 0 else len(grid[0])
+        if chunked is None:
+            chunked = rows * cols > cls.ChunkThreshold
+        flags = (cls.FlagRLE if rle else 0) | (cls.FlagZlib if compress else 0)
+        version = cls.PlainVersion
+        extra = {
+            "objects": jsObj["objects"],
+            "notes": jsObj["notes"]
+        }
+        if chunked:
+            flags |= cls.FlagChunked
+            version = cls.Version
+            # the counts save MapModel from reading every chunk to count
+            # the tiles when the map is opened
+            extra["ttf"] = jsObj["ttf"]
+            extra["counts"] = jsObj.get("counts")
+
+        extraData = json.dumps(extra).encode("utf-8")
+        if compress:
+            extraData = zlib.compress(extraData)
+
+        name = jsObj["name"].encode("utf-8")
+        parts = [
+            cls.Header.pack(cls.Magic, version, flags, rows, cols,
+                            jsObj["uid"]),
+            cls.NameLength.pack(len(name)), name
+        ]
+        if chunked:
+            parts.extend((cls.Length.pack(len(extraData)), extraData))
+            parts.extend(cls.packChunks(grid, rows, cols, compress, rle))
+        else:
+            gridData = cls.packGrid(grid, rle)
+            if compress:
+                gridData = zlib.compress(gridData)
+            parts.extend((cls.Length.pack(len(gridData)), gridData,
+                          cls.Length.pack(len(extraData)), extraData))
+        return b"".join(parts)
+
+    @classmethod
+    def packChunks(cls, grid, rows, cols, compress, rle):
+        size = cls.ChunkSize
+        index = []
+        chunks = []
+        offset = 0
+        for y in range(0, rows, size):
+            band = grid[y:y + size]
+            for x in range(0, cols, size):
+                data = cls.packGrid([row[x:x + size] for row in band], rle)
+                if compress:
+                    data = zlib.compress(data)
+                index.append(cls.ChunkEntry.pack(offset, len(data)))
+                chunks.append(data)
+                offset += len(data)
+        return [cls.ChunkHeader.pack(size)] + index + chunks
+
+    @classmethod
+    def readExact(cls, f, size):
+        data = f.read(size)
+        if len(data) != size:
+            raise ValueError("Unexpected end of map file")
+        return data
+
+    @classmethod
+    def readGrid(cls, f, size, rows, cols, flags):
+        """
+        Stream the grid section into rows of tiles.
+
+        The section is read and decompressed in blocks, so the compressed
+        and the packed copies of the grid never have to be held in memory
+        at the same time.
+        """
+        if rows == 0 or cols == 0:
+            cls.readExact(f, size)
+            return [[] for y in range(rows)]
+        rle = flags & cls.FlagRLE
+        record = cls.RunCell if rle else cls.Cell
+        decompressor = zlib.decompressobj() if flags & cls.FlagZlib else None
+        # cells are immutable tuples, so identical cells can share one
+        tiles = {}
+        grid = []
+        row = []
+        pending = b""
+        remaining = size
+        while remaining > 0 or decompressor is not None:
+            if remaining > 0:
+                block = cls.readExact(f, min(cls.ReadBlock, remaining))
+                remaining -= len(block)
+                if decompressor is not None:
+                    block = decompressor.decompress(block)
+            else:
+                block = decompressor.flush()
+                decompressor = None
+            pending += block
+            usable = len(pending) - (len(pending) % record.size)
+            for fields in record.iter_unpack(pending[:usable]):
+                count = 1
+                if rle:
+                    count, uid, packed = fields
+                else:
+                    uid, packed = fields
+                key = (uid, packed)
+                tile = tiles.get(key)
+                if tile is None:
+                    tile = tiles[key] = cls.unpackTile(uid, packed)
+                while count > 0:
+                    take = min(count, cols - len(row))
+                    if take == 1:
+                        row.append(tile)
+                    else:
+                        row.extend([tile] * take)
+                    count -= take
+                    if len(row) == cols:
+                        grid.append(row)
+                        row = []
+            pending = pending[usable:]
+        if pending or row:
+            raise ValueError("Map grid section is truncated")
+        if len(grid) != rows or any(len(row) != cols for row in grid):
+            raise ValueError("Map grid does not match its header")
+        return grid
+
+    @classmethod
+    def load(cls, f):
+        """Read a binary map from a file object opened in binary mode"""
+        magic, version, flags, rows, cols, uid = cls.Header.unpack(
+            cls.readExact(f, cls.Header.size))
+        if magic != cls.Magic:
+            raise ValueError("Not an Encounter Mapper map file")
+        if version > cls.Version:
+            raise ValueError(
+                "Map file version {} is not supported".format(version))
+
+        nameLength = cls.NameLength.unpack(
+            cls.readExact(f, cls.NameLength.size))[0]
+        name = cls.readExact(f, nameLength).decode("utf-8")
+
+        if flags & cls.FlagChunked:
+            extra = cls.readExtra(f, flags)
+            chunkSize = cls.ChunkHeader.unpack(
+                cls.readExact(f, cls.ChunkHeader.size))[0]
+            numChunks = (-(-rows // chunkSize)) * (-(-cols // chunkSize))
+            index = [cls.ChunkEntry.unpack(
+                cls.readExact(f, cls.ChunkEntry.size))
+                for i in range(numChunks)]
+            grid = ChunkedTileGrid(f, rows, cols, chunkSize, flags,
+                                   f.tell(), index)
+            ttf = extra["ttf"]
+            counts = extra.get("counts")
+        else:
+            gridLength = cls.Length.unpack(
+                cls.readExact(f, cls.Length.size))[0]
+            grid = cls.readGrid(f, gridLength, rows, cols, flags)
+            extra = cls.readExtra(f, flags)
+            ttf = None
+            counts = None
+
+        return {
+            "name": name,
+            "grid": grid,
+            "ttf": ttf,
+            "counts": counts,
+            "uid": uid,
+            "objects": extra["objects"],
+            "notes": extra["notes"]
+        }
+
+    @classmethod
+    def readExtra(cls, f, flags):
+        extraLength = cls.Length.unpack(cls.readExact(f, cls.Length.size))[0]
+        extraData = cls.readExact(f, extraLength)
+        if flags & cls.FlagZlib:
+            extraData = zlib.decompress(extraData)
+        return json.loads(extraData.decode("utf-8"))
+
+
+class ChunkedTileGrid(list):
+    """
+    Tile grid of a chunked map file that is read in on demand.
+
+    The grid behaves like the usual list of rows, but every row starts out
+    as None and is only filled in the first time it is accessed. At that
+    point every chunk in its band of ChunkSize rows is read from the file,
+    so opening a large map costs time in proportion to the part of it that
+    is actually drawn or edited. Iterating over the grid loads all of it.
+
+    The grid keeps its own handle on the file until every row is loaded,
+    so replacing the file on disk does not affect it. Should the file be
+    changed in place instead, loading a band raises an IOError. If the
+    grid was not read from a named file, everything is loaded immediately.
+    """
+
+    def __init__(self, f, rows, cols, chunkSize, flags, dataStart, index):
+        super(ChunkedTileGrid, self).__init__([None] * rows)
+        self.path = getattr(f, "name", None)
+        self.file = None
+        self.fileRows = rows
+        self.cols = cols
+        self.chunkSize = chunkSize
+        self.flags = flags
+        self.dataStart = dataStart
+        self.index = index
+        self.chunksPerRow = -(-cols // chunkSize)
+        if not isinstance(self.path, str):
+            for band in range(-(-rows // chunkSize)):
+                self.loadBand(band, f)
+            return
+        # a handle of our own, the caller closes f once the map is read
+        self.file = os.fdopen(os.dup(f.fileno()), "rb")
+        self.fileStat = self.statFile()
+
+    def __getitem__(self, y):
+        if isinstance(y, slice):
+            for i in range(*y.indices(len(self))):
+                self[i]
+            return super(ChunkedTileGrid, self).__getitem__(y)
+        row = super(ChunkedTileGrid, self).__getitem__(y)
+        if row is None:
+            y = y % len(self)
+            self.loadBand(y // self.chunkSize)
+            row = super(ChunkedTileGrid, self).__getitem__(y)
+        return row
+
+    def __iter__(self):
+        for y in range(len(self)):
+            yield self[y]
+
+    def pop(self, index=-1):
+        self[index]
+        return super(ChunkedTileGrid, self).pop(index)
+
+    def isLoaded(self):
+        return None not in super(ChunkedTileGrid, self).__iter__()
+
+    def loadAll(self):
+        for y in range(0, len(self), self.chunkSize):
+            self[y]
+
+    def close(self):
+        """Let go of the file, rows that were not loaded yet are lost"""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def statFile(self):
+        stat = os.fstat(self.file.fileno())
+        return (stat.st_size, stat.st_mtime_ns)
+
+    def loadBand(self, band, f=None):
+        if f is None:
+            if self.file is None:
+                raise IOError("Map file {} is closed".format(self.path))
+            if self.statFile() != self.fileStat:
+                raise IOError(
+                    "Map file {} changed on disk".format(self.path))
+            self.loadBand(band, self.file)
+            if self.isLoaded():
+                self.close()
+            return
+        y0 = band * self.chunkSize
+        y1 = min(self.fileRows, y0 + self.chunkSize)
+        rows = [[] for y in range(y1 - y0)]
+        for cx in range(self.chunksPerRow):
+            offset, length = self.index[band * self.chunksPerRow + cx]
+            width = min(self.chunkSize, self.cols - cx * self.chunkSize)
+            f.seek(self.dataStart + offset)
+            chunk = MapFileFormat.readGrid(f, length, y1 - y0, width,
+                                           self.flags)
+            for row, chunkRow in zip(rows, chunk):
+                row.extend(chunkRow)
+        for y in range(y0, min(y1, len(self))):
+            if super(ChunkedTileGrid, self).__getitem__(y) is None:
+                super(ChunkedTileGrid, self).__setitem__(y, rows[y - y0])
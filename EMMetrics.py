@@ -0,0 +1,202 @@
+"""
+Encounter Mapper is a tile-based encounter map creator for tabletop RPGs.
+Copyright 2019, 2020 Eric Symmank
+
+This file is part of Encounter Mapper.
+
+Encounter Mapper is free software: you can redistribute it
+and/or modify it under the terms of the GNU General Public License as
+published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+
+Encounter Mapper is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Encounter Mapper.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import atexit
+import functools
+import json
+import os
+import random
+import threading
+import time
+
+
+class NullTimer():
+    """Timer handed out while Metrics is switched off. Does nothing."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class Timer():
+    def __init__(self, name):
+        self.name = name
+        self.start = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        Metrics.record(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class TimerStats():
+    """
+    Count, total and maximum of the samples of one timer, plus a uniform
+    random sample of at most ReservoirSize of them for the percentiles, so
+    timers called for every cell of every paint stay the same size however
+    long the program runs.
+    """
+
+    ReservoirSize = 2048
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.reservoir = []
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        if len(self.reservoir) < self.ReservoirSize:
+            self.reservoir.append(seconds)
+        else:
+            # every sample so far ends up kept with the same probability
+            index = random.randrange(self.count)
+            if index < self.ReservoirSize:
+                self.reservoir[index] = seconds
+
+    def copy(self):
+        stats = TimerStats()
+        stats.count = self.count
+        stats.total = self.total
+        stats.max = self.max
+        stats.reservoir = list(self.reservoir)
+        return stats
+
+
+class Metrics():
+    """
+    Named timers and counters for the hot paths of the program.
+
+    Switched on by setting the EM_PROFILE environment variable, either to 1
+    (results go to em_profile.json in the working directory) or to the path
+    of the file to write. Empty or 0 leaves it off. When it is not set, timed() hands back the
+    function it was given and timer() a shared no-op, so instrumented code
+    runs as if it was never touched.
+
+    On exit, every timer is summarised as count, total, p50, p95 and max
+    (in milliseconds) and every counter as its value. The percentiles are
+    estimated from a bounded sample of each timer (see TimerStats). Timers
+    and counters can be used from any thread.
+    """
+
+    EnvVar = "EM_PROFILE"
+    DefaultPath = "em_profile.json"
+
+    path = os.environ.get(EnvVar, "").strip()
+    enabled = path not in ("", "0")
+
+    # name -> TimerStats
+    samples = {}
+    counters = {}
+    lock = threading.Lock()
+
+    nullTimer = NullTimer()
+
+    @classmethod
+    def timer(cls, name):
+        """Context manager that records how long its block took"""
+        if not cls.enabled:
+            return cls.nullTimer
+        return Timer(name)
+
+    @classmethod
+    def timed(cls, name):
+        """Decorator that records how long every call to the function took"""
+        def decorator(func):
+            if not cls.enabled:
+                return func
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    cls.record(name, time.perf_counter() - start)
+            return wrapper
+        return decorator
+
+    @classmethod
+    def record(cls, name, seconds):
+        with cls.lock:
+            if name not in cls.samples:
+                cls.samples[name] = TimerStats()
+            cls.samples[name].add(seconds)
+
+    @classmethod
+    def count(cls, name, amount=1):
+        if cls.enabled:
+            with cls.lock:
+                cls.counters[name] = cls.counters.get(name, 0) + amount
+
+    @classmethod
+    def percentile(cls, ordered, fraction):
+        last = len(ordered) - 1
+        return ordered[min(last, int(round(fraction * last)))]
+
+    @classmethod
+    def summary(cls):
+        with cls.lock:
+            recorded = {name: stats.copy()
+                        for (name, stats) in cls.samples.items()}
+            counters = dict(cls.counters)
+        timers = {}
+        for name, stats in recorded.items():
+            ordered = sorted(stats.reservoir)
+            timers[name] = {
+                "count": stats.count,
+                "total": stats.total * 1000,
+                "p50": cls.percentile(ordered, 0.5) * 1000,
+                "p95": cls.percentile(ordered, 0.95) * 1000,
+                "max": stats.max * 1000
+            }
+        return {"timers": timers, "counters": counters}
+
+    @classmethod
+    def reset(cls):
+        with cls.lock:
+            cls.samples = {}
+            cls.counters = {}
+
+    @classmethod
+    def dump(cls, path=None):
+        if path is None:
+            path = (cls.DefaultPath if cls.path in ("", "0", "1")
+                    else cls.path)
+        try:
+            f = open(path, "w")
+            f.write(json.dumps(cls.summary(), indent=2, sort_keys=True))
+            f.close()
+        except OSError as e:
+            print("WARNING: profile could not be written to {}: {}".format(
+                path, e))
+
+
+if Metrics.enabled:
+    atexit.register(Metrics.dump)
@@ -19,8 +19,8 @@ along with Encounter Mapper.
 If not, see <https://www.gnu.org/licenses/>.
 """
 
-from PyQt5.QtGui import QColor
-from PyQt5.QtCore import (QObject, pyqtSignal, QPoint)
+from PyQt5.QtGui import QColor, QPolygonF
+from PyQt5.QtCore import (QObject, pyqtSignal, QPoint, QPointF)
 
 
 class EMModel(QObject):
@@ -36,6 +36,12 @@ class EMModel(QObject):
         self.name = name
         self.tags = tags
         self.uid = uid
+        self.version = 0
+
+    @classmethod
+    def newModel(cls):
+        """A blank model, as an EMModelPicker creates new models"""
+        return cls()
 
     def getUid(self):
         return self.uid
@@ -43,6 +49,24 @@ class EMModel(QObject):
     def setUid(self, uid):
         self.uid = uid
 
+    def getVersion(self):
+        return self.version
+
+    def setVersion(self, version):
+        self.version = version
+
+    def bumpVersion(self):
+        """
+        Make cached renders of the model stale. Caches of rendered models
+        are keyed or validated by (uid, version).
+        """
+        self.version += 1
+
+    def markChanged(self):
+        """Called by every mutator that changes how the model renders"""
+        self.bumpVersion()
+        self.modelUpdated.emit()
+
     def getName(self):
         return self.name
 
@@ -51,7 +75,7 @@ class EMModel(QObject):
 
     def setName(self, name):
         self.name = name
-        self.modelUpdated.emit()
+        self.markChanged()
 
     def getTags(self):
         return self.tags
@@ -83,6 +107,11 @@ class TileModel(EMModel):
 
     Future implementations may allow for multiple FG objects, as well as
     different textures to overlay on top of the BG.
+
+    For drawing, the shapes are kept as QPolygonF in tile coordinates
+    (0 to 100) for each orientation and flip combination they are requested
+    in. The polygons are built on first use by fetchShapePolygons() and
+    dropped whenever the shapes change.
     """
 
     def __init__(self, name="new tile", shapeList=None, bgTexture=0, uid=-1):
@@ -98,6 +127,8 @@ class TileModel(EMModel):
                 self.shapeList.append(sh)
         self.bgTexture = bgTexture
         self.selectedIndex = -1
+        # (orientation, hflip, vflip) -> list of QPolygonF, one per shape
+        self.shapePolygons = {}
 
     @classmethod
     def createModelCopy(cls, model):
@@ -113,36 +144,42 @@ class TileModel(EMModel):
 
     def setBgTexture(self, texture):
         self.bgTexture = texture
-        self.modelUpdated.emit()
+        self.markChanged()
 
     def addShape(self):
         self.shapeList.append([1, []])
-        self.modelUpdated.emit()
+        self.invalidateShapes()
+        self.markChanged()
 
     def addPoint(self, shape, index, x, y):
         index = max(0, index)
         self.shapeList[shape][1].insert(index, (x, y))
-        self.modelUpdated.emit()
+        self.invalidateShapes()
+        self.markChanged()
 
     def updatePoint(self, shape, index, x, y):
         if shape >= 0 and shape < len(self.shapeList):
             if index >= 0 and index < len(self.shapeList[shape][1]):
                 self.shapeList[shape][1][index] = (x, y)
-                self.modelUpdated.emit()
+                self.invalidateShapes()
+                self.markChanged()
 
     def updateModel(self, model):
         self.name = model.getName()
         self.shapeList = model.getShapes()
         self.bgTexture = model.getBgTexture()
-        self.modelUpdated.emit()
+        self.invalidateShapes()
+        self.markChanged()
 
     def deleteShape(self, shape):
         del self.shapeList[shape]
-        self.modelUpdated.emit()
+        self.invalidateShapes()
+        self.markChanged()
 
     def deleteShapePoint(self, shape, index):
         del self.shapeList[shape][1][index]
-        self.modelUpdated.emit()
+        self.invalidateShapes()
+        self.markChanged()
 
     def deletePoint(self, index):
         del self.pointList[index]
@@ -150,7 +187,7 @@ class TileModel(EMModel):
             self.selectedIndex = max(self.selectedIndex - 1, 0)
         if len(self.pointList) == 0:
             self.selectedIndex = -1
-        self.modelUpdated.emit()
+        self.markChanged()
 
     def swapPointSelected(self, index):
         self.swapPoints(self.selectedIndex, index)
@@ -165,14 +202,14 @@ class TileModel(EMModel):
                 self.selectedIndex = i2
             elif self.selectedIndex == i2:
                 self.selectedIndex = i1
-        self.modelUpdated.emit()
+        self.markChanged()
 
     def getPoints(self):
         return self.pointList
 
     def setShapeTexture(self, index, texture):
         self.shapeList[index][0] = texture
-        self.modelUpdated.emit()
+        self.markChanged()
 
     def getShape(self, index):
         return self.shapeList[index]
@@ -196,25 +233,30 @@ class TileModel(EMModel):
     def getNumPoints(self):
         return len(self.pointList)
 
+    @classmethod
+    def orientPoint(cls, p, orientation, hflip, vflip):
+        if orientation == 1:
+            p = (100 - p[1], p[0])
+            # flip cw
+        elif orientation == 2:
+            p = (100 - p[0], 100 - p[1])
+
+        elif orientation == 3:
+            # flip ccw
+            p = (p[1],  100 - p[0])
+            pass
+        if hflip:
+            p = (100 - p[0], p[1])
+
+        if vflip:
+            p = (p[0], 100 - p[1])
+        return p
+
     def offsetShape(self, points, scaleX, scaleY, pointScale,
                     orientation, hflip, vflip):
         pointList = []
         for p in points:
-            if orientation == 1:
-                p = (100 - p[1], p[0])
-                # flip cw
-            elif orientation == 2:
-                p = (100 - p[0], 100 - p[1])
-
-            elif orientation == 3:
-                # flip ccw
-                p = (p[1],  100 - p[0])
-                pass
-            if hflip:
-                p = (100 - p[0], p[1])
-
-            if vflip:
-                p = (p[0], 100 - p[1])
+            p = self.orientPoint(p, orientation, hflip, vflip)
 
             point = (p[0] * pointScale + scaleX,
                      p[1] * pointScale + scaleY)
@@ -222,6 +264,21 @@ class TileModel(EMModel):
             pointList.append(QPoint(point[0], point[1]))
         return pointList
 
+    def fetchShapePolygons(self, orientation=0, hflip=False, vflip=False):
+        """Return the shapes as QPolygonF in tile coordinates (0 to 100)"""
+        key = (orientation, bool(hflip), bool(vflip))
+        polygons = self.shapePolygons.get(key)
+        if polygons is None:
+            polygons = []
+            for shape in self.shapeList:
+                polygons.append(QPolygonF([
+                    QPointF(*self.orientPoint(p, *key)) for p in shape[1]]))
+            self.shapePolygons[key] = polygons
+        return polygons
+
+    def invalidateShapes(self):
+        self.shapePolygons = {}
+
     def generateShapeOffset(self, si, xInd, yInd,
                             scale=100, xOff=0, yOff=0,
                             orientation=0, hflip=False,
@@ -254,7 +311,8 @@ class TileModel(EMModel):
                     shape[1][i] = (100 - point[1], point[0])
                 else:
                     shape[1][i] = (point[1], 100 - point[0])
-        self.modelUpdated.emit()
+        self.invalidateShapes()
+        self.markChanged()
 
     def transformFlip(self, h):
         for shape in self.shapeList:
@@ -264,7 +322,8 @@ class TileModel(EMModel):
                     shape[1][i] = (100 - point[0], point[1])
                 else:
                     shape[1][i] = (point[0], 100 - point[1])
-        self.modelUpdated.emit()
+        self.invalidateShapes()
+        self.markChanged()
 
     def jsonObj(self):
 
@@ -282,10 +341,27 @@ class GroupModel(EMModel):
     Model representation of a group of tiles. Contains a matrix which contains
     the UID of each tile inside it, as well as any rotations/transformations
     added to them.
+
+    Alongside the grid, the group keeps a count of how many cells use each
+    tile uid (including -1 for empty cells). Every change to the grid updates
+    the counts, so getTilesToFetch() is always the exact set of tiles in use
+    without rescanning the grid. Passing tileCounts when constructing skips
+    counting the grid, which for a chunked map would mean reading all of it.
+
+    Signals
+    -------
+
+    tilesChanged -> int, int, int, int
+        emitted with the x, y, width and height of the cells that were set
+    gridResized -> None
+        emitted whenever a row or column is added or removed
     """
 
-    def __init__(self, name="new group", tileGrid=None,
-                 ttf=None, uid=-1):
+    tilesChanged = pyqtSignal(int, int, int, int)
+    gridResized = pyqtSignal()
+
+    def __init__(self, name="new group", tileGrid=None, uid=-1,
+                 tileCounts=None):
         super(GroupModel, self).__init__(name, "", uid)
         self.name = name
         if tileGrid is None:
@@ -300,18 +376,18 @@ class GroupModel(EMModel):
             self.tileGrid = tileGrid
             self.rows = len(self.tileGrid)
             self.cols = 0 if self.rows == 0 else len(self.tileGrid[0])
-        self.tilesToFetch = self.generateTilesToFetch() if ttf is None else ttf
+        self.tileCounts = (self.countTiles() if tileCounts is None
+                           else dict(tileCounts))
 
     @classmethod
     def createModelJS(cls, modelJS):
-        model = cls(modelJS["name"], modelJS["grid"],
-                    None, modelJS["uid"])
+        model = cls(modelJS["name"], modelJS["grid"], modelJS["uid"])
         return model
 
     @classmethod
     def createModelCopy(cls, model):
-        mcopy = cls(model.getName(), model.getTileGrid(),
-                    None, model.getUid())
+        mcopy = cls(model.getName(), model.copyTileGrid(), model.getUid(),
+                    model.getTileCounts())
         return mcopy
 
     @classmethod
@@ -379,27 +455,34 @@ class GroupModel(EMModel):
 
         mGrid = tGrid
 
-        return cls(model.getName(), mGrid)
+        # transforming only moves the cells around, so the counts still hold
+        return cls(model.getName(), mGrid, tileCounts=model.getTileCounts())
 
     def jsonObj(self):
         return {
             "name": self.name,
             "grid": self.tileGrid,
-            "ttf": self.tilesToFetch,
+            # no longer read back, but older versions fail without it
+            "ttf": self.getTilesToFetch(),
             "uid": self.uid,
         }
 
     def updateModel(self, model):
         self.name = model.getName()
-        self.grid = model.getTileGrid()
-        self.tilesToFetch = model.getTilesToFetch()
+        self.tileGrid = model.copyTileGrid()
+        self.tileCounts = dict(model.getTileCounts())
         self.rows = model.getNumRows()
         self.cols = model.getNumCols()
-        self.modelUpdated.emit()
+        self.markChanged()
 
     def getTileGrid(self):
         return self.tileGrid
 
+    def copyTileGrid(self):
+        # cells are always replaced rather than modified, so copying the
+        # rows is enough to detach the grid from this model
+        return [list(row) for row in self.tileGrid]
+
     def getNumRows(self):
         return self.rows
 
@@ -410,45 +493,155 @@ class GroupModel(EMModel):
         return "{} ({}x{})".format(self.name, self.cols, self.rows)
 
     def getTilesToFetch(self):
-        return self.tilesToFetch
+        return list(self.tileCounts)
+
+    def getTileCounts(self):
+        return self.tileCounts
+
+    def getTileCount(self, uid):
+        return self.tileCounts.get(uid, 0)
 
     def setTileForIndex(self, x, y, tile):
+        old = self.tileGrid[y][x]
+        if old[0] != tile[0]:
+            self.countTile(old[0], -1)
+            self.countTile(tile[0], 1)
         self.tileGrid[y][x] = tile
-        self.modelUpdated.emit()
+        self.tilesChanged.emit(x, y, 1, 1)
+        self.markChanged()
+
+    def setTiles(self, cells, tiles):
+        """
+        Set every (x, y) in cells to the tile at the same position in tiles,
+        as one bulk write that emits tilesChanged once with the bounds of all
+        of them
+        """
+        if len(cells) == 0:
+            return
+        grid = self.tileGrid
+        counts = {}
+        x0, y0 = cells[0]
+        x1, y1 = x0, y0
+        for ((x, y), tile) in zip(cells, tiles):
+            row = grid[y]
+            uid = row[x][0]
+            counts[uid] = counts.get(uid, 0) - 1
+            counts[tile[0]] = counts.get(tile[0], 0) + 1
+            row[x] = tile
+            x0 = min(x0, x)
+            x1 = max(x1, x)
+            y0 = min(y0, y)
+            y1 = max(y1, y)
+        for (uid, amount) in counts.items():
+            if amount != 0:
+                self.countTile(uid, amount)
+        self.tilesChanged.emit(x0, y0, x1 - x0 + 1, y1 - y0 + 1)
+        self.markChanged()
+
+    def getTiles(self, cells):
+        grid = self.tileGrid
+        return [grid[y][x] for (x, y) in cells]
+
+    def rectCells(self, x0, y0, x1, y1):
+        """
+        Return the cells from (x0, y0) to (x1, y1) inclusive, row by row,
+        leaving out any that are outside the grid
+        """
+        x0, x1 = max(0, min(x0, x1)), min(self.cols - 1, max(x0, x1))
+        y0, y1 = max(0, min(y0, y1)), min(self.rows - 1, max(y0, y1))
+        return [(x, y) for y in range(y0, y1 + 1) for x in range(x0, x1 + 1)]
+
+    def copyRegion(self, x0, y0, x1, y1):
+        """Return a group with a copy of the cells from (x0, y0) to (x1, y1)"""
+        grid = [list(self.tileGrid[y][x0:x1 + 1]) for y in range(y0, y1 + 1)]
+        return GroupModel(self.name, grid)
+
+    def connectedCells(self, x, y):
+        """
+        Return the cells reachable from (x, y) through neighbouring cells
+        that hold the same tile. Uses a scanline fill, so each row is walked
+        in spans rather than cell by cell through a queue.
+        """
+        grid = self.tileGrid
+        target = tuple(grid[y][x])
+        seen = set()
+        cells = []
+        stack = [(x, y)]
+        while len(stack) > 0:
+            (x, y) = stack.pop()
+            if (x, y) in seen:
+                continue
+            row = grid[y]
+            left = x
+            while left > 0 and tuple(row[left - 1]) == target:
+                left -= 1
+            right = x
+            while right < self.cols - 1 and tuple(row[right + 1]) == target:
+                right += 1
+            for cx in range(left, right + 1):
+                seen.add((cx, y))
+                cells.append((cx, y))
+            # queue one cell for each run of matching cells above and below
+            for ny in (y - 1, y + 1):
+                if ny < 0 or ny >= self.rows:
+                    continue
+                nrow = grid[ny]
+                inRun = False
+                for cx in range(left, right + 1):
+                    if (cx, ny) not in seen and tuple(nrow[cx]) == target:
+                        if not inRun:
+                            stack.append((cx, ny))
+                            inRun = True
+                    else:
+                        inRun = False
+        return cells
 
     def addRow(self):
         self.tileGrid.append([])
         for i in range(self.cols):
             self.tileGrid[-1].append((-1, 0, False, False))
+        self.countTile(-1, self.cols)
         self.rows += 1
-        self.modelUpdated.emit()
+        self.gridResized.emit()
+        self.markChanged()
 
     def delRow(self):
         if(self.rows > 1):
-            self.tileGrid.pop()
+            for tile in self.tileGrid.pop():
+                self.countTile(tile[0], -1)
             self.rows -= 1
-            self.modelUpdated.emit()
+            self.gridResized.emit()
+            self.markChanged()
 
     def addCol(self):
         for row in self.tileGrid:
             row.append((-1, 0, False, False))
+        self.countTile(-1, self.rows)
         self.cols += 1
-        self.modelUpdated.emit()
+        self.gridResized.emit()
+        self.markChanged()
 
     def delCol(self):
         if(self.cols > 1):
             for row in self.tileGrid:
-                row.pop()
+                self.countTile(row.pop()[0], -1)
             self.cols -= 1
-            self.modelUpdated.emit()
+            self.gridResized.emit()
+            self.markChanged()
 
-    def generateTilesToFetch(self):
-        ttf = []
+    def countTile(self, uid, amount):
+        count = self.tileCounts.get(uid, 0) + amount
+        if count > 0:
+            self.tileCounts[uid] = count
+        else:
+            self.tileCounts.pop(uid, None)
+
+    def countTiles(self):
+        counts = {}
         for row in self.tileGrid:
             for tile in row:
-                if tile[0] not in ttf:
-                    ttf.append(tile[0])
-        return ttf
+                counts[tile[0]] = counts.get(tile[0], 0) + 1
+        return counts
 
 
 class MapModel(GroupModel):
@@ -459,10 +652,21 @@ class MapModel(GroupModel):
     rather, it is meant to be saved and loaded by the user. MapModel inherits
     the grid from groupModel, but also contains a list of notes and objects to
     populate the grid with.
+
+    Large maps opened from a chunked map file keep a ChunkedTileGrid, which
+    reads its rows in from the file as they are first used.
+
+    Signals
+    -------
+
+    notesChanged -> int, int
+        emitted with the first and last index of the notes that changed
     """
 
-    def __init__(self, name="my encounter", tileGrid=None,
-                 ttf=None, mapObjects=None, mapNotes=None, uid=-1):
+    notesChanged = pyqtSignal(int, int)
+
+    def __init__(self, name="my encounter", tileGrid=None, mapObjects=None,
+                 mapNotes=None, uid=-1, tileCounts=None):
         grid = [] if tileGrid is None else tileGrid
         if len(grid) == 0:
             rows = 5
@@ -472,7 +676,7 @@ class MapModel(GroupModel):
                 for x in range(cols):
                     grid[-1].append((-1, 0, False, False))
 
-        super(MapModel, self).__init__(name, grid, ttf, uid)
+        super(MapModel, self).__init__(name, grid, uid, tileCounts)
         self.mapObjects = [] if mapObjects is None else mapObjects
         self.mapNotes = [] if mapNotes is None else mapNotes
 
@@ -481,8 +685,11 @@ class MapModel(GroupModel):
         noteList = []
         for note in jsonObj["notes"]:
             noteList.append(NoteData.createModelJS(note))
-        return cls(jsonObj["name"], jsonObj["grid"], jsonObj["ttf"],
-                   jsonObj["objects"], noteList, jsonObj["uid"])
+        tileCounts = None
+        if jsonObj.get("counts") is not None:
+            tileCounts = {uid: count for (uid, count) in jsonObj["counts"]}
+        return cls(jsonObj["name"], jsonObj["grid"], jsonObj["objects"],
+                   noteList, jsonObj["uid"], tileCounts)
 
     def getMapObjects(self):
         return self.mapObjects
@@ -493,12 +700,15 @@ class MapModel(GroupModel):
     def addMapNote(self, note, index=-1):
         index = len(self.mapNotes) if index == -1 else index
         self.mapNotes.insert(index, note)
-        self.modelUpdated.emit()
+        # notes after the inserted one have all moved down by one
+        self.notesChanged.emit(index, len(self.mapNotes) - 1)
+        self.markChanged()
 
     def updateMapNote(self, note, index):
         if index >= 0 and index < len(self.mapNotes):
             self.mapNotes[index] = note
-        self.modelUpdated.emit()
+            self.notesChanged.emit(index, index)
+        self.markChanged()
 
     def jsonObj(self):
         noteList = []
@@ -506,8 +716,11 @@ class MapModel(GroupModel):
             noteList.append(note.jsonObj())
         return {
             "name": self.name,
-            "grid": self.tileGrid,
-            "ttf": self.tilesToFetch,
+            "grid": self.copyTileGrid(),
+            # no longer read back, but older versions fail without it
+            "ttf": self.getTilesToFetch(),
+            "counts": [[uid, count] for (uid, count)
+                       in self.tileCounts.items()],
             "uid": self.uid,
             "objects": self.mapObjects,
             "notes": noteList
@@ -554,7 +767,7 @@ class NoteData(EMModel):
 
     def setType(self, type):
         self.type = type
-        self.modelUpdated.emit()
+        self.markChanged()
 
     def setDesc(self, desc):
         self.desc = desc
@@ -562,7 +775,7 @@ class NoteData(EMModel):
     def setPos(self, x, y):
         self.xPos = x
         self.yPos = y
-        self.modelUpdated.emit()
+        self.markChanged()
 
     def jsonObj(self):
         return {
@@ -585,6 +798,16 @@ class TextureModel(EMModel):
         super(TextureModel, self).__init__(name, tags, uid)
         self.dirty = True
 
+    def markChanged(self):
+        self.dirty = True
+        super(TextureModel, self).markChanged()
+
+    def setDirty(self, dirty):
+        self.dirty = dirty
+
+    def isDirty(self):
+        return self.dirty
+
 
 class GeneratedTextureModel(TextureModel):
     def __init__(self, name="New Texture", bgColor=None,
@@ -596,13 +819,6 @@ class GeneratedTextureModel(TextureModel):
         if textures is None:
             self.textures = [["None", QColor(0, 0, 0)],
                              ["None", QColor(0, 0, 0)]]
-        self.dirty = True
-
-    def setDirty(self, dirty):
-        self.dirty = dirty
-
-    def isDirty(self):
-        return self.dirty
 
     @classmethod
     def createModelJS(cls, jsonObj):
@@ -634,25 +850,22 @@ class GeneratedTextureModel(TextureModel):
         self.name = model.getName()
         self.bgColor = model.getBgColor()
         self.textures = model.getTextures()
-        self.dirty = True
+        self.markChanged()
 
     def setBgColor(self, color):
         self.bgColor = color
-        self.dirty = True
-        self.modelUpdated.emit()
+        self.markChanged()
 
     def getBgColor(self):
         return self.bgColor
 
     def setTextureType(self, texture, index):
         self.textures[index][0] = texture
-        self.dirty = True
-        self.modelUpdated.emit()
+        self.markChanged()
 
     def setTextureColor(self, color, index):
         self.textures[index][1] = color
-        self.dirty = True
-        self.modelUpdated.emit()
+        self.markChanged()
 
     def getTextures(self):
         return self.textures
@@ -713,9 +926,14 @@ class ImageTextureModel(TextureModel):
                         model.getUid())
         return mcopy
 
+    def updateModel(self, model):
+        self.name = model.getName()
+        self.filePath = model.getFilePath()
+        self.markChanged()
+
     def setFilePath(self, fp):
         self.filePath = fp
-        self.modelUpdated.emit()
+        self.markChanged()
 
     def getFilePath(self):
         return self.filePath
@@ -731,6 +949,15 @@ class ImageTextureModel(TextureModel):
 
 
 class TextureModelLoader:
+    """
+    Creates the right kind of TextureModel for a texture. New textures start
+    as a GeneratedTextureModel.
+    """
+
+    @classmethod
+    def newModel(cls):
+        return GeneratedTextureModel()
+
     @classmethod
     def createModelJS(cls, jsonObj):
         model = None
@@ -745,4 +972,6 @@ class TextureModelLoader:
         modelCopy = None
         if isinstance(model, GeneratedTextureModel):
             modelCopy = GeneratedTextureModel.createModelCopy(model)
+        elif isinstance(model, ImageTextureModel):
+            modelCopy = ImageTextureModel.createModelCopy(model)
         return modelCopy
@@ -27,6 +27,7 @@ from PyQt5.QtCore import Qt, pyqtSignal
 from PyQt5.QtGui import QPainter, QPixmap
 from EMBaseClasses import EMEditor
 from EMHelper import ModelManager, EMImageGenerator
+from EMMetrics import Metrics
 from EMModel import NoteData
 
 
@@ -287,6 +288,7 @@ class NoteBadge(QLabel):
     def updateUI(self):
         self.repaint()
 
+    @Metrics.timed("NoteBadge.paintEvent")
     def paintEvent(self, paintEvent):
         painter = QPainter(self)
         if self.note is not None:
@@ -0,0 +1,470 @@
+"""
+Encounter Mapper is a tile-based encounter map creator for tabletop RPGs.
+Copyright 2019, 2020 Eric Symmank
+
+This file is part of Encounter Mapper.
+
+Encounter Mapper is free software: you can redistribute it
+and/or modify it under the terms of the GNU General Public License as
+published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+
+Encounter Mapper is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Encounter Mapper.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import hashlib
+import multiprocessing
+import os
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from PyQt5.QtCore import Qt, QBuffer, QByteArray, QIODevice
+from PyQt5.QtGui import QImage, QPainter
+
+from EMHelper import ModelManager, EMImageGenerator
+from EMModel import TileModel, GroupModel, MapModel, TextureModelLoader
+from EMMetrics import Metrics
+from EMCache import CacheManager
+
+
+class RenderService():
+    """
+    Renders tiles, groups and maps to PNG for other programs over HTTP.
+
+    Requests are answered by a RenderServer on localhost:
+
+    /tile/<uid>.png             ?cell=216&o=0&h=0&v=0&grid=0
+    /group/<uid>.png            ?cell=216&grid=0
+    /map/<name>.png             ?cell=216&region=x0,y0,x1,y1&grid=0
+    /thumbnail/<kind>/<id>.png  ?size=256
+
+    cell is the size of a grid cell in pixels, o/h/v the orientation and
+    flips of a tile, and region the cells (x0, y0) up to (x1, y1) of a
+    map. A thumbnail of a tile, group or map fits within size x size.
+    Tiles and groups come from the libraries in directory, and maps are
+    the .emap or .json files in mapDirectory.
+
+    Rendering happens in a pool of worker processes, each holding its own
+    copy of the libraries, so the server itself only parses requests and
+    sends PNGs. Every response is identified by a fingerprint: a hash of the
+    request and of the contents of the files it is rendered from. It is
+    sent as the ETag, so clients revalidating an unchanged image get a 304
+    without anything being rendered, and the PNGs are cached under it in
+    the "renders" cache of the CacheManager. Concurrent requests for the
+    same image wait for a single render. When a library file changes, the
+    workers are replaced with ones that load the new libraries.
+    """
+
+    CellSize = 216
+    ThumbnailSize = 256
+    # the largest side and area rendered for a single request; anything
+    # bigger should be exported as a Deep Zoom pyramid instead
+    MaxSide = 16384
+    MaxPixels = 64 * 1024 * 1024
+    # a lighter zlib level than the default, which encodes about three
+    # times faster for slightly larger files
+    PNGQuality = 80
+    MapExts = (ModelManager.MapExt, ModelManager.ConfigExt)
+    Libraries = (ModelManager.TextureName, ModelManager.TileName,
+                 ModelManager.GroupName)
+    # the library files each kind of request depends on
+    LibraryFiles = {
+        "tile": (ModelManager.TextureName, ModelManager.TileName),
+        "group": Libraries,
+        "map": (ModelManager.TextureName, ModelManager.TileName)
+    }
+    # maps each worker keeps loaded
+    WorkerMaps = 4
+
+    # fingerprint -> PNG bytes
+    renders = CacheManager.register("renders", len)
+
+    # the maps loaded by this process, when it is a worker,
+    # path -> (digest, model)
+    workerMaps = {}
+
+    def __init__(self, directory=None, mapDirectory=None, workers=None):
+        self.directory = os.path.abspath(
+            os.getcwd() if directory is None else directory)
+        self.mapDirectory = (self.directory if mapDirectory is None
+                             else os.path.abspath(mapDirectory))
+        self.workers = workers or max(1, os.cpu_count() or 1)
+        self.lock = threading.Lock()
+        # (path, mtime, size) -> sha1 of the contents
+        self.digests = {}
+        # fingerprint -> future of a render in progress
+        self.pending = {}
+        self.executor = None
+        self.libraryDigest = None
+
+    def libraryPath(self, name):
+        return os.path.join(self.directory, name + ModelManager.ConfigExt)
+
+    def fileDigest(self, path):
+        """Hash of the contents of path, only read again once it changes"""
+        stat = os.stat(path)
+        key = (path, stat.st_mtime_ns, stat.st_size)
+        digest = self.digests.get(key)
+        if digest is None:
+            f = open(path, "rb")
+            digest = hashlib.sha1(f.read()).hexdigest()
+            f.close()
+            self.digests[key] = digest
+        return digest
+
+    def mapPath(self, name):
+        # only plain file names, nothing outside of mapDirectory
+        if not name or name != os.path.basename(name) or name[0] == ".":
+            return None
+        for ext in self.MapExts:
+            path = os.path.join(self.mapDirectory, name + ext)
+            if os.path.isfile(path):
+                return path
+        return None
+
+    def fetchExecutor(self):
+        """
+        Return the worker pool, replacing it if the libraries have changed
+        since its workers loaded them.
+        """
+        digest = tuple(self.fileDigest(self.libraryPath(name))
+                       for name in self.Libraries)
+        with self.lock:
+            if self.executor is None or digest != self.libraryDigest:
+                if self.executor is not None:
+                    # renders already submitted still finish
+                    self.executor.shutdown(wait=False)
+                # spawned rather than forked, a copy of a process using Qt
+                # is not safe to use
+                self.executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=self.initWorker,
+                    initargs=(self.directory,
+                              CacheManager.budget // self.workers))
+                self.libraryDigest = digest
+            return self.executor
+
+    def close(self):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
+
+    @classmethod
+    def parseRequest(cls, url):
+        """
+        Turn a request path into (kind, ident, params), with params a tuple
+        of (cell, region, options, drawGrid, fit) in a canonical form.
+        Raises KeyError for unknown paths and ValueError for bad parameters.
+        """
+        parts = urlsplit(url)
+        path = [unquote(part) for part in parts.path.split("/") if part]
+        query = parse_qs(parts.query)
+
+        def param(name, default):
+            return query[name][-1] if name in query else default
+
+        fit = None
+        if path and path[0] == "thumbnail":
+            fit = int(param("size", cls.ThumbnailSize))
+            if fit < 1 or fit > cls.MaxSide:
+                raise ValueError("size must be between 1 and {}".format(
+                    cls.MaxSide))
+            # the size of a thumbnail does not depend on cell
+            query.pop("cell", None)
+            path = path[1:]
+        if len(path) != 2 or path[0] not in cls.LibraryFiles:
+            raise KeyError(parts.path)
+        kind = path[0]
+        ident = path[1][:-4] if path[1].endswith(".png") else path[1]
+        if kind != "map":
+            ident = int(ident)
+
+        cell = float(param("cell", cls.CellSize))
+        if not 0 < cell <= cls.MaxSide:
+            raise ValueError("cell must be between 0 and {}".format(
+                cls.MaxSide))
+        region = None
+        if kind == "map" and "region" in query:
+            region = tuple(int(v) for v in param("region", "").split(","))
+            if (len(region) != 4 or region[0] < 0 or region[1] < 0
+                    or region[2] <= region[0] or region[3] <= region[1]):
+                raise ValueError("region must be x0,y0,x1,y1")
+        options = (0, False, False)
+        if kind == "tile":
+            options = (int(param("o", 0)) % 4, param("h", "0") == "1",
+                       param("v", "0") == "1")
+        drawGrid = param("grid", "0") == "1"
+        return (kind, ident, (cell, region, options, drawGrid, fit))
+
+    def fingerprint(self, kind, ident, params):
+        """
+        Return (fingerprint, path, digest) of a request, where path and
+        digest are those of the map file for map requests.
+        """
+        digest = hashlib.sha1(repr((kind, ident, params)).encode("utf-8"))
+        for name in self.LibraryFiles[kind]:
+            digest.update(self.fileDigest(self.libraryPath(name)).encode(
+                "utf-8"))
+        path = None
+        mapDigest = None
+        if kind == "map":
+            path = self.mapPath(ident)
+            if path is None:
+                raise KeyError(ident)
+            mapDigest = self.fileDigest(path)
+            digest.update(mapDigest.encode("utf-8"))
+        return (digest.hexdigest(), path, mapDigest)
+
+    def render(self, kind, ident, params, fingerprint, path=None,
+               mapDigest=None):
+        """Return the PNG of a request, rendering it only if not cached"""
+        png = self.renders.get(fingerprint)
+        if png is not None:
+            return png
+        executor = self.fetchExecutor()
+        with self.lock:
+            future = self.pending.get(fingerprint)
+            owner = future is None
+            if owner:
+                future = executor.submit(self.renderRequest, kind, ident,
+                                         params, path, mapDigest)
+                self.pending[fingerprint] = future
+        try:
+            png = future.result()
+        except BrokenProcessPool:
+            # a worker died, start over with a new pool next time
+            with self.lock:
+                if self.executor is executor:
+                    self.executor = None
+            raise
+        finally:
+            if owner:
+                with self.lock:
+                    self.pending.pop(fingerprint, None)
+        if owner:
+            self.renders[fingerprint] = png
+        return png
+
+    def createServer(self, address=("127.0.0.1", 8642)):
+        return RenderServer(address, self)
+
+    @classmethod
+    def initWorker(cls, directory, budget):
+        os.chdir(directory)
+        CacheManager.setBudget(budget)
+        ModelManager.loadModelListFromFile(ModelManager.TextureName,
+                                           TextureModelLoader)
+        ModelManager.loadModelListFromFile(ModelManager.TileName, TileModel)
+        ModelManager.loadModelListFromFile(ModelManager.GroupName,
+                                           GroupModel)
+
+    @classmethod
+    def fetchWorkerModel(cls, kind, ident, path, mapDigest):
+        if kind == "tile":
+            model = ModelManager.fetchByUid(ModelManager.TileName, ident)
+        elif kind == "group":
+            model = ModelManager.fetchByUid(ModelManager.GroupName, ident)
+        else:
+            cached = cls.workerMaps.pop(path, None)
+            if cached is None or cached[0] != mapDigest:
+                model = ModelManager.loadModelFromFile(path, MapModel)
+                cached = (mapDigest, model)
+            # most recently used last
+            cls.workerMaps[path] = cached
+            while len(cls.workerMaps) > cls.WorkerMaps:
+                del cls.workerMaps[next(iter(cls.workerMaps))]
+            model = cached[1]
+        if model is None:
+            raise KeyError(ident)
+        return model
+
+    @classmethod
+    @Metrics.timed("RenderService.renderRequest")
+    def renderRequest(cls, kind, ident, params, path=None, mapDigest=None):
+        """Render a request in a worker and return it encoded as PNG"""
+        cell, region, options, drawGrid, fit = params
+        model = cls.fetchWorkerModel(kind, ident, path, mapDigest)
+        res = cls.CellSize
+        if kind == "tile":
+            nc = nr = 1
+        else:
+            nc = model.getNumCols()
+            nr = model.getNumRows()
+        if region is None:
+            region = (0, 0, nc, nr)
+        elif region[2] > nc or region[3] > nr:
+            raise ValueError("region exceeds the {}x{} map".format(nc, nr))
+        cols = region[2] - region[0]
+        rows = region[3] - region[1]
+        if fit is not None:
+            cell = fit / max(cols, rows)
+        width = max(1, round(cell * cols))
+        height = max(1, round(cell * rows))
+        if (max(width, height) > cls.MaxSide
+                or width * height > cls.MaxPixels):
+            raise ValueError("{}x{} is too large to render".format(
+                width, height))
+
+        img = QImage(width, height, EMImageGenerator.RenderFormat)
+        img.fill(Qt.transparent)
+        painter = QPainter(img)
+        painter.scale(width / (res * cols), height / (res * rows))
+        if kind == "tile":
+            EMImageGenerator.drawTile(painter, model, 0, 0, options)
+        else:
+            painter.translate(-res * region[0], -res * region[1])
+            EMImageGenerator.drawTileGroup(painter, model, region)
+            painter.translate(res * region[0], res * region[1])
+        if drawGrid:
+            EMImageGenerator.drawGrid(painter, cols, rows, 0, 0, res,
+                                      Qt.black,
+                                      EMImageGenerator.GridPatternExport)
+        painter.end()
+        return cls.encodePNG(img)
+
+    @classmethod
+    def encodePNG(cls, img):
+        # renders are premultiplied, PNG stores straight alpha
+        data = QByteArray()
+        buffer = QBuffer(data)
+        buffer.open(QIODevice.WriteOnly)
+        img.convertToFormat(QImage.Format_ARGB32).save(
+            buffer, "PNG", cls.PNGQuality)
+        buffer.close()
+        return bytes(data)
+
+
+class RenderServer(ThreadingHTTPServer):
+    """The HTTP server of a RenderService, one thread per connection"""
+
+    daemon_threads = True
+    verbose = False
+
+    def __init__(self, address, service):
+        self.service = service
+        super(RenderServer, self).__init__(address, RenderRequestHandler)
+
+    def handle_error(self, request, clientAddress):
+        # clients closing their connection early are nothing to report
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super(RenderServer, self).handle_error(request, clientAddress)
+
+
+class RenderRequestHandler(BaseHTTPRequestHandler):
+    """
+    Answers GET requests for renders. A PNG is encoded completely before
+    it is sent, as it is cached under its fingerprint, and its length goes
+    out as the Content-Length.
+    """
+
+    protocol_version = "HTTP/1.1"
+    # headers and body go out in separate writes
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        service = self.server.service
+        try:
+            kind, ident, params = service.parseRequest(self.path)
+            fingerprint, path, mapDigest = service.fingerprint(
+                kind, ident, params)
+        except (KeyError, OSError):
+            self.sendError(404, "Not Found")
+            return
+        except ValueError as e:
+            self.sendError(400, str(e))
+            return
+
+        etag = '"{}"'.format(fingerprint)
+        if etag in self.headers.get("If-None-Match", ""):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        try:
+            png = service.render(kind, ident, params, fingerprint, path,
+                                 mapDigest)
+        except KeyError:
+            self.sendError(404, "Not Found")
+            return
+        except ValueError as e:
+            self.sendError(400, str(e))
+            return
+        except Exception as e:
+            print("WARNING: rendering {} failed: {}".format(self.path, e))
+            self.sendError(500, "Render failed")
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(png)))
+        self.send_header("ETag", etag)
+        # always revalidate, the ETag changes along with the files
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(png)
+
+    def sendError(self, status, message):
+        body = (message + "\n").encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super(RenderRequestHandler, self).log_message(format, *args)
+
+
+def main(argv=None):
+    # the render workers are spawned by running this program again, which
+    # in a frozen build must start a worker rather than the server
+    multiprocessing.freeze_support()
+    parser = argparse.ArgumentParser(
+        description="Serve renders of Encounter Mapper tiles, groups and "
+                    "maps on localhost")
+    parser.add_argument("--directory",
+                        help="directory of the libraries (default: current)")
+    parser.add_argument("--maps",
+                        help="directory of the maps (default: --directory)")
+    parser.add_argument("--port", type=int, default=8642,
+                        help="port to listen on (default 8642)")
+    parser.add_argument("--workers", type=int,
+                        help="render processes (default: one per CPU)")
+    parser.add_argument("--verbose", action="store_true",
+                        help="log every request")
+    args = parser.parse_args(argv)
+
+    service = RenderService(args.directory, args.maps, args.workers)
+    server = service.createServer(("127.0.0.1", args.port))
+    server.verbose = args.verbose
+    print("Serving renders on http://127.0.0.1:{}/".format(
+        server.server_address[1]), file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -23,11 +23,13 @@ from PyQt5.QtCore import Qt
 from PyQt5.QtGui import QPainter, QColor, QPalette
 from PyQt5.QtWidgets import (QWidget, QPushButton, QSpinBox, QSlider,
                              QApplication, QGridLayout, QLabel, QComboBox,
-                             QHBoxLayout, QRadioButton)
+                             QHBoxLayout, QRadioButton, QFileDialog,
+                             QMessageBox)
 
 from EMBaseClasses import EMModelEditor, EMModelGraphics
-from EMModel import GeneratedTextureModel
+from EMModel import GeneratedTextureModel, ImageTextureModel
 from EMHelper import EMImageGenerator, ModelManager
+from EMMetrics import Metrics
 
 
 class TextureEditor(EMModelEditor):
@@ -43,6 +45,11 @@ class TextureEditor(EMModelEditor):
         self.uploadImageBtn.clicked.connect(self.uploadImage)
         self.removeImageBtn = QPushButton("Remove Image")
         self.removeImageBtn.clicked.connect(self.removeImage)
+        # source path of the image being imported, if any
+        self.pendingImage = None
+        importer = ModelManager.fetchTextureImporter()
+        importer.imported.connect(self.imageImported)
+        importer.importFailed.connect(self.imageImportFailed)
 
         # Pick the Grayscale Textures
         self.txtPicker = QComboBox()
@@ -198,7 +205,13 @@ class TextureEditor(EMModelEditor):
     def updateUI(self):
         isGenModel = isinstance(self.model, GeneratedTextureModel)
 
-        self.removeImageBtn.setEnabled(not isGenModel)
+        importing = self.pendingImage is not None
+        self.uploadImageBtn.setEnabled(not importing)
+        self.removeImageBtn.setEnabled(not isGenModel and not importing)
+        self.setBGColorBtn.setEnabled(isGenModel)
+        self.setSubColorBtn.setEnabled(isGenModel)
+        self.subRadio1.setEnabled(isGenModel)
+        self.subRadio2.setEnabled(isGenModel)
         self.txtPicker.setEnabled(isGenModel)
         self.rBox.setEnabled(isGenModel)
         self.rSlider.setEnabled(isGenModel)
@@ -303,10 +316,52 @@ class TextureEditor(EMModelEditor):
         self.setCurrentColor()
 
     def uploadImage(self):
-        pass
+        filePath = QFileDialog.getOpenFileName(
+            self, "Upload Image", "",
+            "Image (*.png *.jpg *.jpeg *.bmp *.gif *.tif *.tiff *.webp)")
+        if filePath is not None and filePath[0]:
+            # decoding large images takes a while, so it happens on the
+            # importer's worker and the model is swapped once it is done
+            self.pendingImage = filePath[0]
+            self.updateUI()
+            ModelManager.fetchTextureImporter().importImage(filePath[0])
+
+    def imageImported(self, source):
+        if source != self.pendingImage:
+            return
+        self.pendingImage = None
+        if isinstance(self.model, ImageTextureModel):
+            self.model.setFilePath(source)
+        else:
+            self.setTextureModel(ImageTextureModel(
+                self.model.getName(), source, self.model.getTags(),
+                self.model.getUid()))
+
+    def imageImportFailed(self, source, error):
+        if source != self.pendingImage:
+            return
+        self.pendingImage = None
+        self.updateUI()
+        QMessageBox.warning(self, "Upload Image",
+                            "{} could not be imported:\n{}".format(
+                                source, error))
 
     def removeImage(self):
-        pass
+        if isinstance(self.model, ImageTextureModel):
+            # the stored copy stays, other textures may use the same image
+            self.setTextureModel(GeneratedTextureModel(
+                self.model.getName(), tags=self.model.getTags(),
+                uid=self.model.getUid()))
+
+    def setTextureModel(self, model):
+        """Switch between a generated and an image texture"""
+        self.model.modelUpdated.disconnect(self.updateUI)
+        self.model = model
+        self.model.modelUpdated.connect(self.updateUI)
+        self.previewWidget.model = model
+        if isinstance(model, GeneratedTextureModel):
+            self.currentSelectedColor = QColor(model.getBgColor())
+        self.updateUI()
 
     def rUpdated(self, r):
         self.rBox.setValue(r)
@@ -382,8 +437,14 @@ class TextureEditPreview(EMModelGraphics):
         return cls(model, 50, 50)
 
     def updateImage(self):
-        self.generatedImage = EMImageGenerator.genImageFromModel(self.model)
-
+        # the editor calls this on every UI update, so only render again
+        # when the texture has actually changed since the last render
+        if self.model.isDirty():
+            self.generatedImage = EMImageGenerator.genImageFromModel(
+                self.model)
+            self.model.setDirty(False)
+
+    @Metrics.timed("TextureEditPreview.paintEvent")
     def paintEvent(self, paintEvent):
         if self.generatedImage is not None:
             painter = QPainter(self)
@@ -401,6 +462,7 @@ class TexturePreview(EMModelGraphics):
     def previewWidget(cls, model):
         return cls(model, 50, 50)
 
+    @Metrics.timed("TexturePreview.paintEvent")
     def paintEvent(self, paintEvent):
         painter = QPainter(self)
         img = EMImageGenerator.getTextureImage(self.model.getUid())
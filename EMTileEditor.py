@@ -26,9 +26,10 @@ from PyQt5.QtWidgets import (QApplication, QGridLayout, QHBoxLayout,  QLabel,
                              QListWidget, QDialog, QVBoxLayout)
 
 from EMPaletteEditor import EMPaletteEditor
-from EMModel import TileModel, GeneratedTextureModel
+from EMModel import TileModel, TextureModelLoader
 from EMBaseClasses import EMModelEditor, EMModelGraphics, EMModelPicker
 from EMHelper import EMImageGenerator, ModelManager
+from EMMetrics import Metrics
 from EMTextureEditor import TextureEditor, TexturePreview
 
 
@@ -56,7 +57,7 @@ class TileEditor(EMModelEditor):
         self.previewWidget.pointSelected.connect(self.setSelectedPoint)
 
         self.textureList = EMModelPicker(
-            ModelManager.TextureName, GeneratedTextureModel,
+            ModelManager.TextureName, TextureModelLoader,
             TextureEditor, TexturePreview)
         self.textureList.selectedModel.connect(self.setSelectedTexture)
         self.shapeList = QListWidget()
@@ -367,16 +368,28 @@ class TilePreviewWidget(EMModelGraphics):
     def setSelectedPoint(self, point):
         self.selectedPoint = point
 
+    @Metrics.timed("TilePreviewWidget.paintEvent")
     def paintEvent(self, paintEvent):
         painter = QPainter(self)
         if self.model is not None:
-            self.modelImage = EMImageGenerator.genImageFromModel(self.model)
+            if self.preview:
+                self.modelImage = EMImageGenerator.fetchModelImage(
+                    ModelManager.TileName, self.model)
+            elif self.draft:
+                self.modelImage = EMImageGenerator.genImageFromModel(
+                    self.model, {"draft": True})
+            else:
+                self.modelImage = EMImageGenerator.genImageFromModel(
+                    self.model)
             # tempImg = EMImageGenerator.genImageFromModel(
             #     self.model)
             # TODO: Convert to Pixmap
+            quality = (Qt.FastTransformation if self.draft
+                       else Qt.SmoothTransformation)
             painter.drawImage(10, 10,
                               self.modelImage.scaled(
-                                  self.tileSize, self.tileSize))
+                                  self.tileSize, self.tileSize,
+                                  Qt.IgnoreAspectRatio, quality))
             EMImageGenerator.drawGrid(painter, 1, 1, 10, 10, self.tileSize)
 
             # self.drawTile(painter, 0, 0, self.model)
@@ -426,6 +439,7 @@ class TilePreviewWidget(EMModelGraphics):
             QMouseEvent.ignore()
         else:
             if self.binkedPoint:
+                self.beginDraft()
                 mp = self.mousePosScale(QMouseEvent.pos())
                 self.model.updatePoint(self.selectedShape, self.selectedPoint,
                                        mp[0], mp[1])
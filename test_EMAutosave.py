@@ -0,0 +1,160 @@
+"""
+Encounter Mapper is a tile-based encounter map creator for tabletop RPGs.
+Copyright 2019, 2020 Eric Symmank
+
+This file is part of Encounter Mapper.
+
+Encounter Mapper is free software: you can redistribute it
+and/or modify it under the terms of the GNU General Public License as
+published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+
+Encounter Mapper is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Encounter Mapper.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+# the tests never need a display
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+import shutil  # noqa: E402
+import tempfile  # noqa: E402
+import unittest  # noqa: E402
+
+from PyQt5.QtWidgets import QApplication  # noqa: E402
+
+from EMAutosave import AutosaveService  # noqa: E402
+from EMHelper import ModelManager  # noqa: E402
+from EMModel import MapModel  # noqa: E402
+
+app = QApplication.instance() or QApplication([])
+
+
+class AutosaveServiceTest(unittest.TestCase):
+    """Autosaves surviving crashes and failed writes"""
+
+    Tile = (2, 1, True, False)
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="em_test_")
+        self.services = []
+
+    def tearDown(self):
+        for service in self.services:
+            service.timer.stop()
+        ModelManager.fetchSaveQueue().waitForIdle()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def createService(self, model):
+        service = AutosaveService(model, self.directory)
+        self.services.append(service)
+        return service
+
+    def settle(self):
+        # let the save worker finish and deliver its signals
+        ModelManager.fetchSaveQueue().waitForIdle()
+        app.processEvents()
+        ModelManager.fetchSaveQueue().waitForIdle()
+
+    def createMap(self):
+        grid = [[(-1, 0, False, False) for x in range(3)] for y in range(3)]
+        return MapModel("map", grid)
+
+    def testRecoveredMapIsWrittenAgain(self):
+        service = self.createService(self.createMap())
+        service.model.setTileForIndex(1, 1, self.Tile)
+        service.checkpoint()
+        self.settle()
+
+        model, source = AutosaveService.recoverModel(self.directory)
+        self.assertEqual(model.getTileGrid()[1][1], self.Tile)
+        # opening the recovered map takes over the autosave directory
+        self.createService(model).markRecovered(source)
+        self.settle()
+
+        self.assertTrue(AutosaveService.hasRecovery(self.directory))
+        model, source = AutosaveService.recoverModel(self.directory)
+        self.assertEqual(model.getTileGrid()[1][1], self.Tile)
+
+    def testUnclaimedRecoveryIsKept(self):
+        crashed = self.createService(self.createMap())
+        crashed.model.setTileForIndex(1, 1, self.Tile)
+        crashed.checkpoint()
+        crashed.model.setTileForIndex(0, 1, self.Tile)
+        crashed.checkpoint()
+        self.settle()
+
+        # another map given the directory leaves the changes alone
+        service = self.createService(self.createMap())
+        self.settle()
+        self.assertTrue(AutosaveService.hasRecovery(self.directory))
+        model, source = AutosaveService.recoverModel(self.directory)
+        self.assertEqual(model.getTileGrid()[1][1], self.Tile)
+        self.assertEqual(model.getTileGrid()[1][0], self.Tile)
+
+        # until it is recovered, which replaces every file it came from
+        self.assertGreaterEqual(service.generation, crashed.generation)
+        service.setModel(model)
+        service.markRecovered(source)
+        self.settle()
+        self.assertEqual(len([name for name in os.listdir(self.directory)
+                              if name.startswith("delta_")]), 0)
+        model, source = AutosaveService.recoverModel(self.directory)
+        self.assertEqual(model.getTileGrid()[1][0], self.Tile)
+
+        AutosaveService.discardDirectory(self.directory)
+        self.settle()
+        self.assertFalse(AutosaveService.hasRecovery(self.directory))
+
+    def testFailedFoldKeepsPreviousFiles(self):
+        service = self.createService(self.createMap())
+        service.model.setTileForIndex(0, 0, self.Tile)
+        service.checkpoint()
+        self.settle()
+        service.model.setTileForIndex(2, 2, self.Tile)
+        service.checkpoint()
+        self.settle()
+        before = sorted(os.listdir(self.directory))
+
+        # the fold cannot read its base
+        service.base = os.path.join(self.directory, "missing.emap")
+        service.fold()
+        ModelManager.fetchSaveQueue().waitForIdle()
+        for name in before:
+            self.assertTrue(os.path.exists(os.path.join(self.directory,
+                                                        name)))
+
+        # and the model is written out in full instead
+        self.settle()
+        model, source = AutosaveService.recoverModel(self.directory)
+        self.assertEqual(model.getTileGrid()[0][0], self.Tile)
+        self.assertEqual(model.getTileGrid()[2][2], self.Tile)
+
+    def testAutosavesAreNotReported(self):
+        reported = []
+        saveQueue = ModelManager.fetchSaveQueue()
+        saveQueue.saveStarted.connect(reported.append)
+        saveQueue.saveFinished.connect(reported.append)
+        try:
+            service = self.createService(self.createMap())
+            for x in range(3):
+                service.model.setTileForIndex(x, 0, self.Tile)
+                service.checkpoint()
+            service.fold()
+            service.writeSession()
+            self.settle()
+        finally:
+            saveQueue.saveStarted.disconnect(reported.append)
+            saveQueue.saveFinished.disconnect(reported.append)
+        self.assertEqual(reported, [])
+        self.assertTrue(AutosaveService.hasRecovery(self.directory))
+
+
+if __name__ == "__main__":
+    unittest.main()
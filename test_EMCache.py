@@ -0,0 +1,108 @@
+"""
+Encounter Mapper is a tile-based encounter map creator for tabletop RPGs.
+Copyright 2019, 2020 Eric Symmank
+
+This file is part of Encounter Mapper.
+
+Encounter Mapper is free software: you can redistribute it
+and/or modify it under the terms of the GNU General Public License as
+published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+
+Encounter Mapper is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Encounter Mapper.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import unittest
+
+from EMCache import CacheManager
+
+
+class CacheManagerTest(unittest.TestCase):
+    """Eviction across caches sharing the budget of the CacheManager"""
+
+    def setUp(self):
+        self.budget = CacheManager.budget
+        CacheManager.setBudget(100)
+        # values are their own size in bytes
+        self.first = CacheManager.register("test_first", lambda value: value)
+        self.second = CacheManager.register("test_second",
+                                            lambda value: value)
+
+    def tearDown(self):
+        for cache in (self.first, self.second):
+            cache.clear()
+            del CacheManager.caches[cache.name]
+        CacheManager.setBudget(self.budget)
+
+    def testLeastRecentlyUsedAcrossCaches(self):
+        self.first["a"] = 40
+        self.second["b"] = 40
+        # a is now more recently used than b
+        self.assertEqual(self.first["a"], 40)
+        self.first["c"] = 40
+
+        self.assertIn("a", self.first)
+        self.assertNotIn("b", self.second)
+        self.assertIn("c", self.first)
+        self.assertEqual(self.second.stats()["evictions"], 1)
+        self.assertEqual(self.first.stats()["evictions"], 0)
+        self.assertEqual(CacheManager.stats()["total"]["bytes"], 80)
+
+    def testContainsDoesNotTouch(self):
+        self.first["a"] = 40
+        self.first["b"] = 40
+        self.assertIn("a", self.first)
+        self.first["c"] = 40
+        self.assertNotIn("a", self.first)
+
+    def testValueLargerThanBudget(self):
+        self.first["a"] = 10
+        self.first["big"] = 500
+        # everything else goes, but the value just stored is kept
+        self.assertEqual(self.first.keys(), ["big"])
+        self.assertEqual(self.first.stats()["evictions"], 1)
+
+    def testReplaceAndRemove(self):
+        self.first["a"] = 30
+        self.first["a"] = 50
+        self.assertEqual(self.first.stats()["bytes"], 50)
+        self.assertEqual(self.first.pop("a"), 50)
+        self.assertEqual(self.first.stats()["bytes"], 0)
+        with self.assertRaises(KeyError):
+            del self.first["a"]
+
+    def testShrinkAndBudget(self):
+        for key in "abcde":
+            self.first[key] = 20
+        CacheManager.shrink(0.5)
+        self.assertEqual(self.first.keys(), ["d", "e"])
+        CacheManager.setBudget(20)
+        self.assertEqual(self.first.keys(), ["e"])
+
+    def testHitsAndMisses(self):
+        self.first["a"] = 10
+        self.first.get("a")
+        self.first.get("b")
+        with self.assertRaises(KeyError):
+            self.first["c"]
+        stats = self.first.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 2))
+        self.assertEqual(stats["entries"], 1)
+
+    def testParseBudget(self):
+        self.assertEqual(CacheManager.parseBudget("256M"), 256 * 1024 ** 2)
+        self.assertEqual(CacheManager.parseBudget("1g"), 1024 ** 3)
+        self.assertEqual(CacheManager.parseBudget("4096"), 4096)
+        self.assertEqual(CacheManager.parseBudget(None),
+                         CacheManager.DefaultBudget)
+
+
+if __name__ == "__main__":
+    unittest.main()
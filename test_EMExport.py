@@ -0,0 +1,60 @@
+"""
+Encounter Mapper is a tile-based encounter map creator for tabletop RPGs.
+Copyright 2019, 2020 Eric Symmank
+
+This file is part of Encounter Mapper.
+
+Encounter Mapper is free software: you can redistribute it
+and/or modify it under the terms of the GNU General Public License as
+published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+
+Encounter Mapper is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Encounter Mapper.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+# the tests never need a display
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+import unittest  # noqa: E402
+from xml.etree import ElementTree  # noqa: E402
+
+from PyQt5.QtWidgets import QApplication  # noqa: E402
+
+from EMExport import VectorExporter  # noqa: E402
+from EMModel import MapModel, NoteData  # noqa: E402
+
+app = QApplication.instance() or QApplication([])
+
+
+class VectorExporterTest(unittest.TestCase):
+    """Maps exported as SVG"""
+
+    Svg = "{http://www.w3.org/2000/svg}"
+
+    def testNotes(self):
+        notes = [NoteData(1, "Ogre <boss>", "Asleep", 1.5, 1.5),
+                 NoteData(3, "Chest", "", 2, 0.5)]
+        grid = [[(-1, 0, False, False)] * 3 for y in range(2)]
+        model = MapModel("map", grid, mapNotes=notes)
+
+        root = ElementTree.fromstring(
+            VectorExporter.svgDocument(model).encode("utf-8"))
+
+        titles = [title.text for title in root.iter(self.Svg + "title")]
+        self.assertEqual(titles, ["Ogre <boss>\nAsleep", "Chest"])
+        numbers = [text.text for text in root.iter(self.Svg + "text")]
+        self.assertEqual(numbers, ["1", "2"])
+        # one badge for each type of note
+        self.assertEqual(len(list(root.iter(self.Svg + "image"))), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,137 @@
+"""
+Encounter Mapper is a tile-based encounter map creator for tabletop RPGs.
+Copyright 2019, 2020 Eric Symmank
+
+This file is part of Encounter Mapper.
+
+Encounter Mapper is free software: you can redistribute it
+and/or modify it under the terms of the GNU General Public License as
+published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+
+Encounter Mapper is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Encounter Mapper.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+# the tests never need a display
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+import shutil  # noqa: E402
+import tempfile  # noqa: E402
+import unittest  # noqa: E402
+
+from PyQt5.QtWidgets import QApplication  # noqa: E402
+
+from EMAutosave import AutosaveService  # noqa: E402
+from EMHelper import ModelManager  # noqa: E402
+from EMMapEditor import MapEditor, MapEditorGraphics  # noqa: E402
+from EMModel import MapModel  # noqa: E402
+
+app = QApplication.instance() or QApplication([])
+
+
+class MapEditorGraphicsTest(unittest.TestCase):
+    """Edits made through the map editor"""
+
+    Tile = (3, 1, False, True)
+
+    def setUp(self):
+        grid = [[MapEditorGraphics.EmptyTile for x in range(4)]
+                for y in range(4)]
+        self.model = MapModel("map", grid)
+        self.graphics = MapEditorGraphics(self.model)
+
+    def tearDown(self):
+        self.graphics.deleteLater()
+
+    def testUndoAfterDelRow(self):
+        self.graphics.applyEdit([(1, 3)], [self.Tile])
+        self.model.delRow()
+
+        self.graphics.undo()
+        self.graphics.redo()
+
+        self.assertEqual(self.model.getNumRows(), 3)
+        self.assertEqual(self.model.getTileCounts(), {-1: 12})
+
+    def testUndoAfterAddRow(self):
+        self.graphics.applyEdit([(1, 3)], [self.Tile])
+        self.model.addRow()
+
+        self.graphics.undo()
+
+        self.assertEqual(self.model.getTileGrid()[3][1],
+                         MapEditorGraphics.EmptyTile)
+
+
+class MapEditorSaveTest(unittest.TestCase):
+    """Maps only count as saved once their file has been written"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="em_test_")
+        grid = [[MapEditorGraphics.EmptyTile for x in range(3)]
+                for y in range(3)]
+        self.editor = MapEditor(MapModel("map", grid),
+                                os.path.join(self.directory, "autosave"))
+        self.document = self.editor.document
+        self.editor.getModel().setTileForIndex(0, 0, (1, 0, False, False))
+
+    def tearDown(self):
+        for document in list(self.editor.documents):
+            document.autosave.close()
+        ModelManager.fetchSaveQueue().waitForIdle()
+        app.processEvents()
+        self.editor.deleteLater()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def settle(self):
+        ModelManager.fetchSaveQueue().waitForIdle()
+        app.processEvents()
+
+    def testNewMapKeepsOutOfCrashData(self):
+        root = os.path.join(self.directory, "autosave")
+        crashed = AutosaveService(MapModel("crashed"),
+                                  os.path.join(root, "map_1"))
+        crashed.model.setTileForIndex(0, 0, (1, 0, False, False))
+        crashed.checkpoint()
+        crashed.timer.stop()
+        self.settle()
+
+        document = self.editor.openMap(MapModel("new"))
+        self.assertEqual(document.autosaveDirectory,
+                         os.path.join(root, "map_2"))
+        self.assertTrue(AutosaveService.hasRecovery(crashed.directory))
+
+        # only the map recovered from it takes the directory over
+        model, source = AutosaveService.recoverModel(crashed.directory)
+        document = self.editor.openMap(model, None, crashed.directory)
+        self.assertEqual(document.autosaveDirectory, crashed.directory)
+
+    def testSaved(self):
+        self.editor.saveMap(os.path.join(self.directory, "map.emap"))
+        self.assertTrue(self.document.edited)
+        self.settle()
+        self.assertFalse(self.document.edited)
+
+    def testSaveFailed(self):
+        self.editor.saveMap(os.path.join(self.directory, "missing",
+                                         "map.emap"))
+        self.settle()
+        self.assertTrue(self.document.edited)
+
+    def testEditedWhileSaving(self):
+        self.editor.saveMap(os.path.join(self.directory, "map.emap"))
+        self.editor.getModel().setTileForIndex(1, 0, (1, 0, False, False))
+        self.settle()
+        self.assertTrue(self.document.edited)
+
+
+if __name__ == "__main__":
+    unittest.main()
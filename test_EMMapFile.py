@@ -0,0 +1,156 @@
+"""
+Encounter Mapper is a tile-based encounter map creator for tabletop RPGs.
+Copyright 2019, 2020 Eric Symmank
+
+This file is part of Encounter Mapper.
+
+Encounter Mapper is free software: you can redistribute it
+and/or modify it under the terms of the GNU General Public License as
+published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+
+Encounter Mapper is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Encounter Mapper.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from EMHelper import ModelManager
+from EMMapFile import MapFileFormat, ChunkedTileGrid
+from EMModel import MapModel, NoteData
+
+
+def makeMap(rows, cols):
+    # runs of equal tiles as well as single cells, so RLE has both to do
+    grid = [[((x // 3 + y) % 5 - 1, x % 4, x % 5 == 0, y % 3 == 0)
+             for x in range(cols)] for y in range(rows)]
+    notes = [NoteData(0, "Entrance", "Stairs down", 0, 0, 0)]
+    return MapModel("map", grid, mapNotes=notes)
+
+
+def tiles(grid):
+    return [[tuple(tile) for tile in row] for row in grid]
+
+
+class MapFileRoundTripTest(unittest.TestCase):
+    """Writing maps with dumps() and reading them back with load()"""
+
+    Sizes = ((1, 1), (1, 7), (5, 3), (32, 32), (33, 65), (70, 70))
+    Flags = ((False, False), (True, False), (False, True), (True, True))
+
+    def roundTrip(self, model, **options):
+        data = MapFileFormat.dumps(model.jsonObj(), **options)
+        f = io.BytesIO(data)
+        self.assertTrue(MapFileFormat.isMapFile(f))
+        return MapFileFormat.load(f)
+
+    def testPlain(self):
+        for (rows, cols) in self.Sizes:
+            model = makeMap(rows, cols)
+            for (rle, compress) in self.Flags:
+                with self.subTest(rows=rows, cols=cols, rle=rle,
+                                  compress=compress):
+                    js = self.roundTrip(model, rle=rle, compress=compress,
+                                        chunked=False)
+                    self.assertEqual(tiles(js["grid"]),
+                                     tiles(model.getTileGrid()))
+                    self.assertEqual(js["name"], model.getName())
+                    self.assertEqual(js["notes"], model.jsonObj()["notes"])
+
+    def testChunked(self):
+        for (rows, cols) in self.Sizes:
+            model = makeMap(rows, cols)
+            for (rle, compress) in self.Flags:
+                with self.subTest(rows=rows, cols=cols, rle=rle,
+                                  compress=compress):
+                    js = self.roundTrip(model, rle=rle, compress=compress,
+                                        chunked=True)
+                    # read from a stream without a name, so loaded at once
+                    self.assertTrue(js["grid"].isLoaded())
+                    self.assertEqual(tiles(js["grid"]),
+                                     tiles(model.getTileGrid()))
+                    self.assertEqual(js["counts"],
+                                     model.jsonObj().get("counts"))
+
+    def testNotAMapFile(self):
+        f = io.BytesIO(b"{\"name\": \"map\"}")
+        self.assertFalse(MapFileFormat.isMapFile(f))
+        self.assertEqual(f.tell(), 0)
+        with self.assertRaises(ValueError):
+            MapFileFormat.load(f)
+
+    def testTruncated(self):
+        data = MapFileFormat.dumps(makeMap(5, 5).jsonObj(), chunked=False)
+        with self.assertRaises(ValueError):
+            MapFileFormat.load(io.BytesIO(data[:-8]))
+
+
+class ChunkedLoadTest(unittest.TestCase):
+    """Lazily reading a chunked map from a file"""
+
+    Rows = 100
+    Cols = 90
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="em_test_")
+        self.path = os.path.join(self.directory, "map.emap")
+        self.model = makeMap(self.Rows, self.Cols)
+        self.write(self.model)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def write(self, model):
+        # replaced like ModelManager.writeFileAtomic() replaces files
+        tmpPath = self.path + ".tmp"
+        f = open(tmpPath, "wb")
+        f.write(MapFileFormat.dumps(model.jsonObj()))
+        f.close()
+        os.replace(tmpPath, self.path)
+
+    def testLazyRead(self):
+        loaded = ModelManager.loadModelFromFile(self.path, MapModel)
+        grid = loaded.getTileGrid()
+        self.assertIsInstance(grid, ChunkedTileGrid)
+        self.assertFalse(grid.isLoaded())
+
+        # only the band of rows 64-95 is read
+        self.assertEqual(tiles([grid[80]]),
+                         tiles([self.model.getTileGrid()[80]]))
+        self.assertFalse(grid.isLoaded())
+        self.assertIsNone(list.__getitem__(grid, 40))
+        self.assertIsNotNone(list.__getitem__(grid, 64))
+
+        self.assertEqual(loaded.getTileCounts(), self.model.countTiles())
+        self.assertEqual(tiles(grid), tiles(self.model.getTileGrid()))
+        self.assertTrue(grid.isLoaded())
+        # the file is let go of once everything has been read
+        self.assertIsNone(grid.file)
+
+    def testFileReplaced(self):
+        loaded = ModelManager.loadModelFromFile(self.path, MapModel)
+        self.write(makeMap(10, 10))
+        self.assertEqual(tiles([loaded.getTileGrid()[80]]),
+                         tiles([self.model.getTileGrid()[80]]))
+
+    def testFileChangedInPlace(self):
+        loaded = ModelManager.loadModelFromFile(self.path, MapModel)
+        f = open(self.path, "r+b")
+        f.truncate(os.path.getsize(self.path) // 2)
+        f.close()
+        with self.assertRaises(IOError):
+            loaded.getTileGrid()[80]
+
+
+if __name__ == "__main__":
+    unittest.main()
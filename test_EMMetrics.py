@@ -0,0 +1,62 @@
+"""
+Encounter Mapper is a tile-based encounter map creator for tabletop RPGs.
+Copyright 2019, 2020 Eric Symmank
+
+This file is part of Encounter Mapper.
+
+Encounter Mapper is free software: you can redistribute it
+and/or modify it under the terms of the GNU General Public License as
+published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+
+Encounter Mapper is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Encounter Mapper.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import unittest
+
+from EMMetrics import Metrics, TimerStats
+
+
+class MetricsTest(unittest.TestCase):
+    """Summaries of the timers, which must not grow with every sample"""
+
+    def setUp(self):
+        self.samples = Metrics.samples
+        Metrics.samples = {}
+
+    def tearDown(self):
+        Metrics.samples = self.samples
+
+    def testSummary(self):
+        for ms in range(1, 101):
+            Metrics.record("test", ms / 1000)
+        timer = Metrics.summary()["timers"]["test"]
+        self.assertEqual(timer["count"], 100)
+        self.assertAlmostEqual(timer["total"], 5050)
+        self.assertAlmostEqual(timer["p50"], 51)
+        self.assertAlmostEqual(timer["p95"], 95)
+        self.assertAlmostEqual(timer["max"], 100)
+
+    def testBoundedSamples(self):
+        samples = 10 * TimerStats.ReservoirSize
+        for i in range(samples):
+            Metrics.record("test", i / samples)
+        stats = Metrics.samples["test"]
+        self.assertEqual(len(stats.reservoir), TimerStats.ReservoirSize)
+        timer = Metrics.summary()["timers"]["test"]
+        self.assertEqual(timer["count"], samples)
+        self.assertAlmostEqual(timer["max"], 1000 * (samples - 1) / samples)
+        # a uniform sample keeps the percentiles close to the real ones
+        self.assertAlmostEqual(timer["p50"], 500, delta=50)
+        self.assertAlmostEqual(timer["p95"], 950, delta=25)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,112 @@
+"""
+Encounter Mapper is a tile-based encounter map creator for tabletop RPGs.
+Copyright 2019, 2020 Eric Symmank
+
+This file is part of Encounter Mapper.
+
+Encounter Mapper is free software: you can redistribute it
+and/or modify it under the terms of the GNU General Public License as
+published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+
+Encounter Mapper is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Encounter Mapper.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from EMHelper import ModelManager
+from EMMapFile import MapFileFormat, ChunkedTileGrid
+from EMModel import MapModel, GroupModel
+
+
+class ChunkedMapTest(unittest.TestCase):
+    """Editing maps that were opened lazily from a chunked map file"""
+
+    Size = 100
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="em_test_")
+        grid = [[((x + y) % 7, x % 4, x % 2 == 0, y % 2 == 0)
+                 for x in range(self.Size)] for y in range(self.Size)]
+        self.path = os.path.join(self.directory, "map.emap")
+        f = open(self.path, "wb")
+        f.write(MapFileFormat.dumps(MapModel("map", grid).jsonObj()))
+        f.close()
+        self.model = ModelManager.loadModelFromFile(self.path, MapModel)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def testDelRowBeforeLoading(self):
+        grid = self.model.getTileGrid()
+        self.assertIsInstance(grid, ChunkedTileGrid)
+        self.assertFalse(grid.isLoaded())
+
+        self.model.delRow()
+
+        self.assertEqual(self.model.getNumRows(), self.Size - 1)
+        self.assertEqual(len(grid), self.Size - 1)
+        self.assertEqual(self.model.getTileCounts(),
+                         self.model.countTiles())
+
+
+class ConnectedCellsTest(unittest.TestCase):
+    """The cells a flood fill of a group or map reaches"""
+
+    def group(self, rows):
+        # "#" is a wall tile, "r" the wall turned once and "." the floor
+        tiles = {"#": (1, 0, False, False), "r": (1, 1, False, False),
+                 ".": (-1, 0, False, False)}
+        return GroupModel("group", [[tiles[c] for c in row] for row in rows])
+
+    def fill(self, rows, x, y):
+        return sorted(self.group(rows).connectedCells(x, y))
+
+    def testUniform(self):
+        cells = self.fill(["...", "...", "..."], 1, 1)
+        self.assertEqual(cells, [(x, y) for x in range(3) for y in range(3)])
+
+    def testDiagonalsNotConnected(self):
+        rows = [".#.",
+                "#.#",
+                ".#."]
+        self.assertEqual(self.fill(rows, 1, 1), [(1, 1)])
+        self.assertEqual(self.fill(rows, 0, 0), [(0, 0)])
+
+    def testAroundWalls(self):
+        # reaching the inside of the U needs runs found above and below
+        rows = ["#.#.#",
+                "#.#.#",
+                "#...#",
+                "#####"]
+        self.assertEqual(self.fill(rows, 1, 0),
+                         [(1, 0), (1, 1), (1, 2), (2, 2), (3, 0), (3, 1),
+                          (3, 2)])
+
+    def testOrientationIsADifferentTile(self):
+        rows = ["##r#"]
+        self.assertEqual(self.fill(rows, 0, 0), [(0, 0), (1, 0)])
+        self.assertEqual(self.fill(rows, 2, 0), [(2, 0)])
+
+    def testSeparateRegions(self):
+        rows = ["..#..",
+                "..#..",
+                "#####",
+                "....."]
+        self.assertEqual(self.fill(rows, 4, 0),
+                         [(3, 0), (3, 1), (4, 0), (4, 1)])
+        self.assertEqual(len(self.fill(rows, 2, 1)), 7)
+
+
+if __name__ == "__main__":
+    unittest.main()